@@ -0,0 +1,34 @@
+# Compare the cost of finding our IP addresses (which happens at the start of
+# every transfer) with getifaddrs(3), with the old ip/ifconfig subprocess,
+# and with the cache.
+#
+# run like: python misc/bench-ipaddrs.py
+
+from __future__ import print_function
+import time
+from wormhole import ipaddrs
+
+def timeit(f, count):
+    start = time.time()
+    for i in range(count):
+        result = f()
+    return 1e3 * (time.time() - start) / count, result
+
+def cold_native():
+    # what the first transfer in a process pays, including loading libc
+    ipaddrs._libc = None
+    return ipaddrs._native_addresses()
+
+def main():
+    cases = [("subprocess", ipaddrs._tool_addresses, 20),
+             ("getifaddrs (first call)", cold_native, 20),
+             ("getifaddrs", ipaddrs._native_addresses, 1000),
+             ("cached", ipaddrs.find_addresses, 100000),
+             ]
+    print("%-24s %10s  %s" % ("", "ms/call", "addresses"))
+    for (name, f, count) in cases:
+        ms, result = timeit(f, count)
+        print("%-24s %10.4f  %s" % (name, ms, result))
+
+if __name__ == "__main__":
+    main()
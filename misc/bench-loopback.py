@@ -0,0 +1,218 @@
+# End-to-end transit throughput: a TransitSender and a TransitReceiver (and,
+# with --relay, the transit relay between them) in one process, moving a
+# file's worth of records over loopback (or, with --unix, over a unix-v1
+# Unix-domain socket instead) through the real Connection code:
+# framing, encryption, coalescing, flow control, and the TCP stack. Unlike
+# misc/bench-transit.py, this includes everything but the disk.
+#
+# Each case runs in a child process of its own, so that its CPU time and
+# peak RSS aren't mixed up with the others'. Results are printed as a table,
+# and as JSON (to stdout, or to the --json file) for comparing runs.
+#
+# run like: python misc/bench-loopback.py --size 256 --record-size 16384
+#           --record-size 65536 --relay --unix --json results.json
+#
+# and later, to see what a change did: --baseline results.json
+
+from __future__ import print_function
+import os, sys, json, time, shutil, tempfile, resource, argparse, subprocess
+from twisted.internet import reactor, task
+from twisted.internet.defer import inlineCallbacks, gatherResults, returnValue
+from wormhole import transit
+from wormhole.server.database import get_db
+from wormhole.server.transit_server import Transit
+
+class SourceFile:
+    # 'size' bytes of incompressible data, without keeping them in memory
+    def __init__(self, size, record_size):
+        self._remaining = size
+        self._block = os.urandom(record_size)
+
+    def read(self, size):
+        size = min(size, self._remaining)
+        self._remaining -= size
+        if size == len(self._block):
+            return self._block
+        return self._block[:size]
+
+class NullFile:
+    def write(self, data):
+        pass
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 2.0**20 # bytes
+    return peak / 2.0**10 # KiB
+
+def start_relay():
+    port = transit.allocate_tcp_port()
+    relay = Transit(get_db(":memory:"), None)
+    reactor.listenTCP(port, relay, interface="127.0.0.1")
+    return u"tcp:127.0.0.1:%d" % port
+
+def route_name(case):
+    if case["relay"]:
+        return "relay"
+    if case.get("unix"):
+        return "unix"
+    return "direct"
+
+@inlineCallbacks
+def connect_pair(case, relay, socket_dir, index):
+    # with a relay, neither side listens, so the relay is the only route
+    kwargs = {"no_listen": relay is not None,
+              "crypto_threads": case["crypto_threads"],
+              "compress_level": case["compress"],
+              "unix_socket_dir": socket_dir}
+    s = transit.TransitSender(relay, **kwargs)
+    r = transit.TransitReceiver(relay, **kwargs)
+    key = (u"%d" % index).encode("ascii") * 32
+    s.set_transit_key(key)
+    r.set_transit_key(key)
+    s.add_connection_abilities(r.get_connection_abilities())
+    r.add_connection_abilities(s.get_connection_abilities())
+    shints = yield s.get_connection_hints()
+    rhints = yield r.get_connection_hints()
+    if socket_dir:
+        # the sockets would win anyway, but make sure of it
+        shints = [h for h in shints if h[u"type"] == u"unix-v1"]
+        rhints = [h for h in rhints if h[u"type"] == u"unix-v1"]
+    s.add_connection_hints(rhints)
+    r.add_connection_hints(shints)
+    returnValue((s, r))
+
+@inlineCallbacks
+def run_case(case):
+    relay = start_relay() if case["relay"] else None
+    socket_dir = tempfile.mkdtemp() if case.get("unix") else None
+    pairs = []
+    for i in range(case["stripes"]):
+        pair = yield connect_pair(case, relay, socket_dir, i)
+        pairs.append(pair)
+    if case["stripes"] > 1:
+        x, y = yield gatherResults([
+            transit.connect_striped([s for (s, r) in pairs]),
+            transit.connect_striped([r for (s, r) in pairs])], True)
+    else:
+        s, r = pairs[0]
+        x, y = yield gatherResults([s.connect(), r.connect()], True)
+
+    size = case["size"]
+    cpu_start, start = cpu_time(), time.time()
+    received_d = y.writeToFile(NullFile(), size)
+    fp = transit.FileProducer(case["record_size"])
+    yield fp.beginFileTransfer(SourceFile(size, case["record_size"]), x)
+    received = yield received_d
+    elapsed, cpu = time.time() - start, cpu_time() - cpu_start
+    assert received == size, (received, size)
+
+    result = dict(case)
+    result.update({"seconds": elapsed,
+                   "mb_per_s": size / elapsed / 1e6,
+                   "cpu_s_per_gb": cpu * 2**30 / size,
+                   "peak_rss_mb": peak_rss_mb(),
+                   "sender": x.get_stats(),
+                   "receiver": y.get_stats(),
+                   })
+    yield x.close()
+    yield y.close()
+    if socket_dir:
+        shutil.rmtree(socket_dir)
+    returnValue(result)
+
+def child(case):
+    def _main(reactor):
+        d = run_case(case)
+        d.addCallback(lambda result: print(json.dumps(result)))
+        return d
+    task.react(_main)
+
+def case_key(result):
+    # results from before --unix existed were all over TCP
+    return tuple(result.get(name, False)
+                 for name in ["size", "record_size", "relay", "unix",
+                              "stripes", "crypto_threads", "compress"])
+
+def change(old, new, name):
+    return 100.0 * (new[name] - old[name]) / old[name]
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=256, metavar="MiB",
+                        help="how much data to send in each case")
+    parser.add_argument("--record-size", type=int, action="append",
+                        metavar="BYTES", help="repeat to try several")
+    parser.add_argument("--relay", action="store_true",
+                        help="also try each case through the transit relay")
+    parser.add_argument("--unix", action="store_true",
+                        help="also try each case over a Unix-domain socket")
+    parser.add_argument("--stripes", type=int, default=1)
+    parser.add_argument("--crypto-threads", action="store_true")
+    parser.add_argument("--compress", type=int, metavar="LEVEL")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write results here instead of to stdout")
+    parser.add_argument("--repeat", type=int, default=1, metavar="N",
+                        help="run each case N times and keep the fastest,"
+                        " which is less noisy")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare with the results of an earlier run")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.case:
+        return child(json.loads(args.case))
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            for result in json.load(f):
+                baseline[case_key(result)] = result
+    results = []
+    print("%6s %8s %7s %10s %10s %10s" % ("route", "record", "stripes",
+                                          "MB/s", "cpu s/GB", "RSS MiB"),
+          file=sys.stderr)
+    routes = [(False, False)]
+    if args.unix:
+        routes.append((False, True))
+    if args.relay:
+        routes.append((True, False))
+    for (relay, unix) in routes:
+        for record_size in args.record_size or [2**14, 2**16]:
+            case = {"size": args.size * 2**20, "record_size": record_size,
+                    "relay": relay, "unix": unix, "stripes": args.stripes,
+                    "crypto_threads": args.crypto_threads,
+                    "compress": args.compress}
+            runs = []
+            for i in range(args.repeat):
+                output = subprocess.check_output([sys.executable, __file__,
+                                                  "--case", json.dumps(case)])
+                runs.append(json.loads(output.decode("utf-8")
+                                       .splitlines()[-1]))
+            result = max(runs, key=lambda r: r["mb_per_s"])
+            results.append(result)
+            print("%6s %8d %7d %10.1f %10.3f %10.1f"
+                  % (route_name(case), record_size,
+                     args.stripes, result["mb_per_s"],
+                     result["cpu_s_per_gb"], result["peak_rss_mb"]),
+                  file=sys.stderr)
+            old = baseline.get(case_key(result))
+            if old:
+                print("%6s %8s %7s %+9.1f%% %+9.1f%% %+9.1f%%"
+                      % ("", "", "vs base",
+                         change(old, result, "mb_per_s"),
+                         change(old, result, "cpu_s_per_gb"),
+                         change(old, result, "peak_rss_mb")),
+                      file=sys.stderr)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
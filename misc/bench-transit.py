@@ -0,0 +1,450 @@
+# Microbenchmarks for the transit record layer. These exercise
+# wormhole.transit.Connection directly (no network), so they measure only
+# the Python-side cost of framing, encrypting, and reassembling records.
+#
+# run like: python misc/bench-transit.py [BENCHMARK..]
+
+from __future__ import print_function
+import io, os, sys, time, hashlib, tempfile
+from binascii import hexlify, unhexlify
+from nacl.secret import SecretBox
+from twisted.test import proto_helpers
+from twisted.python.threadpool import ThreadPool
+from six.moves import queue
+from twisted.protocols import basic
+from wormhole import transit, framing, hashing, delta
+
+# CPU time, not wall-clock time
+try:
+    clock = time.process_time
+except AttributeError: # py2
+    clock = time.clock
+
+class Owner:
+    def __init__(self, send_key=b"s"*32, receive_key=b"r"*32):
+        self._send_key = send_key
+        self._receive_key = receive_key
+    def connection_ready(self, connection):
+        return "go"
+    def connection_negotiated(self, connection):
+        pass
+    def _send_this(self):
+        return b"send_this"
+    def _expect_this(self):
+        return b"expect_this"
+    def _sender_record_key(self):
+        return self._send_key
+    def _receiver_record_key(self):
+        return self._receive_key
+
+class Factory:
+    def connectionWasMade(self, p):
+        pass
+
+def make_connection(owner=None):
+    owner = owner or Owner()
+    c = transit.Connection(owner, None, None, "bench")
+    c.transport = proto_helpers.StringTransport()
+    c.factory = Factory()
+    c.connectionMade()
+    c.startNegotiation()
+    c.dataReceived(b"expect_this")
+    assert c.state == "records", c.state
+    c.transport.clear()
+    return c, owner
+
+def build_wire(owner, count, size):
+    # what the peer would put on the wire for 'count' records
+    box = SecretBox(owner._receiver_record_key())
+    record = b"\x00" * size
+    chunks = []
+    for i in range(count):
+        encrypted = box.encrypt(record, unhexlify("%048x" % i))
+        chunks.append(unhexlify("%08x" % len(encrypted)))
+        chunks.append(encrypted)
+    return b"".join(chunks)
+
+def bench_reassembly():
+    """Deliver N records in a single dataReceived() burst, as a fast link
+    would. Per-record cost should stay flat as the burst grows."""
+    size = 1024
+    print("%8s %10s %12s %10s" % ("records", "burst", "us/record", "Gbit/s"))
+    for count in [10, 100, 1000, 10000]:
+        c, owner = make_connection()
+        c.recordReceived = lambda record: None
+        wire = build_wire(owner, count, size)
+        start = time.time()
+        c.dataReceived(wire)
+        elapsed = time.time() - start
+        assert c.next_receive_nonce == count
+        print("%8d %9dk %12.2f %10.2f" % (count, len(wire) // 1024,
+                                          1e6 * elapsed / count,
+                                          8 * len(wire) / elapsed / 1e9))
+
+def _per_call(f, arg, count=200000):
+    start = time.time()
+    for i in range(count):
+        f(arg)
+    return 1e9 * (time.time() - start) / count
+
+def bench_framing():
+    """Compare the struct-based length/nonce codecs against the hex-string
+    formatting they replaced, then measure a whole send_record()."""
+    encrypted = framing.encode_nonce(12345) + b"\x00" * (2**14 + 16)
+    length = framing.encode_length(2**14 + 40)
+    cases = [
+        ("encode nonce",
+         lambda n: unhexlify("%048x" % n), framing.encode_nonce, 12345),
+        ("decode nonce",
+         lambda b: int(hexlify(b[:24]), 16), framing.decode_nonce, encrypted),
+        ("encode length",
+         lambda n: unhexlify("%08x" % n), framing.encode_length, 2**14 + 40),
+        ("decode length",
+         lambda b: int(hexlify(b[:4]), 16), framing.decode_length, length),
+        ]
+    print("%-14s %10s %10s" % ("", "hex ns", "struct ns"))
+    for (name, old, new, arg) in cases:
+        assert old(arg) == new(arg)
+        print("%-14s %10.0f %10.0f" % (name, _per_call(old, arg),
+                                       _per_call(new, arg)))
+
+    c, owner = make_connection()
+    record = b"\x00" * 2**14
+    count = 20000
+    start = time.time()
+    for i in range(count):
+        c.send_record(record)
+        c.transport.clear()
+    elapsed = time.time() - start
+    print("send_record(16KiB): %.2f us/record" % (1e6 * elapsed / count))
+
+def bench_coalesce():
+    """Push a file through FileSender into a Connection, the way 'wormhole
+    send' does, and count how many transport writes that took."""
+    size = 64 * 2**20
+    c, owner = make_connection()
+    writes = []
+    c.transport.writeSequence = lambda data: writes.append(len(data))
+    fs = basic.FileSender()
+    start = time.time()
+    d = fs.beginFileTransfer(io.BytesIO(b"\x00" * size), c)
+    while c.transport.producer:
+        c.transport.producer.resumeProducing()
+    elapsed = time.time() - start
+    assert d.called
+    stats = c.get_stats()
+    print("%d records, %d transport writes (%d saved), %.1f records/write"
+          % (stats["records_sent"], stats["write_calls"],
+             stats["writes_saved"],
+             1.0 * stats["records_sent"] / stats["write_calls"]))
+    print("%.1f MB/s" % (size / elapsed / 1e6))
+
+def bench_record_size():
+    """Send a file through a FileProducer at various record sizes, then feed
+    the resulting bytes into a receiving Connection. Reports the CPU time
+    spent per GB on each side."""
+    size = 64 * 2**20
+    data = b"\x00" * size
+    print("%10s %14s %14s" % ("record", "tx cpu s/GB", "rx cpu s/GB"))
+    for record_size in [2**14, 2**15, 2**16, 2**17, 2**18, 2**20]:
+        tx, owner = make_connection()
+        rx, _ = make_connection(Owner(send_key=owner._receive_key,
+                                      receive_key=owner._send_key))
+        received = []
+        rx.recordReceived = lambda record: received.append(len(record))
+
+        start = clock()
+        fp = transit.FileProducer(record_size)
+        fp.beginFileTransfer(io.BytesIO(data), tx)
+        while tx.transport.producer:
+            tx.transport.producer.resumeProducing()
+        tx_cpu = clock() - start
+        wire = tx.transport.value()
+
+        start = clock()
+        for i in range(0, len(wire), 2**16):
+            rx.dataReceived(wire[i:i+2**16])
+        rx_cpu = clock() - start
+        assert sum(received) == size
+        print("%9dk %14.2f %14.2f" % (record_size // 1024,
+                                      tx_cpu * 2**30 / size,
+                                      rx_cpu * 2**30 / size))
+
+class ThreadReactor:
+    # stands in for the reactor: results from the crypto threads are queued
+    # here, and the benchmark loop runs them in the main thread
+    def __init__(self):
+        self.calls = queue.Queue()
+    def callFromThread(self, f, *args, **kwargs):
+        self.calls.put((f, args, kwargs))
+    def run_one(self):
+        f, args, kwargs = self.calls.get()
+        f(*args, **kwargs)
+
+def bench_crypto_threads():
+    """Encrypt a file with use_crypto_threads() and a pool of N threads,
+    and report the throughput. With enough cores this should scale until
+    the main thread (framing, and writing to the transport) is the
+    bottleneck."""
+    size = 64 * 2**20
+    data = b"\x00" * size
+    cpus = getattr(os, "cpu_count", lambda: None)()
+    print("%d CPUs" % cpus if cpus else "unknown number of CPUs")
+    print("%8s %10s" % ("threads", "MB/s"))
+    for count in [0, 1, 2, 4, 8]:
+        c, owner = make_connection()
+        if count:
+            pool = ThreadPool(minthreads=count, maxthreads=count)
+            pool.start()
+            r = ThreadReactor()
+            c.use_crypto_threads(r, pool)
+        start = time.time()
+        fp = transit.FileProducer(2**16)
+        fp.beginFileTransfer(io.BytesIO(data), c)
+        while c.transport.producer or c._encrypting:
+            if c.transport.producer and not c._outbound_full():
+                c.transport.producer.resumeProducing()
+            else:
+                r.run_one()
+        elapsed = time.time() - start
+        if count:
+            pool.stop()
+        assert len(c.transport.value()) > size
+        print("%8s %10.1f" % (count or "none", size / elapsed / 1e6))
+
+class Unmappable:
+    # hides fileno(), so FileProducer falls back to read()
+    def __init__(self, f):
+        self.read = f.read
+        self.tell = f.tell
+        self.seek = f.seek
+
+class NullConsumer:
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+    def unregisterProducer(self):
+        self.producer = None
+    def write(self, data):
+        pass
+
+def bench_file_producer():
+    """Read a file from disk (well, from the page cache) through a
+    FileProducer with read() and with mmap(), hashing each record the way
+    'wormhole send' does, then again with encryption. Reports CPU time per
+    GB."""
+    size = 256 * 2**20
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(os.urandom(size))
+        f.flush()
+        print("%8s %14s %10s" % ("reader", "consumer", "cpu s/GB"))
+        for name in ["hash", "hash+encrypt"]:
+            for mode in ["read()", "mmap"]:
+                if name == "hash":
+                    consumer = NullConsumer()
+                else:
+                    consumer, owner = make_connection()
+                    consumer.transport.write = lambda data: None
+                    consumer.transport.writeSequence = lambda data: None
+                f.seek(0)
+                reader = Unmappable(f) if mode == "read()" else f
+                hasher = hashlib.sha256()
+                def _hash(data):
+                    hasher.update(data)
+                    return data
+                start = clock()
+                fp = transit.FileProducer(2**16)
+                d = fp.beginFileTransfer(reader, consumer, _hash)
+                if name == "hash":
+                    while consumer.producer:
+                        fp.resumeProducing()
+                else:
+                    while consumer.transport.producer:
+                        consumer.transport.producer.resumeProducing()
+                elapsed = clock() - start
+                assert d.called
+                print("%8s %14s %10.3f" % (mode, name,
+                                            elapsed * 2**30 / size))
+
+def bench_hashing():
+    """Raw speed of each hash we can negotiate, then a file pushed through
+    a FileProducer into an encrypting Connection, hashed inline (as before)
+    or by a ThreadedHasher. Threading only helps if there is a spare core."""
+    size = 64 * 2**20
+    data = b"\x00" * size
+    cpus = getattr(os, "cpu_count", lambda: None)()
+    print("%d CPUs" % cpus if cpus else "unknown number of CPUs")
+    for name in hashing.preferred_hashes():
+        hasher = hashing.new_hash(name)
+        start = time.time()
+        for i in range(0, size, 2**16):
+            hasher.update(data[i:i+2**16])
+        print("%8s alone: %8.1f MB/s" % (name, size / (time.time()-start)
+                                        / 1e6))
+    print("%8s %10s %10s" % ("hash", "where", "MB/s"))
+    for name in hashing.preferred_hashes():
+        for where in ["inline", "thread"]:
+            c, owner = make_connection()
+            hasher = hashing.new_hash(name)
+            r = ThreadReactor()
+            if where == "inline":
+                update = hasher.update
+            else:
+                th = hashing.ThreadedHasher(r, hasher)
+                update = th.update
+            def _hash(chunk):
+                update(chunk)
+                return chunk
+            start = time.time()
+            fp = transit.FileProducer(2**16)
+            fp.beginFileTransfer(io.BytesIO(data), c, _hash)
+            while c.transport.producer:
+                c.transport.producer.resumeProducing()
+                c.transport.clear()
+            if where == "thread":
+                th.finish()
+                r.run_one()
+            hasher.digest()
+            elapsed = time.time() - start
+            print("%8s %10s %10.1f" % (name, where, size / elapsed / 1e6))
+
+def _corpora(size):
+    lines = ["2016-06-%02d 12:%02d:%02d INFO worker-%d: processed request "
+             "%d in %dms\n" % (i % 28 + 1, i % 60, i % 59, i % 7, i, i % 997)
+             for i in range(size // 50)]
+    log = "".join(lines).encode("ascii")[:size]
+    records = ['{"id": %d, "name": "item-%d", "tags": ["a", "b"], '
+               '"price": %d.%02d}' % (i, i * 7919 % 10007, i % 500, i % 100)
+               for i in range(size // 40)]
+    dump = ("[" + ",\n".join(records) + "]").encode("ascii")[:size]
+    noise = os.urandom(size)
+    # like a tarball of logs and photos: 4MiB of each, in turn
+    step = 4 * 2**20
+    mixed = b"".join(log[i:i+step] if (i // step) % 2 else noise[i:i+step]
+                     for i in range(0, size, step))
+    return [("log", log), ("json", dump), ("random", noise),
+            ("mixed", mixed)]
+
+def bench_compression():
+    """Send each corpus through an encrypting Connection with compress-v1
+    at a few zlib levels. Reports the bytes that hit the wire (as a
+    fraction of the file) and the sender's CPU time per GB."""
+    size = 32 * 2**20
+    print("%10s %6s %8s %10s" % ("corpus", "level", "wire", "cpu s/GB"))
+    for name, data in _corpora(size):
+        for level in [None, 1, 6, 9]:
+            c, owner = make_connection()
+            c.use_compression(level)
+            wire = [0]
+            def _write(frames, wire=wire):
+                wire[0] += sum(len(f) for f in frames)
+            c.transport.writeSequence = _write
+            start = clock()
+            for i in range(0, size, 2**16):
+                c.send_record(data[i:i+2**16])
+            elapsed = clock() - start
+            print("%10s %6s %8.3f %10.3f" % (name, level or "off",
+                                             wire[0] / float(size),
+                                             elapsed * 2**30 / size))
+
+def bench_delta():
+    """Send a new version of a file to a receiver that has the old one:
+    the bytes on the wire (as a fraction of the file), and the CPU time
+    each side spends per GB of file, for a few kinds of change."""
+    size = 64 * 2**20
+    old = os.urandom(size)
+    cases = [("unchanged", old),
+             ("10 edits", b"".join(old[i:i+size//10] + b"edit %d" % i
+                                   for i in range(0, size, size//10))),
+             ("appended", old + os.urandom(2**20)),
+             ("unrelated", os.urandom(size)),
+             ]
+    block_size = delta.block_size_for(size)
+    start = clock()
+    sigs = delta.signatures(io.BytesIO(old), block_size)
+    sig_time = clock() - start
+    print("block size %d, signatures %d bytes, %.3f cpu s/GB"
+          % (block_size, len(sigs), sig_time * 2**30 / size))
+    print("%10s %8s %12s %12s" % ("new file", "wire", "send s/GB",
+                                   "apply s/GB"))
+    parsed = delta.parse_signatures(sigs)
+    for name, new in cases:
+        reader = delta.DeltaReader(io.BytesIO(new), block_size, parsed,
+                                   2**16)
+        start = clock()
+        records = []
+        while True:
+            record = reader.read(2**16)
+            if not record:
+                break
+            records.append(record)
+        send_time = clock() - start
+        applier = delta.DeltaApplier(io.BytesIO(old), block_size,
+                                     len(old) // block_size)
+        start = clock()
+        for record in records:
+            applier.apply(record)
+        apply_time = clock() - start
+        wire = len(sigs) + sum(len(r) for r in records)
+        print("%10s %8.4f %12.3f %12.3f" % (name, wire / float(len(new)),
+                                           send_time * 2**30 / len(new),
+                                           apply_time * 2**30 / len(new)))
+
+def bench_stream_read():
+    """Drain inbound records with one receive_record() Deferred per record,
+    and with one read() or read_chunks() per burst of records. Records are
+    handed to recordReceived() directly, so this leaves out decryption."""
+    record = b"\x00" * 1024
+    total = 200000
+    def per_record(c, burst, sink):
+        for i in range(burst):
+            c.receive_record().addCallback(sink)
+    def read(c, burst, sink):
+        c.read().addCallback(sink)
+    def read_chunks(c, burst, sink):
+        c.read_chunks().addCallback(sink)
+    readers = [("receive_record", per_record), ("read", read),
+               ("read_chunks", read_chunks)]
+    print("%8s %s" % ("burst", " ".join("%16s" % n for (n, _) in readers)))
+    for burst in [1, 4, 16, 64]:
+        times = []
+        for (name, reader) in readers:
+            c, owner = make_connection()
+            got = []
+            start = time.time()
+            for i in range(total // burst):
+                for j in range(burst):
+                    c.recordReceived(record)
+                reader(c, burst, got.append)
+            elapsed = time.time() - start
+            assert got and not c._inbound_records
+            times.append(1e6 * elapsed / total)
+        print("%8d %s" % (burst, " ".join("%13.2f us" % t for t in times)))
+
+BENCHMARKS = [("reassembly", bench_reassembly),
+              ("framing", bench_framing),
+              ("coalesce", bench_coalesce),
+              ("record-size", bench_record_size),
+              ("crypto-threads", bench_crypto_threads),
+              ("file-producer", bench_file_producer),
+              ("hashing", bench_hashing),
+              ("compression", bench_compression),
+              ("delta", bench_delta),
+              ("stream-read", bench_stream_read),
+              ]
+
+def main(argv):
+    names = argv or [name for (name, _) in BENCHMARKS]
+    known = dict(BENCHMARKS)
+    for name in names:
+        if name not in known:
+            print("unknown benchmark '%s', try one of: %s"
+                  % (name, " ".join(n for (n, _) in BENCHMARKS)))
+            return 1
+    for name in names:
+        print("== %s ==" % name)
+        known[name]()
+        print()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
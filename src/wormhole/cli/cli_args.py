@@ -31,6 +31,19 @@ g.add_argument("--no-listen", action="store_true",
                help="(debug) don't open a listening socket for Transit")
 g.add_argument("--tor", action="store_true",
                help="use Tor when connecting")
+g.add_argument("--crypto-threads", action="store_true",
+               help="(experimental) encrypt file data on several CPU cores")
+g.add_argument("--compress", type=int, choices=range(1, 10), metavar="LEVEL",
+               help="(experimental) compress file data with zlib at LEVEL"
+               " (1-9), for as long as that helps")
+g.add_argument("--route-cache", type=type(u""), metavar="FILE",
+               help="(experimental) remember which transit route worked")
+g.add_argument("--udp", action="store_true",
+               help="(experimental) also offer and try reliable-UDP transit"
+               " connections")
+g.add_argument("--unix-socket-dir", type=type(u""), metavar="DIR",
+               help="(experimental) also listen on, and connect to, Unix"
+               " sockets in DIR, for peers on the same host (or sharing DIR)")
 parser.set_defaults(timing=None)
 subparsers = parser.add_subparsers(title="subcommands",
                                    dest="subcommand")
@@ -98,6 +111,8 @@ p.add_argument("-0", dest="zeromode", action="store_true",
                help="enable no-code anything-goes mode")
 p.add_argument("what", nargs="?", default=None, metavar="[FILENAME|DIRNAME]",
                help="the file/directory to send")
+p.add_argument("--stripes", type=int, default=1, metavar="N",
+               help="(experimental) send a file over N parallel connections")
 p.set_defaults(func="send/send")
 
 # CLI: receive
@@ -110,6 +125,11 @@ p.add_argument("-t", "--only-text", dest="only_text", action="store_true",
                help="refuse file transfers, only accept text transfers")
 p.add_argument("--accept-file", dest="accept_file", action="store_true",
                help="accept file transfer with asking for confirmation")
+p.add_argument("--delta", action="store_true",
+               help=dedent("""\
+               If the file already exists, replace it with the new one, and
+               only fetch the parts of it that have changed."""),
+               )
 p.add_argument("-o", "--output-file", default=None, metavar="FILENAME|DIRNAME",
                help=dedent("""\
                The file or directory to create, overriding the name suggested
@@ -1,15 +1,23 @@
 from __future__ import print_function
-import os, sys, six, tempfile, zipfile, hashlib
+import os, sys, six, tempfile, zipfile
 from tqdm import tqdm
-from twisted.internet import reactor
+from twisted.internet import reactor, error
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.threads import deferToThreadPool
 from twisted.python import log
 from ..wormhole import wormhole
-from ..transit import TransitReceiver
+from ..route_cache import RouteCache
+from ..fileutil import reserve_space
+from .. import delta
+from ..hashing import choose_hash, new_hash, background_hasher, DEFAULT_HASH
+from ..transit import (TransitReceiver, MAX_STRIPES, connect_striped,
+                       ConnectionHistory)
 from ..errors import TransferError, WormholeClosedError
 from ..util import dict_to_bytes, bytes_to_dict, bytes_to_hexstr
 
 APPID = u"lothar.com/wormhole/text-or-file-xfer"
+# how many times we'll reconnect after losing the transit connection
+MAX_RESUMES = 5
 
 class RespondError(Exception):
     def __init__(self, response):
@@ -33,6 +41,20 @@ class TwistedReceiver:
         self._reactor = reactor
         self._tor_manager = None
         self._transit_receiver = None
+        self._stripe_receivers = None # None means "not striped"
+        self._resume_v1 = False
+        self._hashes_v1 = False # did the sender offer a choice of hashes?
+        self._hash_name = DEFAULT_HASH
+        self._hasher = new_hash(DEFAULT_HASH) # everything in the file so far
+        self._basis = None # our old copy, when it can save a full transfer
+        self._delta_v1 = None
+        self._signatures_d = None
+        # shared by every Transit we make (stripes, resumes), so each one
+        # tries first what worked for the others
+        self._history = ConnectionHistory()
+        self._route_cache = None
+        if args.route_cache:
+            self._route_cache = RouteCache(args.route_cache)
 
     def _msg(self, *args, **kwargs):
         print(*args, file=self.args.stdout, **kwargs)
@@ -138,26 +160,57 @@ class TwistedReceiver:
             return
         yield self._build_transit(w, sender_transit)
 
+    def _make_transit_receiver(self):
+        return TransitReceiver(self.args.transit_helper,
+                               no_listen=self.args.no_listen,
+                               tor_manager=self._tor_manager,
+                               reactor=self._reactor,
+                               timing=self.args.timing,
+                               crypto_threads=self.args.crypto_threads,
+                               compress_level=self.args.compress,
+                               route_cache=self._route_cache,
+                               udp=self.args.udp,
+                               unix_socket_dir=self.args.unix_socket_dir,
+                               history=self._history)
+
     @inlineCallbacks
     def _build_transit(self, w, sender_transit):
-        tr = TransitReceiver(self.args.transit_helper,
-                             no_listen=self.args.no_listen,
-                             tor_manager=self._tor_manager,
-                             reactor=self._reactor,
-                             timing=self.args.timing)
+        tr = self._make_transit_receiver()
         self._transit_receiver = tr
         transit_key = w.derive_key(APPID+u"/transit-key", tr.TRANSIT_KEY_LENGTH)
         tr.set_transit_key(transit_key)
 
+        tr.add_connection_abilities(sender_transit.get("abilities-v1", []))
         tr.add_connection_hints(sender_transit.get("hints-v1", []))
         receiver_abilities = tr.get_connection_abilities()
         receiver_hints = yield tr.get_connection_hints()
         receiver_transit = {"abilities-v1": receiver_abilities,
                             "hints-v1": receiver_hints,
                             }
+        if u"stripes-v1" in sender_transit:
+            stripes = sender_transit[u"stripes-v1"][:MAX_STRIPES-1]
+            receiver_transit["stripes-v1"] = yield self._build_stripes(
+                w, stripes)
         self._send_data({u"transit": receiver_transit}, w)
         # TODO: send more hints as the TransitReceiver produces them
 
+    @inlineCallbacks
+    def _build_stripes(self, w, sender_stripes):
+        # the sender wants to spread the file over several connections, each
+        # of which is a complete Transit of its own
+        self._stripe_receivers = []
+        stripes = []
+        for i, sender_stripe in enumerate(sender_stripes, 1):
+            tr = self._make_transit_receiver()
+            self._stripe_receivers.append(tr)
+            stripe_key = w.derive_key(APPID+u"/transit-key/stripe-%d" % i,
+                                      tr.TRANSIT_KEY_LENGTH)
+            tr.set_transit_key(stripe_key)
+            tr.add_connection_hints(sender_stripe.get("hints-v1", []))
+            hints = yield tr.get_connection_hints()
+            stripes.append({u"hints-v1": hints})
+        returnValue(stripes)
+
     @inlineCallbacks
     def _parse_offer(self, them_d, w):
         if "message" in them_d:
@@ -166,16 +219,16 @@ class TwistedReceiver:
         # transit will be created by this point, but not connected
         if "file" in them_d:
             f = self._handle_file(them_d)
-            self._send_permission(w)
+            self._send_permission(w, f)
             rp = yield self._establish_transit()
-            datahash = yield self._transfer_data(rp, f)
+            rp, datahash = yield self._transfer_data(rp, f, w)
             self._write_file(f)
             yield self._close_transit(rp, datahash)
         elif "directory" in them_d:
             f = self._handle_directory(them_d)
-            self._send_permission(w)
+            self._send_permission(w, f)
             rp = yield self._establish_transit()
-            datahash = yield self._transfer_data(rp, f)
+            rp, datahash = yield self._transfer_data(rp, f, w)
             self._write_directory(f)
             yield self._close_transit(rp, datahash)
         else:
@@ -191,14 +244,74 @@ class TwistedReceiver:
     def _handle_file(self, them_d):
         file_data = them_d["file"]
         self.abs_destname = self._decide_destname("file",
-                                                  file_data["filename"])
+                                                  file_data["filename"],
+                                                  update=self.args.delta)
         self.xfersize = file_data["filesize"]
 
         self._msg(u"Receiving file (%d bytes) into: %s" %
                   (self.xfersize, os.path.basename(self.abs_destname)))
         self._ask_permission()
+        self._resume_v1 = bool(file_data.get("resume-v1"))
+        self._choose_hash(file_data)
         tmp_destname = self.abs_destname + ".tmp"
-        return open(tmp_destname, "wb")
+        if self._resume_v1 and os.path.exists(tmp_destname):
+            # left behind by an earlier attempt: offer the sender to pick up
+            # where that one stopped
+            f = open(tmp_destname, "r+b")
+            self._hash_partial(f)
+        else:
+            f = open(tmp_destname, "wb")
+            if (file_data.get("delta-v1") and self._stripe_receivers is None
+                and os.path.exists(self.abs_destname)):
+                self._open_basis()
+        self._reserve_space(f)
+        return f
+
+    def _open_basis(self):
+        # we have an older copy, so the sender only has to send us what has
+        # changed since. Computing the block signatures means reading all of
+        # it, which can overlap with setting up the transit connection.
+        self._basis = open(self.abs_destname, "rb")
+        block_size = delta.block_size_for(self.xfersize)
+        blocks = os.fstat(self._basis.fileno()).st_size // block_size
+        self._delta_v1 = {u"block_size": block_size, u"blocks": blocks}
+        self._signatures_d = deferToThreadPool(self._reactor,
+                                               self._reactor.getThreadPool(),
+                                               delta.signatures,
+                                               self._basis, block_size)
+
+    def _close_basis(self):
+        if self._basis is not None:
+            self._basis.close()
+            self._basis = None
+
+    def _reserve_space(self, f):
+        try:
+            reserve_space(f, self.xfersize)
+        except EnvironmentError:
+            self._msg(u"Error: not enough free disk space for %s" %
+                      os.path.basename(f.name))
+            empty = f.tell() == 0
+            f.close()
+            if empty:
+                os.unlink(f.name)
+            raise RespondError("not enough disk space")
+
+    def _hash_partial(self, f):
+        hasher = new_hash(self._hash_name)
+        while True:
+            chunk = f.read(2**20)
+            if not chunk:
+                break
+            hasher.update(chunk)
+        if f.tell() > self.xfersize:
+            # not from this file, then
+            f.seek(0)
+            f.truncate()
+            hasher = new_hash(self._hash_name)
+        self._hasher = hasher
+        if f.tell():
+            self._msg(u"Found %d bytes from an earlier attempt" % f.tell())
 
     def _handle_directory(self, them_d):
         file_data = them_d["directory"]
@@ -215,9 +328,16 @@ class TwistedReceiver:
         self._msg(u"%d files, %d bytes (uncompressed)" %
                   (file_data["numfiles"], file_data["numbytes"]))
         self._ask_permission()
+        self._resume_v1 = bool(file_data.get("resume-v1"))
+        self._choose_hash(file_data)
         return tempfile.SpooledTemporaryFile()
 
-    def _decide_destname(self, mode, destname):
+    def _choose_hash(self, file_data):
+        self._hashes_v1 = "hashes-v1" in file_data
+        self._hash_name = choose_hash(file_data.get("hashes-v1"))
+        self._hasher = new_hash(self._hash_name)
+
+    def _decide_destname(self, mode, destname, update=False):
         # the basename() is intended to protect us against
         # "~/.ssh/authorized_keys" and other attacks
         destname = os.path.basename(destname)
@@ -227,6 +347,9 @@ class TwistedReceiver:
 
         # get confirmation from the user before writing to the local directory
         if os.path.exists(abs_destname):
+            if update and os.path.isfile(abs_destname):
+                self._msg(u"Updating existing %s %s" % (mode, destname))
+                return abs_destname
             self._msg(u"Error: refusing to overwrite existing %s %s" %
                       (mode, destname))
             raise RespondError("%s already exists" % mode)
@@ -243,43 +366,189 @@ class TwistedReceiver:
                 raise RespondError("transfer rejected")
             t.detail(answer="yes")
 
-    def _send_permission(self, w):
-        self._send_data({"answer": { "file_ack": "ok" }}, w)
+    def _send_permission(self, w, f):
+        answer = {"file_ack": "ok"}
+        if self._hashes_v1:
+            answer["hash-v1"] = self._hash_name
+        if self._resume_v1:
+            answer["resume-v1"] = self._resume_point(f)
+        if self._delta_v1:
+            answer["delta-v1"] = self._delta_v1
+        self._send_data({"answer": answer}, w)
+
+    def _resume_point(self, f):
+        # the sender checks this against its own copy before skipping ahead
+        return {u"offset": f.tell(),
+                self._hash_name: self._hasher.hexdigest()}
 
     @inlineCallbacks
     def _establish_transit(self):
-        record_pipe = yield self._transit_receiver.connect()
+        if self._stripe_receivers is not None:
+            record_pipe = yield connect_striped([self._transit_receiver] +
+                                                self._stripe_receivers)
+        else:
+            record_pipe = yield self._transit_receiver.connect()
         self.args.timing.add("transit connected")
         returnValue(record_pipe)
 
     @inlineCallbacks
-    def _transfer_data(self, record_pipe, f):
-        # now receive the rest of the owl
+    def _transfer_data(self, record_pipe, f, w):
+        # now receive the rest of the owl. If the connection drops and the
+        # sender knows about resume-v1, we build a new one and carry on from
+        # where the old one stopped.
+        resumes = 0
+        while True:
+            try:
+                if self._basis is not None:
+                    yield self._receive_delta(record_pipe, f)
+                else:
+                    yield self._receive_data(record_pipe, f)
+                break
+            except error.ConnectionClosed:
+                if not self._resume_v1 or resumes >= MAX_RESUMES:
+                    self._connection_dropped(f)
+            finally:
+                # only the first connection carries a delta: if it drops,
+                # the sender sends the rest of the file in full
+                self._close_basis()
+            # the other stripes may still be up: hang them up before we
+            # build the new connection, or they'd stay open until we exit
+            record_pipe.close()
+            self._stripe_receivers = None
+            resumes += 1
+            self._msg(u"Connection dropped, resuming at byte %d.." % f.tell())
+            record_pipe = yield self._resume_transit(w, f, resumes)
+        returnValue((record_pipe, self._hasher.digest()))
+
+    def _connection_dropped(self, f):
+        self._msg()
+        self._msg(u"Connection dropped before full file received")
+        self._msg(u"got %d bytes, wanted %d" % (f.tell(), self.xfersize))
+        raise TransferError("Connection dropped before full file received")
+
+    @inlineCallbacks
+    def _receive_data(self, record_pipe, f):
         self._msg(u"Receiving (%s).." % record_pipe.describe())
+        if self._resume_v1:
+            header_bytes = yield record_pipe.receive_record()
+            self._seek_to(f, bytes_to_dict(header_bytes).get(u"offset"))
+        start = f.tell()
+        wanted = self.xfersize - start
+
+        # the hashing happens in another thread too, CPUs permitting
+        bg_hasher = background_hasher(self._reactor, self._hasher)
+        try:
+            with self.args.timing.add("rx file", offset=start,
+                                      hash=self._hash_name) as t:
+                progress = tqdm(file=self.args.stdout,
+                                disable=self.args.hide_progress,
+                                unit="B", unit_scale=True,
+                                total=self.xfersize)
+                progress.update(start)
+                received = 0
+                with progress:
+                    if wanted:
+                        # the writes happen in a thread, so a slow disk
+                        # slows the sender down instead of stalling our
+                        # reactor
+                        received = yield record_pipe.writeToFile(
+                            f, wanted, progress.update,
+                            bg_hasher.update, reactor=self._reactor)
+                t.detail(**record_pipe.get_stats())
+        finally:
+            yield bg_hasher.finish()
 
-        with self.args.timing.add("rx file"):
+        # except TransitError
+        if received < wanted:
+            self._connection_dropped(f)
+        assert received == wanted
+
+    @inlineCallbacks
+    def _receive_delta(self, record_pipe, f):
+        self._msg(u"Receiving changes (%s).." % record_pipe.describe())
+        # first the signatures of our blocks, as many to a record as fit
+        signatures = yield self._signatures_d
+        per_record = self._transit_receiver.get_record_size()
+        per_record -= per_record % delta.SIGNATURE.size
+        for i in range(0, len(signatures), per_record):
+            record_pipe.send_record(signatures[i:i+per_record])
+        header_bytes = yield record_pipe.receive_record()
+        self._seek_to(f, bytes_to_dict(header_bytes).get(u"offset"))
+
+        applier = delta.DeltaApplier(self._basis,
+                                     self._delta_v1[u"block_size"],
+                                     self._delta_v1[u"blocks"])
+        received = f.tell()
+        with self.args.timing.add("rx file", offset=received, delta=True,
+                                  hash=self._hash_name) as t:
             progress = tqdm(file=self.args.stdout,
                             disable=self.args.hide_progress,
-                            unit="B", unit_scale=True, total=self.xfersize)
-            hasher = hashlib.sha256()
+                            unit="B", unit_scale=True,
+                            total=self.xfersize)
+            progress.update(received)
             with progress:
-                received = yield record_pipe.writeToFile(f, self.xfersize,
-                                                         progress.update,
-                                                         hasher.update)
-            datahash = hasher.digest()
+                while received < self.xfersize:
+                    record = yield record_pipe.receive_record()
+                    try:
+                        chunks = applier.apply(record)
+                    except delta.DeltaError as e:
+                        raise TransferError("bad delta from sender: %s" % e)
+                    for chunk in chunks:
+                        f.write(chunk)
+                        self._hasher.update(chunk)
+                        received += len(chunk)
+                        progress.update(len(chunk))
+            t.detail(**record_pipe.get_stats())
+            t.detail(delta_copied=applier.copied,
+                     delta_literal=applier.literal)
+        if received != self.xfersize:
+            raise TransferError("delta from sender made %d bytes, not %d"
+                                % (received, self.xfersize))
+
+    def _seek_to(self, f, offset):
+        if offset == f.tell():
+            return
+        if offset == 0:
+            # the sender didn't recognize what we have: start over
+            f.seek(0)
+            f.truncate()
+            self._hasher = new_hash(self._hash_name)
+            return
+        raise TransferError("sender resumed at unexpected offset %r"
+                            % (offset,))
 
-        # except TransitError
-        if received < self.xfersize:
-            self._msg()
-            self._msg(u"Connection dropped before full file received")
-            self._msg(u"got %d bytes, wanted %d" % (received, self.xfersize))
-            raise TransferError("Connection dropped before full file received")
-        assert received == self.xfersize
-        returnValue(datahash)
+    @inlineCallbacks
+    def _resume_transit(self, w, f, resumes):
+        # a fresh Transit (with its own key) for each attempt. We send our
+        # hints along with the resume request, the sender replies with its.
+        tr = self._make_transit_receiver()
+        transit_key = w.derive_key(APPID+u"/transit-key/resume-%d" % resumes,
+                                   tr.TRANSIT_KEY_LENGTH)
+        tr.set_transit_key(transit_key)
+        receiver_hints = yield tr.get_connection_hints()
+        resume = self._resume_point(f)
+        resume[u"transit"] = {"abilities-v1": tr.get_connection_abilities(),
+                              "hints-v1": receiver_hints,
+                              }
+        self._send_data({u"resume-v1": resume}, w)
+        them_d = yield self._get_data(w)
+        if u"transit" not in them_d:
+            raise TransferError("unexpected message while resuming: %r"
+                                % (them_d,))
+        sender_transit = them_d[u"transit"]
+        tr.add_connection_abilities(sender_transit.get("abilities-v1", []))
+        tr.add_connection_hints(sender_transit.get("hints-v1", []))
+        self._transit_receiver = tr
+        record_pipe = yield tr.connect()
+        self.args.timing.add("transit connected", resume=resumes)
+        returnValue(record_pipe)
 
     def _write_file(self, f):
         tmp_name = f.name
         f.close()
+        if sys.platform == "win32" and os.path.exists(self.abs_destname):
+            # replacing an older copy (--delta), which rename() won't do here
+            os.unlink(self.abs_destname)
         os.rename(tmp_name, self.abs_destname)
         self._msg(u"Received file written to %s" %
                   os.path.basename(self.abs_destname))
@@ -300,7 +569,7 @@ class TwistedReceiver:
     @inlineCallbacks
     def _close_transit(self, record_pipe, datahash):
         datahash_hex = bytes_to_hexstr(datahash)
-        ack = {u"ack": u"ok", u"sha256": datahash_hex}
+        ack = {u"ack": u"ok", self._hash_name: datahash_hex}
         ack_bytes = dict_to_bytes(ack)
         with self.args.timing.add("send ack"):
             yield record_pipe.send_record(ack_bytes)
@@ -1,16 +1,23 @@
 from __future__ import print_function
-import os, sys, six, tempfile, zipfile, hashlib
+import os, sys, six, tempfile, zipfile
 from tqdm import tqdm
 from twisted.python import log
-from twisted.protocols import basic
-from twisted.internet import reactor
+from twisted.internet import reactor, error
 from twisted.internet.defer import inlineCallbacks, returnValue
 from ..errors import TransferError, WormholeClosedError
 from ..wormhole import wormhole
-from ..transit import TransitSender
+from ..route_cache import RouteCache
+from ..hashing import (preferred_hashes, new_hash, background_hasher,
+                       DEFAULT_HASH)
+from ..delta import (DeltaReader, parse_signatures, SIGNATURE,
+                     MIN_BLOCK_SIZE, MAX_BLOCK_SIZE)
+from ..transit import (TransitSender, FileProducer, MAX_STRIPES,
+                       connect_striped, TransitClosed, ConnectionHistory)
 from ..util import dict_to_bytes, bytes_to_dict, bytes_to_hexstr
 
 APPID = u"lothar.com/wormhole/text-or-file-xfer"
+# how many times we'll reconnect after losing the transit connection
+MAX_RESUMES = 5
 
 def send(args, reactor=reactor):
     """I implement 'wormhole send'. I return a Deferred that fires with None
@@ -30,7 +37,16 @@ class Sender:
         self._tor_manager = None
         self._timing = args.timing
         self._fd_to_send = None
+        self._hash_name = DEFAULT_HASH
         self._transit_sender = None
+        self._stripe_senders = []
+        self._striped = False
+        # shared by every Transit we make (stripes, resumes), so each one
+        # tries first what worked for the others
+        self._history = ConnectionHistory()
+        self._route_cache = None
+        if args.route_cache:
+            self._route_cache = RouteCache(args.route_cache)
 
     @inlineCallbacks
     def go(self):
@@ -99,11 +115,7 @@ class Sender:
                     raise TransferError(err)
 
         if self._fd_to_send:
-            ts = TransitSender(args.transit_helper,
-                               no_listen=args.no_listen,
-                               tor_manager=self._tor_manager,
-                               reactor=self._reactor,
-                               timing=self._timing)
+            ts = self._make_transit_sender()
             self._transit_sender = ts
 
             # for now, send this before the main offer
@@ -112,12 +124,20 @@ class Sender:
             sender_transit = {"abilities-v1": sender_abilities,
                               "hints-v1": sender_hints,
                               }
+            stripes = min(args.stripes, MAX_STRIPES)
+            if stripes > 1:
+                sender_transit["stripes-v1"] = yield self._build_stripes(
+                    stripes-1)
             self._send_data({u"transit": sender_transit}, w)
 
             # TODO: move this down below w.get()
             transit_key = w.derive_key(APPID+"/transit-key",
                                        ts.TRANSIT_KEY_LENGTH)
             ts.set_transit_key(transit_key)
+            for i, stripe in enumerate(self._stripe_senders, 1):
+                stripe_key = w.derive_key(APPID+"/transit-key/stripe-%d" % i,
+                                          stripe.TRANSIT_KEY_LENGTH)
+                stripe.set_transit_key(stripe_key)
 
         self._send_data({"offer": offer}, w)
 
@@ -145,15 +165,50 @@ class Sender:
                 recognized = True
                 if not want_answer:
                     raise TransferError("duplicate answer")
-                yield self._handle_answer(them_d[u"answer"])
+                yield self._handle_answer(them_d[u"answer"], w)
                 done = True
                 returnValue(None)
             if not recognized:
                 log.msg("unrecognized message %r" % (them_d,))
 
+    def _make_transit_sender(self):
+        return TransitSender(self._args.transit_helper,
+                             no_listen=self._args.no_listen,
+                             tor_manager=self._tor_manager,
+                             reactor=self._reactor,
+                             timing=self._timing,
+                             crypto_threads=self._args.crypto_threads,
+                             compress_level=self._args.compress,
+                             route_cache=self._route_cache,
+                             udp=self._args.udp,
+                             unix_socket_dir=self._args.unix_socket_dir,
+                             history=self._history)
+
+    @inlineCallbacks
+    def _build_stripes(self, count):
+        # each extra stripe is a complete Transit of its own
+        stripes = []
+        for i in range(count):
+            ts = self._make_transit_sender()
+            self._stripe_senders.append(ts)
+            hints = yield ts.get_connection_hints()
+            stripes.append({u"hints-v1": hints})
+        returnValue(stripes)
+
     def _handle_transit(self, receiver_transit):
         ts = self._transit_sender
+        ts.add_connection_abilities(receiver_transit.get("abilities-v1", []))
         ts.add_connection_hints(receiver_transit.get("hints-v1", []))
+        # the receiver answers each stripe it is willing to use. Older ones
+        # don't know about striping, and won't answer at all.
+        their_stripes = receiver_transit.get("stripes-v1", [])
+        self._striped = bool(self._stripe_senders
+                             and "stripes-v1" in receiver_transit)
+        for stripe in self._stripe_senders[len(their_stripes):]:
+            stripe._stop_listening()
+        del self._stripe_senders[len(their_stripes):]
+        for stripe, hints in zip(self._stripe_senders, their_stripes):
+            stripe.add_connection_hints(hints.get("hints-v1", []))
 
     def _build_offer(self):
         offer = {}
@@ -186,6 +241,11 @@ class Sender:
             offer["file"] = {
                 "filename": basename,
                 "filesize": filesize,
+                # we can pick up where an earlier attempt left off
+                "resume-v1": True,
+                "hashes-v1": preferred_hashes(),
+                # or just the changes, if they have an older copy
+                "delta-v1": True,
                 }
             print(u"Sending %d byte file named '%s'" % (filesize, basename),
                   file=args.stdout)
@@ -222,6 +282,8 @@ class Sender:
                 "zipsize": filesize,
                 "numbytes": num_bytes,
                 "numfiles": num_files,
+                "resume-v1": True,
+                "hashes-v1": preferred_hashes(),
                 }
             print(u"Sending directory (%d bytes compressed) named '%s'"
                   % (filesize, basename), file=args.stdout)
@@ -230,7 +292,7 @@ class Sender:
         raise TypeError("'%s' is neither file nor directory" % args.what)
 
     @inlineCallbacks
-    def _handle_answer(self, them_answer):
+    def _handle_answer(self, them_answer, w):
         if self._fd_to_send is None:
             if them_answer["message_ack"] == "ok":
                 print(u"text message sent", file=self._args.stdout)
@@ -240,38 +302,192 @@ class Sender:
         if them_answer.get("file_ack") != "ok":
             raise TransferError("ambiguous response from remote, "
                                 "transfer abandoned: %s" % (them_answer,))
+        self._hash_name = them_answer.get("hash-v1", DEFAULT_HASH)
+        if self._hash_name not in preferred_hashes():
+            raise TransferError("remote picked a hash we didn't offer: %r"
+                                % (self._hash_name,))
 
-        yield self._send_file()
+        delta_v1 = them_answer.get("delta-v1")
+        if delta_v1 is not None and not self._valid_delta(delta_v1):
+            raise TransferError("bad delta-v1 answer: %r" % (delta_v1,))
+
+        yield self._send_file(w, them_answer.get("resume-v1"), delta_v1)
+
+    def _valid_delta(self, delta_v1):
+        # the receiver has an older copy, and says how it cut it into blocks
+        block_size = delta_v1.get("block_size")
+        blocks = delta_v1.get("blocks")
+        return (isinstance(block_size, int)
+                and MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE
+                and isinstance(blocks, int) and blocks >= 0)
 
 
     @inlineCallbacks
-    def _send_file(self):
+    def _send_file(self, w, resume, delta_v1=None):
+        # 'resume' is None if the receiver doesn't know about resume-v1.
+        # Otherwise it says how much of the file they already have.
+        # 'delta_v1' is set if they have an older copy of it.
         ts = self._transit_sender
 
         self._fd_to_send.seek(0,2)
         filesize = self._fd_to_send.tell()
         self._fd_to_send.seek(0,0)
 
-        record_pipe = yield ts.connect()
+        if self._striped:
+            record_pipe = yield connect_striped([ts] + self._stripe_senders)
+        else:
+            record_pipe = yield ts.connect()
         self._timing.add("transit connected")
+        # peers which don't know about "record-size-v1" get the 16KiB
+        # records that FileSender used to produce
+        record_size = ts.get_record_size()
+
+        resumes = 0
+        while True:
+            offset, hasher = self._find_resume_point(resume, filesize)
+            try:
+                yield self._send_file_over(record_pipe, resume is not None,
+                                           offset, hasher, filesize,
+                                           record_size, delta_v1)
+                break
+            except (TransitClosed, error.ConnectionClosed):
+                if resume is None or resumes >= MAX_RESUMES:
+                    raise TransferError("Connection dropped before transfer "
+                                        "finished")
+            # the other stripes may still be up: hang them up before we
+            # build the new connection, or they'd stay open until we exit
+            record_pipe.close()
+            self._stripe_senders = []
+            self._striped = False
+            # a resumed connection sends the rest of the file in full
+            delta_v1 = None
+            resumes += 1
+            print(u"Connection dropped, waiting for the receiver to resume..",
+                  file=self._args.stdout)
+            resume, record_pipe, record_size = yield self._resume_transit(
+                w, resumes)
+
+    def _find_resume_point(self, resume, filesize):
+        # The receiver says it already has the first 'offset' bytes: check
+        # that against our own copy. Returns the offset to start sending
+        # from, and a hasher that has seen everything before it.
+        hasher = new_hash(self._hash_name)
+        offset = 0
+        claimed = (resume or {}).get("offset", 0)
+        if isinstance(claimed, int) and 0 < claimed <= filesize:
+            self._fd_to_send.seek(0)
+            remaining = claimed
+            while remaining:
+                chunk = self._fd_to_send.read(min(remaining, 2**20))
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                remaining -= len(chunk)
+            if (not remaining
+                and hasher.hexdigest() == resume.get(self._hash_name)):
+                offset = claimed
+            else:
+                hasher = new_hash(self._hash_name)
+        self._fd_to_send.seek(offset)
+        return offset, hasher
+
+    @inlineCallbacks
+    def _resume_transit(self, w, resumes):
+        # the receiver builds a new Transit, and sends its hints along with
+        # the resume request. We answer with ours, and both sides connect.
+        them_d = bytes_to_dict((yield w.get()))
+        if u"error" in them_d:
+            raise TransferError("remote error, transfer abandoned: %s"
+                                % them_d["error"])
+        if u"resume-v1" not in them_d:
+            raise TransferError("unexpected message while waiting to "
+                                "resume: %r" % (them_d,))
+        resume = them_d[u"resume-v1"]
+        receiver_transit = resume.get(u"transit", {})
+
+        ts = self._make_transit_sender()
+        ts.add_connection_abilities(receiver_transit.get("abilities-v1", []))
+        ts.add_connection_hints(receiver_transit.get("hints-v1", []))
+        transit_key = w.derive_key(APPID+"/transit-key/resume-%d" % resumes,
+                                   ts.TRANSIT_KEY_LENGTH)
+        ts.set_transit_key(transit_key)
+        sender_hints = yield ts.get_connection_hints()
+        self._send_data({u"transit": {"abilities-v1":
+                                      ts.get_connection_abilities(),
+                                      "hints-v1": sender_hints,
+                                      }}, w)
+        self._transit_sender = ts
+        record_pipe = yield ts.connect()
+        self._timing.add("transit connected", resume=resumes)
+        returnValue((resume, record_pipe, ts.get_record_size()))
+
+    @inlineCallbacks
+    def _receive_signatures(self, record_pipe, delta_v1):
+        wanted = delta_v1["blocks"] * SIGNATURE.size
+        records = []
+        received = 0
+        while received < wanted:
+            record = yield record_pipe.receive_record()
+            records.append(record)
+            received += len(record)
+        if received != wanted:
+            raise TransferError("receiver sent %d bytes of block signatures,"
+                                " not %d" % (received, wanted))
+        returnValue(parse_signatures(b"".join(records)))
+
+    @inlineCallbacks
+    def _send_file_over(self, record_pipe, send_header, offset, hasher,
+                        filesize, record_size, delta_v1=None):
         # record_pipe should implement IConsumer, chunks are just records
         stdout = self._args.stdout
-        print(u"Sending (%s).." % record_pipe.describe(), file=stdout)
+        if delta_v1 is None:
+            print(u"Sending (%s).." % record_pipe.describe(), file=stdout)
+        else:
+            print(u"Sending changes (%s).." % record_pipe.describe(),
+                  file=stdout)
+        if send_header:
+            # tell the receiver where this connection's data starts
+            record_pipe.send_record(dict_to_bytes({u"offset": offset}))
+        if delta_v1 is not None:
+            signatures = yield self._receive_signatures(record_pipe, delta_v1)
 
-        hasher = hashlib.sha256()
         progress = tqdm(file=stdout, disable=self._args.hide_progress,
                         unit="B", unit_scale=True,
                         total=filesize)
+        progress.update(offset)
+        # the hashing happens in another thread (if there's a spare CPU),
+        # alongside the encryption
+        bg_hasher = background_hasher(self._reactor, hasher)
         def _count_and_hash(data):
-            hasher.update(data)
+            bg_hasher.update(data)
             progress.update(len(data))
             return data
-        fs = basic.FileSender()
-
-        with self._timing.add("tx file"):
-            with progress:
-                yield fs.beginFileTransfer(self._fd_to_send, record_pipe,
-                                           transform=_count_and_hash)
+        source, transform = self._fd_to_send, _count_and_hash
+        if delta_v1 is not None:
+            # the DeltaReader hashes the file itself, and counts the bytes
+            # each record stands for rather than its size. Its searching
+            # happens in a thread, off the reactor.
+            source = DeltaReader(self._fd_to_send, delta_v1["block_size"],
+                                 signatures, record_size,
+                                 hasher=bg_hasher.update,
+                                 progress=progress.update,
+                                 reactor=self._reactor)
+            transform = None
+        fs = FileProducer(record_size)
+
+        try:
+            with self._timing.add("tx file", record_size=record_size,
+                                  offset=offset, hash=self._hash_name,
+                                  delta=delta_v1 is not None) as t:
+                with progress:
+                    yield fs.beginFileTransfer(source, record_pipe,
+                                               transform=transform)
+                t.detail(**record_pipe.get_stats())
+                if delta_v1 is not None:
+                    t.detail(delta_copied=source.copied,
+                             delta_literal=source.literal)
+        finally:
+            yield bg_hasher.finish()
 
         expected_hash = hasher.digest()
         expected_hex = bytes_to_hexstr(expected_hash)
@@ -284,8 +500,8 @@ class Sender:
             if ok != u"ok":
                 t.detail(ack="failed")
                 raise TransferError("Transfer failed (remote says: %r)" % ack)
-            if u"sha256" in ack:
-                if ack[u"sha256"] != expected_hex:
+            if self._hash_name in ack:
+                if ack[self._hash_name] != expected_hex:
                     t.detail(datahash="failed")
                     raise TransferError("Transfer failed (bad remote hash)")
             print(u"Confirmation received. Transfer complete.", file=stdout)
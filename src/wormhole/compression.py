@@ -0,0 +1,114 @@
+from __future__ import absolute_import
+import zlib
+
+# Transit records can be compressed one at a time. Each side advertises
+# "compress-v1" in its abilities, and once both have, every record in both
+# directions starts with a flag byte: RAW means the rest of the record is the
+# data itself, ZLIB means it is the data compressed with zlib. The sender
+# decides record by record, so a receiver only has to follow the flags, and
+# a sender that doesn't want to compress just sends everything RAW.
+#
+# Compressing data that is already compressed (or encrypted, or random) burns
+# CPU for nothing, so a RecordCompressor keeps an eye on how well it is
+# doing. It measures what zlib actually achieves over each SAMPLE_SIZE bytes,
+# which is a better guide than counting byte frequencies: it notices repeated
+# blocks, and it isn't fooled by base64. If the savings drop below
+# MIN_SAVING it stops compressing, but tries one record in every
+# PROBE_INTERVAL in case the data has changed (think of a tarball with both
+# logs and JPEGs in it).
+
+RAW = b"\x00"
+ZLIB = b"\x01"
+# headers, acks, and other small records aren't worth trying
+MIN_SIZE = 512
+SAMPLE_SIZE = 2**20
+MIN_SAVING = 0.1
+PROBE_INTERVAL = 64
+# No legitimate record is anywhere near this big. Stopping here keeps a
+# small malicious record from inflating into gigabytes.
+MAX_RECORD_SIZE = 2**20
+
+class CompressionError(Exception):
+    pass
+
+class RecordCompressor:
+    def __init__(self, level):
+        self._level = level
+        self._enabled = True
+        self._sample_in = 0
+        self._sample_out = 0
+        self._since_probe = 0
+        self.records_compressed = 0
+        self.bytes_saved = 0
+
+    def compress(self, record):
+        """Return 'record' with a flag byte in front, compressed if that
+        makes it smaller. With a level of None, nothing is compressed."""
+        if self._level is None or len(record) < MIN_SIZE:
+            return RAW + record
+        if not self._enabled:
+            self._since_probe += 1
+            if self._since_probe < PROBE_INTERVAL:
+                return RAW + record
+            self._since_probe = 0
+        compressed = zlib.compress(record, self._level)
+        self._measure(len(record), min(len(compressed), len(record)))
+        if len(compressed) >= len(record):
+            return RAW + record
+        self.records_compressed += 1
+        self.bytes_saved += len(record) - len(compressed)
+        return ZLIB + compressed
+
+    def _worth_it(self, size_in, size_out):
+        return size_out <= size_in * (1 - MIN_SAVING)
+
+    def _measure(self, size_in, size_out):
+        if not self._enabled:
+            # a probe: one good record is enough to start sampling again
+            self._enabled = self._worth_it(size_in, size_out)
+            return
+        self._sample_in += size_in
+        self._sample_out += size_out
+        if self._sample_in >= SAMPLE_SIZE:
+            self._enabled = self._worth_it(self._sample_in, self._sample_out)
+            self._sample_in = self._sample_out = 0
+
+    def get_stats(self):
+        return {"records_compressed": self.records_compressed,
+                "compression_saved": self.bytes_saved,
+                }
+
+def decompress_record(data):
+    """Undo RecordCompressor.compress(). Raises CompressionError if the flag
+    is unknown, the data is corrupt or truncated, or it inflates past
+    MAX_RECORD_SIZE."""
+    flag, body = data[:1], data[1:]
+    if flag == RAW:
+        return body
+    if flag != ZLIB:
+        raise CompressionError("unknown record flag %r" % (flag,))
+    d = zlib.decompressobj()
+    try:
+        record = d.decompress(body, MAX_RECORD_SIZE)
+    except zlib.error as e:
+        raise CompressionError("corrupt compressed record: %s" % (e,))
+    if d.unconsumed_tail:
+        raise CompressionError("compressed record is too large")
+    if d.unused_data:
+        raise CompressionError("junk after compressed record")
+    if not _complete(d, body):
+        raise CompressionError("truncated compressed record")
+    return record
+
+def _complete(d, body):
+    # did 'd' see the end of the zlib stream?
+    if hasattr(d, "eof"):
+        return d.eof
+    # py2's decompressobj can't say, but zlib.decompress() complains about a
+    # truncated stream. We've just inflated all of 'body' within
+    # MAX_RECORD_SIZE, so doing it again costs no more than that.
+    try:
+        zlib.decompress(body)
+    except zlib.error:
+        return False
+    return True
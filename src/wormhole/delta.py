@@ -0,0 +1,249 @@
+from __future__ import absolute_import
+import zlib, struct, hashlib, bisect
+from twisted.internet import threads
+
+# Delta transfers, after rsync. When 'wormhole receive --delta' already has
+# an older copy of the file, it cuts that copy into blocks and sends the
+# sender a signature of each one: a weak checksum (Adler-32) and a strong
+# one (the first 16 bytes of its SHA-256). The sender slides a block-sized
+# window over the new file, one byte at a time. Adler-32 can be updated in
+# constant time as the window moves, so only windows whose weak checksum
+# matches get the strong hash. The sender then sends a sequence of delta
+# records. Each is either "copy these blocks from your old copy" or "here
+# are some new bytes", and the receiver builds the new file from them.
+#
+# Sliding the window happens in Python, so it runs at a few MB/s. That's
+# fine when most of the file matches, because matched blocks are skipped
+# in one step. A file that has nothing in common with the old copy would
+# crawl, though. So after SEARCH_LIMIT bytes without a match, the sender
+# only tries whole-block steps until something matches again. Even so, one
+# record can take tens of milliseconds, so given a reactor, DeltaReader does
+# the searching in the reactor's thread pool.
+
+MIN_BLOCK_SIZE = 2**10
+MAX_BLOCK_SIZE = 2**16
+SIGNATURE = struct.Struct(">I16s") # weak, strong
+COPY = struct.Struct(">cQI") # b"C", first block, number of blocks
+LITERAL = b"L"
+READ_SIZE = 2**20
+SEARCH_LIMIT = 2**22
+# cut copy runs at this many bytes, so one read() never scans for too long
+MAX_COPY_SIZE = 2**24
+_ADLER_MOD = 65521
+
+class DeltaError(Exception):
+    pass
+
+def block_size_for(size):
+    """Pick a block size for a file of 'size' bytes: about its square root,
+    like rsync, rounded up to a power of two."""
+    block_size = MIN_BLOCK_SIZE
+    while block_size < MAX_BLOCK_SIZE and block_size * block_size < size:
+        block_size *= 2
+    return block_size
+
+def weak_sum(data):
+    return zlib.adler32(data) & 0xffffffff
+
+def strong_sum(data):
+    return hashlib.sha256(data).digest()[:16]
+
+def signatures(f, block_size):
+    """Return the packed signatures of every whole block in 'f'. This only
+    reads 'f', so it can run in a thread."""
+    f.seek(0)
+    sigs = []
+    while True:
+        block = f.read(block_size)
+        if len(block) < block_size:
+            break
+        sigs.append(SIGNATURE.pack(weak_sum(block), strong_sum(block)))
+    return b"".join(sigs)
+
+def parse_signatures(data):
+    """Turn packed signatures into {weak: {strong: [block indexes]}}."""
+    if len(data) % SIGNATURE.size:
+        raise DeltaError("truncated block signatures")
+    sigs = {}
+    for index in range(len(data) // SIGNATURE.size):
+        weak, strong = SIGNATURE.unpack_from(data, index * SIGNATURE.size)
+        sigs.setdefault(weak, {}).setdefault(strong, []).append(index)
+    return sigs
+
+class DeltaReader:
+    """I look like a file to FileProducer, but each read() returns the next
+    delta record (of at most 'record_size' bytes) instead of the file's
+    contents. 'hasher' is called with the new file's bytes as they are
+    read, and 'progress' with how many of them each record covers.
+
+    With a 'reactor', read() returns a Deferred instead, and each record is
+    found in the reactor's thread pool. 'hasher' and 'progress' are still
+    called from the reactor thread, just before the Deferred fires."""
+    def __init__(self, f, block_size, sigs, record_size, hasher=None,
+                 progress=None, reactor=None):
+        self._f = f
+        self._reactor = reactor
+        self._calls = None # hasher/progress calls made in the thread
+        self._block_size = block_size
+        self._sigs = sigs
+        self._max_literal = record_size - len(LITERAL)
+        self._hasher = hasher
+        self._progress = progress
+        self._records = self._generate()
+        self.copied = 0
+        self.literal = 0
+
+    def read(self, size=None):
+        if self._reactor is None:
+            return self._next_record()
+        self._calls = calls = []
+        d = threads.deferToThreadPool(self._reactor,
+                                      self._reactor.getThreadPool(),
+                                      self._next_record)
+        def _done(record):
+            self._calls = None
+            for (f, arg) in calls:
+                f(arg)
+            return record
+        d.addCallback(_done)
+        return d
+
+    def _next_record(self):
+        for record in self._records:
+            return record
+        return b""
+
+    def _report(self, f, arg):
+        if self._calls is not None:
+            self._calls.append((f, arg)) # replayed in the reactor thread
+        else:
+            f(arg)
+
+    def _match(self, candidates, window, expected):
+        indexes = candidates.get(strong_sum(window))
+        if not indexes:
+            return None
+        # prefer the block that continues the current run
+        i = bisect.bisect_left(indexes, expected)
+        if i < len(indexes) and indexes[i] == expected:
+            return expected
+        return indexes[0]
+
+    def _copy(self, first, count):
+        self.copied += count * self._block_size
+        if self._progress:
+            self._report(self._progress, count * self._block_size)
+        return COPY.pack(b"C", first, count)
+
+    def _literal(self, data):
+        self.literal += len(data)
+        if self._progress:
+            self._report(self._progress, len(data))
+        return LITERAL + bytes(data)
+
+    def _generate(self):
+        B = self._block_size
+        sigs = self._sigs
+        max_run = max(1, MAX_COPY_SIZE // B)
+        buf = bytearray()
+        # the window is buf[pos:pos+B], unmatched bytes are buf[start:pos]
+        pos = start = 0
+        eof = False
+        a = b = None # the window's Adler-32, in two halves
+        run_first = run_count = 0
+        searched = 0
+        while True:
+            if not eof and len(buf) - pos <= B:
+                chunk = self._f.read(READ_SIZE)
+                if not chunk:
+                    eof = True
+                elif self._hasher:
+                    self._report(self._hasher, chunk)
+                del buf[:start]
+                pos -= start
+                start = 0
+                buf += chunk
+                continue
+            if len(buf) - pos < B:
+                break
+            if a is None:
+                weak = weak_sum(bytes(buf[pos:pos+B]))
+                a, b = weak & 0xffff, weak >> 16
+            index = None
+            candidates = sigs.get((b << 16) | a)
+            if candidates:
+                index = self._match(candidates, bytes(buf[pos:pos+B]),
+                                    run_first + run_count)
+            if index is not None:
+                if pos > start:
+                    if run_count:
+                        yield self._copy(run_first, run_count)
+                        run_count = 0
+                    yield self._literal(buf[start:pos])
+                if (run_count and index == run_first + run_count
+                    and run_count < max_run):
+                    run_count += 1
+                else:
+                    if run_count:
+                        yield self._copy(run_first, run_count)
+                    run_first, run_count = index, 1
+                pos += B
+                start = pos
+                a = None
+                searched = 0
+                continue
+            if pos + B == len(buf):
+                break # at EOF, and the last window didn't match
+            if searched >= SEARCH_LIMIT:
+                pos += B
+                a = None
+            else:
+                out, new = buf[pos], buf[pos+B]
+                a = (a - out + new) % _ADLER_MOD
+                b = (b - B*out + a - 1) % _ADLER_MOD
+                pos += 1
+                searched += 1
+            while pos - start >= self._max_literal:
+                if run_count:
+                    yield self._copy(run_first, run_count)
+                    run_count = 0
+                yield self._literal(buf[start:start+self._max_literal])
+                start += self._max_literal
+        if run_count:
+            yield self._copy(run_first, run_count)
+        for i in range(start, len(buf), self._max_literal):
+            yield self._literal(buf[i:min(i+self._max_literal, len(buf))])
+
+class DeltaApplier:
+    """I turn delta records back into the new file's contents, reading
+    copied blocks from 'basis' (the old copy)."""
+    def __init__(self, basis, block_size, blocks):
+        self._basis = basis
+        self._block_size = block_size
+        self._blocks = blocks
+        self.copied = 0
+        self.literal = 0
+
+    def apply(self, record):
+        """Return a list of the chunks that 'record' stands for."""
+        kind = record[:1]
+        if kind == LITERAL and len(record) > 1:
+            self.literal += len(record) - 1
+            return [record[1:]]
+        if kind != b"C" or len(record) != COPY.size:
+            raise DeltaError("bad delta record")
+        _, first, count = COPY.unpack(record)
+        if not count or first + count > self._blocks:
+            raise DeltaError("delta record copies blocks %d..%d of %d"
+                             % (first, first + count, self._blocks))
+        self._basis.seek(first * self._block_size)
+        remaining = count * self._block_size
+        chunks = []
+        while remaining:
+            chunk = self._basis.read(min(remaining, READ_SIZE))
+            if not chunk:
+                raise DeltaError("old copy changed during the transfer")
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        self.copied += count * self._block_size
+        return chunks
@@ -0,0 +1,63 @@
+# Reserve disk space for a file we're about to receive, so a full disk is
+# noticed before the transfer starts instead of halfway through it, and the
+# filesystem can lay the file out in one piece instead of extending it on
+# every write.
+
+import os, errno, ctypes
+from sys import platform
+
+FALLOC_FL_KEEP_SIZE = 0x01 # from linux/falloc.h
+
+_fallocate = None
+
+def reserve_space(f, size):
+    """Make sure the file 'f' has room to grow from its current position to
+    'size' bytes. Raises EnvironmentError(ENOSPC) if it doesn't. On linux the
+    blocks are allocated up front with fallocate(2), keeping the apparent
+    size unchanged, so a partial file still shows how much was received.
+    Elsewhere we can only compare against the free space from statvfs()."""
+    offset = f.tell()
+    if size <= offset:
+        return
+    fd = f.fileno()
+    if platform.startswith("linux"):
+        try:
+            _allocate(fd, offset, size - offset)
+            return
+        except EnvironmentError as e:
+            if e.errno == errno.ENOSPC:
+                _release(fd, size)
+                raise
+            # e.g. EOPNOTSUPP: this filesystem can't, so just check
+        except AttributeError:
+            pass # no fallocate() in this libc
+    _check_free_space(fd, size - offset)
+
+def _allocate(fd, offset, length):
+    global _fallocate
+    if _fallocate is None:
+        libc = ctypes.CDLL(None, use_errno=True)
+        # fallocate64 takes a 64-bit off_t even on 32-bit platforms
+        f = getattr(libc, "fallocate64", None) or libc.fallocate
+        f.argtypes = [ctypes.c_int, ctypes.c_int,
+                      ctypes.c_int64, ctypes.c_int64]
+        _fallocate = f
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        e = ctypes.get_errno()
+        raise EnvironmentError(e, os.strerror(e))
+
+def _release(fd, size):
+    # Give back whatever fallocate() managed to reserve past EOF. Truncating
+    # to the current size is a no-op that leaves those blocks allocated, so
+    # grow the file over the whole range (which allocates nothing), then
+    # shrink it back: that frees every block past the old EOF.
+    eof = os.fstat(fd).st_size
+    os.ftruncate(fd, size)
+    os.ftruncate(fd, eof)
+
+def _check_free_space(fd, needed):
+    if not hasattr(os, "fstatvfs"):
+        return # windows: just hope for the best
+    st = os.fstatvfs(fd)
+    if st.f_bavail * st.f_frsize < needed:
+        raise EnvironmentError(errno.ENOSPC, os.strerror(errno.ENOSPC))
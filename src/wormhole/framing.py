@@ -0,0 +1,46 @@
+from __future__ import absolute_import
+import struct
+from binascii import hexlify, unhexlify
+
+# Each transit record goes over the wire as a 4-byte big-endian length,
+# followed by that many bytes of SecretBox output. SecretBox puts the 24-byte
+# nonce at the front, and we use a big-endian record counter for the nonce.
+# These codecs are called once or twice for every record, so they use
+# precompiled struct objects instead of hex-string formatting.
+
+LENGTH_SIZE = 4
+NONCE_SIZE = 24
+# striped transfers put a sequence number in front of each (plaintext) record
+SEQNUM_SIZE = 8
+
+_length = struct.Struct(">L")
+# Counters fit in the low 8 bytes for any transfer we'll ever see, so the
+# common case packs 16 zero bytes and a 64-bit integer.
+_nonce = struct.Struct(">16xQ")
+_low_nonce = struct.Struct(">Q")
+_seqnum = struct.Struct(">Q")
+_HIGH_NONCE_ZEROS = b"\x00" * 16
+_SHORT_NONCE_LIMIT = 2**64
+
+def encode_length(length):
+    return _length.pack(length)
+
+def decode_length(buf, offset=0):
+    return _length.unpack_from(buf, offset)[0]
+
+def encode_nonce(counter):
+    if counter < _SHORT_NONCE_LIMIT:
+        return _nonce.pack(counter)
+    return unhexlify("%048x" % counter)
+
+def decode_nonce(buf):
+    # 'buf' is a SecretBox ciphertext, with the nonce prepended
+    if buf[:16] == _HIGH_NONCE_ZEROS:
+        return _low_nonce.unpack_from(buf, 16)[0]
+    return int(hexlify(buf[:NONCE_SIZE]), 16)
+
+def encode_seqnum(seqnum):
+    return _seqnum.pack(seqnum)
+
+def decode_seqnum(buf):
+    return _seqnum.unpack_from(buf)[0]
@@ -0,0 +1,107 @@
+from __future__ import absolute_import
+import os, hashlib, threading
+from six.moves import queue
+from twisted.internet import defer
+from twisted.python import failure
+
+# A file transfer ends with the receiver sending back a hash of everything it
+# got. That used to always be SHA-256. Now the sender offers the hashes it
+# has ("hashes-v1" in the offer, fastest first), and the receiver answers
+# with the first one it also has ("hash-v1"). Peers that don't know about
+# this keep using SHA-256. BLAKE2b is faster on most CPUs (SHA-256 only wins
+# where there are SHA instructions), so we prefer it. The order is fixed, so
+# the same two hosts always agree on the same hash.
+
+DEFAULT_HASH = u"sha256"
+_CANDIDATES = [u"blake2b", u"sha256"] # most preferred first
+_preferred = None # set this to override the order, e.g. in tests
+
+def preferred_hashes():
+    """Return the names of the hashes we can do, most preferred first."""
+    if _preferred is not None:
+        return _preferred
+    # py2 has no blake2b
+    return [name for name in _CANDIDATES if hasattr(hashlib, name)]
+
+def choose_hash(offered):
+    """Pick the first of the peer's 'offered' hashes that we also have."""
+    for name in offered or []:
+        if name in _CANDIDATES and hasattr(hashlib, name):
+            return name
+    return DEFAULT_HASH
+
+def new_hash(name):
+    return getattr(hashlib, name)()
+
+# hashlib releases the GIL for large updates, so a ThreadedHasher lets the
+# hashing overlap with the reactor's encryption and I/O. The queue is bounded:
+# if the worker falls HASH_QUEUE_SIZE chunks behind, update() waits for it,
+# which is no worse than hashing inline. It checks every HASH_WAIT seconds
+# that the worker is still there, so the reactor can't hang on a dead one. If
+# the hash itself fails, update() and finish() pass the error on. With only
+# one CPU the handoff is pure overhead (about 10%), so background_hasher()
+# hashes inline there.
+
+HASH_QUEUE_SIZE = 64
+HASH_WAIT = 0.1
+
+def background_hasher(reactor, hasher):
+    cpus = getattr(os, "cpu_count", lambda: None)() or 1
+    if cpus > 1:
+        return ThreadedHasher(reactor, hasher)
+    return InlineHasher(hasher)
+
+class InlineHasher:
+    # same API as ThreadedHasher
+    def __init__(self, hasher):
+        self._hasher = hasher
+        self.update = hasher.update
+    def finish(self):
+        return defer.succeed(self._hasher)
+
+class ThreadedHasher:
+    def __init__(self, reactor, hasher):
+        self._reactor = reactor
+        self._hasher = hasher
+        self._queue = queue.Queue(HASH_QUEUE_SIZE)
+        self._failure = None # set by the worker if the hash fails
+        self._thread = threading.Thread(target=self._run,
+                                        name="wormhole-hasher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        # runs in the worker thread. After a failure we keep draining the
+        # queue, so update() never waits on us, until finish() asks
+        while True:
+            data, d = self._queue.get()
+            if d is not None:
+                if self._failure is not None:
+                    self._reactor.callFromThread(d.errback, self._failure)
+                else:
+                    self._reactor.callFromThread(d.callback, self._hasher)
+                return
+            if self._failure is None:
+                try:
+                    self._hasher.update(data)
+                except Exception:
+                    self._failure = failure.Failure()
+
+    def update(self, data):
+        while True:
+            if self._failure is not None:
+                self._failure.raiseException()
+            try:
+                self._queue.put((data, None), timeout=HASH_WAIT)
+                return
+            except queue.Full:
+                if not self._thread.is_alive():
+                    raise RuntimeError("the hasher thread has stopped")
+
+    def finish(self):
+        """Stop the worker once it has hashed everything given to update().
+        Returns a Deferred that fires with the hash object, which the caller
+        may then use directly."""
+        d = defer.Deferred()
+        self._queue.put((None, d))
+        return d
@@ -1,9 +1,105 @@
 
 # Find all of our ip addresses. From tahoe's src/allmydata/util/iputil.py
 
-import os, re, subprocess, errno
+import os, re, subprocess, errno, socket, time
+import ctypes
 from sys import platform
 
+# Results are cached for this long, since they are needed for every transfer
+# but rarely change.
+CACHE_TTL = 30 # seconds
+_cache = None # (expiration time, [(family, address)..])
+
+def find_addresses(ipv6=False, now=time.time):
+    """Return a list of our IP addresses (as strings): IPv4 only, unless
+    'ipv6' is True. This asks the kernel directly via getifaddrs(3) where
+    possible, and falls back to running ifconfig/ip/route.exe."""
+    global _cache
+    t = now()
+    if _cache is None or t >= _cache[0]:
+        try:
+            addresses = _native_addresses()
+        except Exception:
+            addresses = []
+        if not addresses:
+            addresses = [(socket.AF_INET, a) for a in _tool_addresses()]
+        _cache = (t + CACHE_TTL, addresses)
+    families = (socket.AF_INET, socket.AF_INET6) if ipv6 else (socket.AF_INET,)
+    return [address for (family, address) in _cache[1] if family in families]
+
+# getifaddrs(3) is available on linux, the BSDs, and OS-X, but not windows.
+# The BSDs put a length byte at the start of each sockaddr.
+if platform.startswith(("darwin", "freebsd", "openbsd", "netbsd")):
+    _sa_header = [("sa_len", ctypes.c_uint8), ("sa_family", ctypes.c_uint8)]
+else:
+    _sa_header = [("sa_family", ctypes.c_uint16)]
+
+class _sockaddr(ctypes.Structure):
+    _fields_ = _sa_header + [("sa_data", ctypes.c_uint8 * 14)]
+
+class _sockaddr_in(ctypes.Structure):
+    _fields_ = _sa_header + [("sin_port", ctypes.c_uint16),
+                             ("sin_addr", ctypes.c_uint8 * 4),
+                             ("sin_zero", ctypes.c_uint8 * 8)]
+
+class _sockaddr_in6(ctypes.Structure):
+    _fields_ = _sa_header + [("sin6_port", ctypes.c_uint16),
+                             ("sin6_flowinfo", ctypes.c_uint32),
+                             ("sin6_addr", ctypes.c_uint8 * 16),
+                             ("sin6_scope_id", ctypes.c_uint32)]
+
+class _ifaddrs(ctypes.Structure):
+    pass
+_ifaddrs._fields_ = [("ifa_next", ctypes.POINTER(_ifaddrs)),
+                     ("ifa_name", ctypes.c_char_p),
+                     ("ifa_flags", ctypes.c_uint),
+                     ("ifa_addr", ctypes.POINTER(_sockaddr)),
+                     ("ifa_netmask", ctypes.POINTER(_sockaddr)),
+                     ("ifa_ifu", ctypes.POINTER(_sockaddr)),
+                     ("ifa_data", ctypes.c_void_p)]
+
+_libc = None
+
+def _native_addresses():
+    global _libc
+    if _libc is None:
+        # the symbols of the running process, which include libc's. This is
+        # much faster than ctypes.util.find_library("c"), which runs ldconfig
+        _libc = ctypes.CDLL(None, use_errno=True)
+    libc = _libc
+    ifap = ctypes.POINTER(_ifaddrs)()
+    if libc.getifaddrs(ctypes.byref(ifap)) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    addresses = []
+    try:
+        ifa = ifap
+        while ifa:
+            address = _parse_sockaddr(ifa.contents.ifa_addr)
+            if address and address not in addresses:
+                addresses.append(address)
+            ifa = ifa.contents.ifa_next
+    finally:
+        libc.freeifaddrs(ifap)
+    return addresses
+
+def _parse_sockaddr(sa):
+    # returns (family, address), or None for anything we can't use
+    if not sa:
+        return None
+    family = sa.contents.sa_family
+    if family == socket.AF_INET:
+        sin = ctypes.cast(sa, ctypes.POINTER(_sockaddr_in)).contents
+        raw = bytes(bytearray(sin.sin_addr))
+    elif family == socket.AF_INET6:
+        sin6 = ctypes.cast(sa, ctypes.POINTER(_sockaddr_in6)).contents
+        raw = bytes(bytearray(sin6.sin6_addr))
+        if raw[:2] == b"\xfe\x80":
+            return None # link-local addresses are useless without a scope
+    else:
+        return None
+    return (family, socket.inet_ntop(family, raw))
+
 # Wow, I'm really amazed at home much mileage we've gotten out of calling
 # the external route.exe program on windows...  It appears to work on all
 # versions so far.  Still, the real system calls would much be preferred...
@@ -22,7 +118,7 @@ _unix_commands = (('/bin/ip', ('addr',), _addr_re),
                  )
 
 
-def find_addresses():
+def _tool_addresses():
     # originally by Greg Smith, hacked by Zooko and then Daira
 
     # We don't reach here for cygwin.
@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+import os, json, time, hashlib, tempfile
+from twisted.python import log
+
+# An optional on-disk record of which route (direct hint or relay) worked the
+# last time we talked to a given peer, so repeat transfers between the same
+# two hosts can try it first. The peer is identified by a hash of the
+# hostnames in its hints: the ports are allocated afresh for each transfer,
+# so they are left out. The same file also remembers how long it took to
+# reach each transit relay, so the nearest one can be tried first.
+
+DEFAULT_MAX_AGE = 7*24*60*60 # seconds
+
+def hints_key(hint_objs):
+    names = sorted(set(u"%s:%s" % (type(h).__name__, h.hostname)
+                       for h in hint_objs))
+    return hashlib.sha256(u"\n".join(names).encode("utf-8")).hexdigest()
+
+class RouteCache:
+    def __init__(self, path, max_age=DEFAULT_MAX_AGE, now=time.time):
+        self._path = path
+        self._max_age = max_age
+        self._now = now
+        self._routes = self._load()
+
+    def _fresh(self, entry, now):
+        return (isinstance(entry, dict)
+                and now - entry.get(u"when", 0) < self._max_age)
+
+    def _load(self):
+        try:
+            with open(self._path, "r") as f:
+                routes = json.load(f)
+        except (EnvironmentError, ValueError):
+            return {}
+        if not isinstance(routes, dict):
+            return {}
+        now = self._now()
+        return dict((key, entry) for (key, entry) in routes.items()
+                    if self._fresh(entry, now))
+
+    def _save(self):
+        now = self._now()
+        routes = dict((key, entry) for (key, entry) in self._routes.items()
+                      if self._fresh(entry, now))
+        # a unique name, so two wormholes saving at once can't clobber
+        # each other's half-written file
+        tmp = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                    "w", dir=os.path.dirname(self._path) or ".",
+                    prefix=os.path.basename(self._path) + ".",
+                    suffix=".tmp", delete=False) as f:
+                tmp = f.name
+                json.dump(routes, f, indent=1, sort_keys=True)
+            # os.rename won't replace an existing file on windows
+            getattr(os, "replace", os.rename)(tmp, self._path)
+        except EnvironmentError:
+            log.err(None, "unable to write route cache %s" % self._path)
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def lookup(self, key):
+        """Return the route that worked last time for the peer with this
+        hints_key() (a dict with 'hostname', 'relay', and 'latency'), or None
+        if we don't have one or it has expired."""
+        entry = self._routes.get(key)
+        if entry is None or not self._fresh(entry, self._now()):
+            return None
+        return entry
+
+    def remember(self, key, hostname, relay, latency):
+        self._routes[key] = {u"hostname": hostname,
+                             u"relay": relay,
+                             u"latency": latency,
+                             u"when": self._now(),
+                             }
+        self._save()
+
+    def lookup_rtt(self, relay):
+        """Return the TCP connect time last measured for this relay (a
+        connector description), or None."""
+        entry = self.lookup(u"rtt:" + relay)
+        return entry and entry.get(u"rtt")
+
+    def remember_rtt(self, relay, rtt):
+        self._routes[u"rtt:" + relay] = {u"rtt": rtt, u"when": self._now()}
+        self._save()
@@ -0,0 +1,735 @@
+from __future__ import print_function, absolute_import
+import os, re, struct
+from collections import deque
+from zope.interface import implementer
+from twisted.python import failure
+from twisted.internet import interfaces, defer, protocol, address, error
+
+# A small reliable, ordered byte stream over UDP, for the "direct-udp-v1"
+# transit hint. On lossy long-haul links TCP's throughput collapses; this
+# recovers from loss with selective acknowledgements instead, and paces its
+# packets out rather than sending each window in one burst.
+#
+# Each side has one UDP socket (a UDPEndpoint), which carries any number of
+# sessions, told apart by a random 8-byte connection id. A session looks
+# like a TCP transport to the Protocol on top of it (a transit.Connection),
+# so the handshake and the encrypted records are exactly the same as they
+# are over TCP.
+#
+# Every packet starts with the connection id and a type byte:
+#
+#  SYN, SYNACK, PING, RST: nothing else
+#  DATA, FIN: 4-byte sequence number (one per packet), then the payload
+#  ACK: 4-byte cumulative ack (the next sequence number expected), 4-byte
+#       receive window (in packets, past the cumulative ack), 1-byte count
+#       of SACK blocks, then [start, end) pairs of 4-byte sequence numbers
+#
+# Loss is detected when packets sent after one have been acknowledged
+# (three packets' worth, like TCP's fast retransmit), or when nothing is
+# acknowledged for a retransmission timeout. Congestion control is NewReno:
+# slow start, then additive increase, and one halving per window of loss.
+
+SYN, SYNACK, DATA, FIN, ACK, PING, RST = range(1, 8)
+
+HEADER = struct.Struct(">8sB")
+SEQ = struct.Struct(">I")
+ACK_FIELDS = struct.Struct(">IIB")
+SACK_BLOCK = struct.Struct(">II")
+
+MSS = 1200 # payload bytes per packet: safe for most paths' MTU
+INITIAL_CWND = 10 # packets
+MIN_CWND = 2
+RECEIVE_WINDOW = 2048 # packets we will buffer for each session
+INITIAL_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = 10.0
+MAX_TIMEOUTS = 8 # consecutive silent timeouts before we give up
+SYN_RETRIES = 5
+DUPTHRESH = 3
+ACK_EVERY = 2 # acknowledge at least every second packet ..
+ACK_DELAY = 0.005 # .. or this long after the first unacknowledged one
+MAX_SACK_BLOCKS = 16
+# pace at this multiple of cwnd/srtt, so the window can still grow
+PACING_GAIN = 1.25
+SLOW_START_PACING_GAIN = 2.0
+PACING_BURST = 4 # packets that may go out back-to-back
+PACING_TICK = 0.001 # finer timers than this aren't worth having
+# pause our producer once this many bytes are waiting to be sent
+SEND_HIGH_WATER = 2**20
+SEND_LOW_WATER = 2**18
+
+class _Packet(object):
+    __slots__ = ["seq", "kind", "payload", "sent_at", "retransmitted",
+                 "in_flight", "sacked"]
+    def __init__(self, seq, kind, payload):
+        self.seq = seq
+        self.kind = kind
+        self.payload = payload
+        self.sent_at = None
+        self.retransmitted = False
+        self.in_flight = False
+        self.sacked = False
+
+def encode_ack(conn_id, cumulative, window, blocks):
+    blocks = blocks[:MAX_SACK_BLOCKS]
+    return b"".join([HEADER.pack(conn_id, ACK),
+                     ACK_FIELDS.pack(cumulative, window, len(blocks))]
+                    + [SACK_BLOCK.pack(start, end) for (start, end) in blocks])
+
+def decode_ack(packet):
+    """Return (cumulative, window, blocks) from an ACK packet, or raise
+    ValueError."""
+    offset = HEADER.size
+    if len(packet) < offset + ACK_FIELDS.size:
+        raise ValueError("short ACK")
+    cumulative, window, count = ACK_FIELDS.unpack_from(packet, offset)
+    offset += ACK_FIELDS.size
+    if len(packet) != offset + count * SACK_BLOCK.size:
+        raise ValueError("bad ACK length")
+    blocks = [SACK_BLOCK.unpack_from(packet, offset + i * SACK_BLOCK.size)
+              for i in range(count)]
+    return cumulative, window, blocks
+
+def sack_blocks(seqs):
+    """Turn the sorted sequence numbers we hold out of order into a list of
+    [start, end) ranges."""
+    blocks = []
+    for seq in seqs:
+        if blocks and blocks[-1][1] == seq:
+            blocks[-1][1] = seq + 1
+        else:
+            blocks.append([seq, seq + 1])
+    return [tuple(b) for b in blocks]
+
+
+@implementer(interfaces.ITransport, interfaces.IConsumer,
+             interfaces.IPushProducer)
+class Session:
+    """One reliable connection, carried by a UDPEndpoint. This is what the
+    Protocol sees as its transport."""
+    def __init__(self, endpoint, conn_id, addr, reactor):
+        self._endpoint = endpoint
+        self.conn_id = conn_id
+        self._addr = addr
+        self._reactor = reactor
+        self.protocol = None
+        self.state = "syn-sent"
+        self.disconnecting = False
+        # only used by the side that connects
+        self._connected_d = None
+        self._factory = None
+        self._syn_timer = None
+        self._syn_tries = 0
+        self._syn_sent_at = None
+        # sending
+        self._pending = deque() # memoryviews of bytes not yet packetized
+        self._pending_size = 0
+        self._fin_seq = None
+        self._next_seq = 0
+        self._snd_una = 0 # lowest sequence number not yet acknowledged
+        self._unacked = {} # seq -> _Packet
+        self._lost = deque() # seqs waiting to be retransmitted
+        self._in_flight = 0
+        self._highest_sacked = -1
+        self._latest_delivered_sent = 0 # when the newest acked packet went
+        self._peer_window = RECEIVE_WINDOW
+        self.cwnd = float(INITIAL_CWND)
+        self.ssthresh = float(2**31)
+        self._recovery_until = 0
+        self.srtt = None
+        self._rttvar = None
+        self.rto = INITIAL_RTO
+        self._timeouts = 0
+        self._tokens = PACING_BURST * MSS
+        self._tokens_at = None
+        self._rto_timer = None
+        self._pace_timer = None
+        # receiving
+        self._rcv_next = 0
+        self._out_of_order = {} # seq -> (kind, payload)
+        self._deliverable = [] # in-order payloads, held while we're paused
+        self._received_unacked = 0
+        self._ack_timer = None
+        self._paused = False
+        self._deliver_timer = None
+        # producer of outbound data
+        self._producer = None
+        self._streaming = False
+        self._producer_paused = False
+        self._pulling = False
+        # for get_stats()
+        self._packets_sent = 0
+        self._retransmits = 0
+        self._packets_received = 0
+        self._loss_events = 0
+
+    # ITransport
+
+    def write(self, data):
+        if self.state == "closed" or self.disconnecting or not data:
+            return
+        self._pending.append(memoryview(data))
+        self._pending_size += len(data)
+        self._pump()
+        if (self._producer and self._streaming and not self._producer_paused
+            and self._pending_size > SEND_HIGH_WATER):
+            self._producer_paused = True
+            self._producer.pauseProducing()
+
+    def writeSequence(self, data):
+        for d in data:
+            self.write(d)
+
+    def loseConnection(self):
+        if self.state == "closed" or self.disconnecting:
+            return
+        self.disconnecting = True
+        if self.state == "syn-sent":
+            self.abortConnection()
+            return
+        self._pump() # the FIN goes after everything already written
+
+    def abortConnection(self):
+        self._endpoint._send(HEADER.pack(self.conn_id, RST), self._addr)
+        self._teardown(error.ConnectionAborted())
+
+    def getPeer(self):
+        return address.IPv4Address("UDP", self._addr[0], self._addr[1])
+
+    def getHost(self):
+        return self._endpoint.getHost()
+
+    # IConsumer, for outbound flow control
+
+    def registerProducer(self, producer, streaming):
+        if self._producer is not None:
+            raise RuntimeError("Cannot register producer %s, because %s is"
+                               " already registered." % (producer,
+                                                        self._producer))
+        self._producer = producer
+        self._streaming = streaming
+        self._producer_paused = False
+        if not streaming:
+            self._wake_producer()
+
+    def unregisterProducer(self):
+        self._producer = None
+
+    def _wake_producer(self):
+        if self._producer is None or self._pending_size >= SEND_LOW_WATER:
+            return
+        if self._streaming:
+            if self._producer_paused:
+                self._producer_paused = False
+                self._producer.resumeProducing()
+        elif not self._pulling:
+            self._pulling = True
+            try:
+                self._producer.resumeProducing()
+            finally:
+                self._pulling = False
+
+    # IPushProducer, for inbound flow control
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        if not self._paused:
+            return
+        self._paused = False
+        # deliver on a later turn, like a TCP transport: our caller may be
+        # in the middle of handling what we delivered last time
+        if self._deliver_timer is None:
+            self._deliver_timer = self._reactor.callLater(0, self._resumed)
+
+    def _resumed(self):
+        self._deliver_timer = None
+        self._deliver()
+        if self.state == "open":
+            self._send_ack() # our window has opened again
+
+    def stopProducing(self):
+        self.loseConnection()
+
+    def get_stats(self):
+        return {"udp_packets_sent": self._packets_sent,
+                "udp_retransmits": self._retransmits,
+                "udp_packets_received": self._packets_received,
+                "udp_loss_events": self._loss_events,
+                }
+
+    # connection setup, driven by the UDPEndpoint
+
+    def _send_syn(self, connected_d, factory, tries=0):
+        self._syn_timer = None
+        if tries > SYN_RETRIES:
+            self._endpoint._remove(self)
+            self.state = "closed"
+            connected_d.errback(error.ConnectError(
+                string="no answer from %s:%d" % self._addr))
+            return
+        if tries == 0:
+            self._syn_sent_at = self._reactor.seconds()
+        self._endpoint._send(HEADER.pack(self.conn_id, SYN), self._addr)
+        self._syn_tries = tries
+        self._syn_timer = self._reactor.callLater(
+            INITIAL_RTO * 2**tries, self._send_syn, connected_d, factory,
+            tries + 1)
+        self._connected_d = connected_d
+        self._factory = factory
+
+    def _cancel_connect(self, d):
+        if self._syn_timer is not None and self._syn_timer.active():
+            self._syn_timer.cancel()
+        self._endpoint._send(HEADER.pack(self.conn_id, RST), self._addr)
+        self._endpoint._remove(self)
+        self.state = "closed"
+
+    def _established(self):
+        # the client side, when the server first answers
+        if self._syn_timer is not None and self._syn_timer.active():
+            self._syn_timer.cancel()
+        if self._syn_tries == 0:
+            self._rtt_sample(self._reactor.seconds() - self._syn_sent_at)
+        self.state = "open"
+        p = self._factory.buildProtocol(self.getPeer())
+        d, self._connected_d = self._connected_d, None
+        self._attach(p)
+        d.callback(p)
+
+    def _accepted(self, factory):
+        # the server side, on the first SYN
+        self.state = "open"
+        self._endpoint._send(HEADER.pack(self.conn_id, SYNACK), self._addr)
+        p = factory.buildProtocol(self.getPeer())
+        if p is None:
+            self.abortConnection()
+            return
+        self._attach(p)
+
+    def _attach(self, p):
+        self.protocol = p
+        p.makeConnection(self)
+
+    def _packet_received(self, kind, packet):
+        self._packets_received += 1
+        self._timeouts = 0 # they're still there
+        if kind == RST:
+            if self.state == "syn-sent":
+                self._cancel_connect(None)
+                d, self._connected_d = self._connected_d, None
+                d.errback(error.ConnectionRefusedError())
+            elif self.disconnecting:
+                # they already tore down, after our FIN got through
+                self._teardown(error.ConnectionDone())
+            else:
+                self._teardown(error.ConnectionLost("reset by peer"))
+            return
+        if kind == SYN:
+            # our SYNACK was lost
+            self._endpoint._send(HEADER.pack(self.conn_id, SYNACK),
+                                 self._addr)
+            return
+        if self.state == "syn-sent":
+            # a SYNACK, or anything that shows they heard our SYN
+            self._established()
+            if self.state != "open":
+                return
+        if kind == ACK:
+            try:
+                cumulative, window, blocks = decode_ack(packet)
+            except ValueError:
+                return
+            self._ack_received(cumulative, window, blocks)
+        elif kind in (DATA, FIN):
+            if len(packet) < HEADER.size + SEQ.size:
+                return
+            (seq,) = SEQ.unpack_from(packet, HEADER.size)
+            self._data_received(seq, kind, packet[HEADER.size + SEQ.size:])
+        elif kind == PING:
+            self._send_ack()
+
+    # sending
+
+    def _pacing_rate(self):
+        if self.srtt is None or self.srtt <= 0:
+            return None
+        gain = PACING_GAIN
+        if self.cwnd < self.ssthresh:
+            gain = SLOW_START_PACING_GAIN
+        return gain * self.cwnd * MSS / self.srtt
+
+    def _pump(self):
+        if self.state != "open":
+            return
+        now = self._reactor.seconds()
+        rate = self._pacing_rate()
+        if rate is not None and self._tokens_at is not None:
+            burst = max(PACING_BURST * MSS, rate * 2 * PACING_TICK)
+            self._tokens = min(burst,
+                               self._tokens + (now - self._tokens_at) * rate)
+        self._tokens_at = now
+        while self._in_flight < self.cwnd:
+            if rate is not None and self._tokens < MSS:
+                if self._pace_timer is None and self._has_work():
+                    delay = max(PACING_TICK, (MSS - self._tokens) / rate)
+                    self._pace_timer = self._reactor.callLater(delay,
+                                                               self._paced)
+                break
+            p = self._next_packet()
+            if p is None:
+                break
+            self._transmit(p, now)
+            self._tokens -= len(p.payload) or MSS
+        if (self._in_flight == 0 and self._rto_timer is None
+            and self._has_work()):
+            # their window is closed: probe it until it opens
+            self._start_rto()
+        self._wake_producer()
+
+    def _paced(self):
+        self._pace_timer = None
+        self._pump()
+
+    def _has_work(self):
+        return bool(self._lost or self._pending_size
+                    or (self.disconnecting and self._fin_seq is None))
+
+    def _next_packet(self):
+        while self._lost:
+            p = self._unacked.get(self._lost.popleft())
+            if p is not None and not p.sacked and not p.in_flight:
+                p.retransmitted = True
+                self._retransmits += 1
+                return p
+        if self._next_seq >= self._snd_una + self._peer_window:
+            return None
+        if self._pending_size:
+            p = _Packet(self._next_seq, DATA, self._take(MSS))
+        elif self.disconnecting and self._fin_seq is None:
+            self._fin_seq = self._next_seq
+            p = _Packet(self._next_seq, FIN, b"")
+        else:
+            return None
+        self._unacked[p.seq] = p
+        self._next_seq += 1
+        return p
+
+    def _take(self, size):
+        chunks, taken = [], 0
+        while self._pending and taken < size:
+            chunk = self._pending.popleft()
+            if taken + len(chunk) > size:
+                cut = size - taken
+                self._pending.appendleft(chunk[cut:])
+                chunk = chunk[:cut]
+            chunks.append(chunk.tobytes())
+            taken += len(chunk)
+        self._pending_size -= taken
+        return b"".join(chunks)
+
+    def _transmit(self, p, now):
+        p.sent_at = now
+        p.in_flight = True
+        self._in_flight += 1
+        self._packets_sent += 1
+        self._endpoint._send(HEADER.pack(self.conn_id, p.kind)
+                             + SEQ.pack(p.seq) + p.payload, self._addr)
+        if self._rto_timer is None:
+            self._start_rto()
+
+    def _start_rto(self):
+        self._rto_timer = self._reactor.callLater(self.rto, self._rto_expired)
+
+    def _stop_rto(self):
+        if self._rto_timer is not None:
+            if self._rto_timer.active():
+                self._rto_timer.cancel()
+            self._rto_timer = None
+
+    def _rtt_sample(self, rtt):
+        # RFC 6298
+        if self.srtt is None:
+            self.srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self._rttvar))
+
+    def _ack_received(self, cumulative, window, blocks):
+        now = self._reactor.seconds()
+        cumulative = min(cumulative, self._next_seq)
+        self._peer_window = window
+        newly_acked = 0
+        sample = None
+        while self._snd_una < cumulative:
+            p = self._unacked.pop(self._snd_una, None)
+            self._snd_una += 1
+            if p is None:
+                continue
+            if p.in_flight:
+                p.in_flight = False
+                self._in_flight -= 1
+            if not p.sacked:
+                newly_acked += 1
+                self._latest_delivered_sent = max(self._latest_delivered_sent,
+                                                  p.sent_at)
+                if not p.retransmitted: # Karn's algorithm
+                    sample = now - p.sent_at
+        for (start, end) in blocks:
+            for seq in range(max(start, self._snd_una),
+                             min(end, self._next_seq)):
+                p = self._unacked.get(seq)
+                if p is None or p.sacked:
+                    continue
+                p.sacked = True
+                newly_acked += 1
+                if p.in_flight:
+                    p.in_flight = False
+                    self._in_flight -= 1
+                self._latest_delivered_sent = max(self._latest_delivered_sent,
+                                                  p.sent_at)
+                self._highest_sacked = max(self._highest_sacked, seq)
+                if not p.retransmitted:
+                    sample = now - p.sent_at
+        if sample is not None:
+            self._rtt_sample(sample)
+        self._detect_losses()
+        if newly_acked:
+            if self._snd_una >= self._recovery_until:
+                if self.cwnd < self.ssthresh:
+                    self.cwnd += newly_acked # slow start
+                else:
+                    self.cwnd += float(newly_acked) / self.cwnd
+            self._stop_rto()
+            if self._in_flight:
+                self._start_rto()
+        if self._fin_seq is not None and self._snd_una > self._fin_seq:
+            self._teardown(error.ConnectionDone())
+            return
+        self._pump()
+
+    def _detect_losses(self):
+        # a packet is lost if three later ones have arrived, and something
+        # sent after it (even a retransmission) has been acknowledged
+        last = self._highest_sacked - DUPTHRESH
+        congested = False
+        for seq in range(self._snd_una, last + 1):
+            p = self._unacked.get(seq)
+            if (p is None or p.sacked or not p.in_flight
+                or p.sent_at >= self._latest_delivered_sent):
+                continue
+            p.in_flight = False
+            self._in_flight -= 1
+            self._lost.append(seq)
+            if seq >= self._recovery_until:
+                congested = True
+        if congested:
+            self._enter_recovery()
+
+    def _enter_recovery(self):
+        self._loss_events += 1
+        self.ssthresh = max(self.cwnd / 2, float(MIN_CWND))
+        self.cwnd = self.ssthresh
+        self._recovery_until = self._next_seq
+
+    def _rto_expired(self):
+        self._rto_timer = None
+        self._timeouts += 1
+        if self._timeouts > MAX_TIMEOUTS:
+            self._teardown(error.ConnectionLost("no answer from peer"))
+            return
+        self.rto = min(MAX_RTO, self.rto * 2)
+        if not self._in_flight:
+            # nothing outstanding, but their window was closed: ask again
+            self._endpoint._send(HEADER.pack(self.conn_id, PING), self._addr)
+            self._start_rto()
+            self._pump()
+            return
+        # assume everything in flight was lost, and start again slowly
+        for seq in sorted(self._unacked):
+            p = self._unacked[seq]
+            if p.in_flight:
+                p.in_flight = False
+                self._lost.append(seq)
+        self._lost = deque(sorted(set(self._lost)))
+        self._in_flight = 0
+        self._loss_events += 1
+        self.ssthresh = max(self.cwnd / 2, float(MIN_CWND))
+        self.cwnd = 1.0
+        self._recovery_until = self._next_seq
+        self._pump()
+        if self._rto_timer is None:
+            self._start_rto()
+
+    # receiving
+
+    def _window(self):
+        return max(0, RECEIVE_WINDOW - len(self._deliverable))
+
+    def _data_received(self, seq, kind, payload):
+        if seq < self._rcv_next or seq in self._out_of_order:
+            self._send_ack() # a duplicate: our ack was probably lost
+            return
+        if seq >= self._rcv_next + self._window():
+            self._send_ack()
+            return
+        if seq != self._rcv_next:
+            self._out_of_order[seq] = (kind, payload)
+            self._send_ack() # tell them about the gap right away
+            return
+        self._accept(kind, payload)
+        filled_gap = False
+        while self._rcv_next in self._out_of_order:
+            self._accept(*self._out_of_order.pop(self._rcv_next))
+            filled_gap = True
+        self._received_unacked += 1
+        if (filled_gap or kind == FIN
+            or self._received_unacked >= ACK_EVERY):
+            self._send_ack()
+        elif self._ack_timer is None:
+            self._ack_timer = self._reactor.callLater(ACK_DELAY,
+                                                      self._send_ack)
+        self._deliver()
+
+    def _accept(self, kind, payload):
+        self._rcv_next += 1
+        self._deliverable.append(None if kind == FIN else payload)
+
+    def _deliver(self):
+        while (self._deliverable and not self._paused and self.protocol
+               and self.state == "open"):
+            if self._deliverable[0] is None:
+                # their FIN: everything before it has been delivered
+                self._teardown(error.ConnectionDone())
+                return
+            try:
+                end = self._deliverable.index(None)
+            except ValueError:
+                end = len(self._deliverable)
+            data = b"".join(self._deliverable[:end])
+            del self._deliverable[:end]
+            self.protocol.dataReceived(data)
+
+    def _send_ack(self):
+        if self._ack_timer is not None:
+            if self._ack_timer.active():
+                self._ack_timer.cancel()
+            self._ack_timer = None
+        self._received_unacked = 0
+        if self.state == "closed":
+            return
+        blocks = sack_blocks(sorted(self._out_of_order))
+        self._endpoint._send(encode_ack(self.conn_id, self._rcv_next,
+                                        self._window(), blocks), self._addr)
+
+    def _teardown(self, reason):
+        if self.state == "closed":
+            return
+        if self.state == "syn-sent":
+            d = self._connected_d
+            self._cancel_connect(None)
+            if d is not None:
+                d.errback(failure.Failure(reason))
+            return
+        self.state = "closed"
+        self._stop_rto()
+        for timer in (self._pace_timer, self._ack_timer, self._deliver_timer):
+            if timer is not None and timer.active():
+                timer.cancel()
+        self._pace_timer = self._ack_timer = self._deliver_timer = None
+        self._endpoint._remove(self)
+        producer, self._producer = self._producer, None
+        if producer is not None:
+            producer.stopProducing()
+        if self.protocol is not None:
+            self.protocol.connectionLost(failure.Failure(reason))
+
+
+class UDPEndpoint(protocol.DatagramProtocol):
+    """One UDP socket, carrying any number of Sessions. Inbound sessions are
+    handed to 'factory', if there is one: set it to None to turn new ones
+    away."""
+    def __init__(self, reactor, factory=None):
+        self._reactor = reactor
+        self.factory = factory
+        self._sessions = {} # conn_id -> Session
+        self._port = None
+        self._host = None
+        self._close_when_idle = False
+
+    def listen(self, port=0, interface=""):
+        self._port = self._reactor.listenUDP(port, self, interface=interface)
+        self._host = self._port.getHost()
+        return self._host.port
+
+    def getHost(self):
+        return self._host
+
+    def connect(self, host, port, factory):
+        """Open a session to host:port. Returns a Deferred that fires with
+        the Protocol built by 'factory' once the other side answers."""
+        if re.search(r"^\d+\.\d+\.\d+\.\d+$", host):
+            d = defer.succeed(host)
+        else:
+            d = self._reactor.resolve(host)
+        d.addCallback(self._connect, port, factory)
+        return d
+
+    def _connect(self, host, port, factory):
+        conn_id = os.urandom(8)
+        s = Session(self, conn_id, (host, port), self._reactor)
+        self._sessions[conn_id] = s
+        d = defer.Deferred(s._cancel_connect)
+        s._send_syn(d, factory)
+        return d
+
+    def datagramReceived(self, packet, addr):
+        if len(packet) < HEADER.size:
+            return
+        conn_id, kind = HEADER.unpack_from(packet)
+        s = self._sessions.get(conn_id)
+        if s is not None:
+            if addr == s._addr:
+                s._packet_received(kind, packet)
+            return
+        if kind == SYN and self.factory is not None:
+            s = Session(self, conn_id, addr, self._reactor)
+            self._sessions[conn_id] = s
+            s._accepted(self.factory)
+        elif kind != RST:
+            # a session we've already torn down, or never knew
+            self._send(HEADER.pack(conn_id, RST), addr)
+
+    def _send(self, packet, addr):
+        if self.transport is not None:
+            self.transport.write(packet, addr)
+
+    def _remove(self, session):
+        self._sessions.pop(session.conn_id, None)
+        self._maybe_close()
+
+    def close_when_idle(self):
+        """Stop listening once the last session has closed."""
+        self._close_when_idle = True
+        self._maybe_close()
+
+    def _maybe_close(self):
+        if self._close_when_idle and not self._sessions and self._port:
+            port, self._port = self._port, None
+            port.stopListening()
+
+
+@implementer(interfaces.IStreamClientEndpoint)
+class UDPClientEndpoint:
+    """Connects over an existing UDPEndpoint, so a reliable-UDP session can
+    race the TCP connectors like any other endpoint."""
+    def __init__(self, udp, host, port):
+        self._udp = udp
+        self._host = host
+        self._port = port
+
+    def connect(self, factory):
+        return self._udp.connect(self._host, self._port, factory)
@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+import os, zlib
+from twisted.trial import unittest
+from .. import compression
+from ..compression import (RecordCompressor, decompress_record, RAW, ZLIB,
+                           CompressionError)
+
+TEXT = b"the quick brown fox jumps over the lazy dog\n" * 1000
+
+class Compressor(unittest.TestCase):
+    def setUp(self):
+        self.patch(compression, "SAMPLE_SIZE", 4*len(TEXT))
+        self.patch(compression, "PROBE_INTERVAL", 4)
+
+    def test_roundtrip(self):
+        c = RecordCompressor(6)
+        for record in [TEXT, b"small", os.urandom(10000), b""]:
+            self.assertEqual(decompress_record(c.compress(record)), record)
+        self.assertEqual(c.get_stats()["records_compressed"], 1)
+
+    def test_small(self):
+        c = RecordCompressor(6)
+        self.assertEqual(c.compress(b"a" * 100), RAW + b"a" * 100)
+
+    def test_no_level(self):
+        c = RecordCompressor(None)
+        self.assertEqual(c.compress(TEXT), RAW + TEXT)
+        self.assertEqual(c.get_stats(), {"records_compressed": 0,
+                                         "compression_saved": 0})
+
+    def test_adaptive(self):
+        c = RecordCompressor(1)
+        noise = os.urandom(len(TEXT))
+        # a whole sample of random data switches compression off
+        for i in range(4):
+            self.assertEqual(c.compress(noise), RAW + noise)
+        calls = []
+        real_compress = zlib.compress
+        def _compress(data, level):
+            calls.append(level)
+            return real_compress(data, level)
+        self.patch(zlib, "compress", _compress)
+        for i in range(3):
+            self.assertEqual(c.compress(TEXT), RAW + TEXT)
+        self.assertEqual(calls, [])
+        # the probe finds that it's worth compressing again
+        self.assertEqual(c.compress(TEXT)[:1], ZLIB)
+        self.assertEqual(c.compress(TEXT)[:1], ZLIB)
+        self.assertEqual(calls, [1, 1])
+
+    def test_mixed(self):
+        # half the sample compresses well, which is still worth it
+        c = RecordCompressor(1)
+        noise = os.urandom(len(TEXT))
+        for i in range(2):
+            c.compress(noise)
+            c.compress(TEXT)
+        self.assertEqual(c.compress(TEXT)[:1], ZLIB)
+
+class Decompress(unittest.TestCase):
+    def test_bad_flag(self):
+        self.assertRaises(CompressionError, decompress_record, b"\x02data")
+        self.assertRaises(CompressionError, decompress_record, b"")
+
+    def test_corrupt(self):
+        self.assertRaises(CompressionError, decompress_record,
+                          ZLIB + b"not zlib")
+
+    def test_truncated(self):
+        compressed = zlib.compress(TEXT)
+        e = self.assertRaises(CompressionError, decompress_record,
+                              ZLIB + compressed[:len(compressed)//2])
+        self.assertIn("truncated", str(e))
+        # the zlib trailer alone (its checksum) is missing
+        self.assertRaises(CompressionError, decompress_record,
+                          ZLIB + compressed[:-4])
+        e = self.assertRaises(CompressionError, decompress_record,
+                              ZLIB + compressed + b"junk")
+        self.assertIn("junk", str(e))
+        self.assertEqual(decompress_record(ZLIB + compressed), TEXT)
+
+    def test_bomb(self):
+        bomb = ZLIB + zlib.compress(b"\x00" * (compression.MAX_RECORD_SIZE+1))
+        self.assertRaises(CompressionError, decompress_record, bomb)
+        ok = ZLIB + zlib.compress(b"\x00" * compression.MAX_RECORD_SIZE)
+        self.assertEqual(len(decompress_record(ok)),
+                         compression.MAX_RECORD_SIZE)
@@ -0,0 +1,155 @@
+from __future__ import absolute_import
+import io, os, hashlib
+from twisted.trial import unittest
+from .. import delta
+from ..delta import DeltaError
+
+class FakeThreadPool:
+    # jobs only run when the test says so
+    def __init__(self):
+        self.jobs = []
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        self.jobs.append((onResult, f, args, kwargs))
+    def run(self):
+        onResult, f, args, kwargs = self.jobs.pop(0)
+        onResult(True, f(*args, **kwargs))
+
+class FakeReactor:
+    def __init__(self):
+        self.pool = FakeThreadPool()
+    def getThreadPool(self):
+        return self.pool
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+def transfer(old, new, block_size, record_size=2**16):
+    # run 'new' through a DeltaReader and back through a DeltaApplier
+    sigs = delta.parse_signatures(delta.signatures(io.BytesIO(old),
+                                                   block_size))
+    hasher = hashlib.sha256()
+    covered = []
+    reader = delta.DeltaReader(io.BytesIO(new), block_size, sigs,
+                               record_size, hasher=hasher.update,
+                               progress=covered.append)
+    applier = delta.DeltaApplier(io.BytesIO(old), block_size,
+                                 len(old) // block_size)
+    records = []
+    chunks = []
+    while True:
+        record = reader.read(record_size)
+        if not record:
+            break
+        assert len(record) <= record_size
+        records.append(record)
+        chunks.extend(applier.apply(record))
+    assert b"".join(chunks) == new
+    assert hasher.digest() == hashlib.sha256(new).digest()
+    assert sum(covered) == len(new)
+    assert (reader.copied, reader.literal) == (applier.copied,
+                                               applier.literal)
+    return records, reader
+
+class Reader(unittest.TestCase):
+    def setUp(self):
+        self.old = os.urandom(300000)
+
+    def test_same(self):
+        records, reader = transfer(self.old, self.old, 1024)
+        # one copy of every whole block, and the tail
+        self.assertEqual(len(records), 2)
+        self.assertEqual(reader.literal, len(self.old) % 1024)
+
+    def test_edits(self):
+        new = (b"prefix" + self.old[:5000] + self.old[9000:200000] + b"x"
+               + self.old[200001:] + b"suffix")
+        records, reader = transfer(self.old, new, 1024)
+        self.assertTrue(reader.literal < 5*1024, reader.literal)
+
+    def test_nothing_in_common(self):
+        new = os.urandom(100000)
+        records, reader = transfer(self.old, new, 1024, record_size=4096)
+        self.assertEqual(reader.copied, 0)
+        self.assertEqual(len(records), 25)
+
+    def test_empty(self):
+        transfer(b"", b"new", 1024)
+        transfer(self.old, b"", 1024)
+        transfer(b"short", b"short", 1024)
+
+    def test_repeated_blocks(self):
+        # all the blocks match, but runs stay in order
+        old = b"\x00" * 20 * 1024
+        records, reader = transfer(old, old + old, 1024)
+        self.assertEqual(reader.literal, 0)
+        self.assertEqual(len(records), 2)
+
+    def test_search_limit(self):
+        # past the limit we only look at whole-block steps, which still
+        # finds blocks that are where they were
+        self.patch(delta, "SEARCH_LIMIT", 2048)
+        new = b"a" * 4096 + self.old[4096:]
+        records, reader = transfer(self.old, new, 1024)
+        self.assertEqual(reader.literal, 4096 + len(self.old) % 1024)
+        new = b"a" * 4000 + self.old[4096:]
+        records, reader = transfer(self.old, new, 1024)
+        self.assertEqual(reader.copied, 0)
+
+    def test_threaded(self):
+        new = self.old[:1000] + b"x" + self.old[1000:]
+        sigs = delta.parse_signatures(delta.signatures(io.BytesIO(self.old),
+                                                       1024))
+        hasher = hashlib.sha256()
+        covered = []
+        reactor = FakeReactor()
+        reader = delta.DeltaReader(io.BytesIO(new), 1024, sigs, 2**16,
+                                   hasher=hasher.update,
+                                   progress=covered.append, reactor=reactor)
+        d = reader.read(2**16)
+        self.assertNoResult(d)
+        # the search runs in the thread, but its reports wait for the
+        # reactor thread
+        onResult, f, args, kwargs = reactor.pool.jobs.pop(0)
+        record = f(*args, **kwargs)
+        self.assertEqual(covered, [])
+        onResult(True, record)
+        self.assertEqual(self.successResultOf(d), record)
+        self.assertEqual(covered, [1025]) # the first block, and the "x"
+
+        applier = delta.DeltaApplier(io.BytesIO(self.old), 1024,
+                                     len(self.old) // 1024)
+        chunks = applier.apply(record)
+        while record:
+            d = reader.read(2**16)
+            reactor.pool.run()
+            record = self.successResultOf(d)
+            if record:
+                chunks.extend(applier.apply(record))
+        self.assertEqual(b"".join(chunks), new)
+        self.assertEqual(hasher.digest(), hashlib.sha256(new).digest())
+        self.assertEqual(sum(covered), len(new))
+
+class Misc(unittest.TestCase):
+    def test_block_size(self):
+        self.assertEqual(delta.block_size_for(0), delta.MIN_BLOCK_SIZE)
+        self.assertEqual(delta.block_size_for(2**20), 2**10)
+        self.assertEqual(delta.block_size_for(2**20+1), 2**11)
+        self.assertEqual(delta.block_size_for(2**40), delta.MAX_BLOCK_SIZE)
+
+    def test_bad_signatures(self):
+        self.assertRaises(DeltaError, delta.parse_signatures, b"x" * 21)
+
+    def test_bad_records(self):
+        applier = delta.DeltaApplier(io.BytesIO(b"x" * 4096), 1024, 4)
+        self.assertEqual(applier.apply(b"Lnew"), [b"new"])
+        self.assertEqual(b"".join(applier.apply(delta.COPY.pack(b"C", 1, 3))),
+                         b"x" * 3072)
+        self.assertRaises(DeltaError, applier.apply, b"L")
+        self.assertRaises(DeltaError, applier.apply, b"Xwhat")
+        self.assertRaises(DeltaError, applier.apply,
+                          delta.COPY.pack(b"C", 2, 3))
+        self.assertRaises(DeltaError, applier.apply,
+                          delta.COPY.pack(b"C", 0, 0))
+        # the old copy shrank underneath us
+        applier = delta.DeltaApplier(io.BytesIO(b"x" * 2000), 1024, 4)
+        self.assertRaises(DeltaError, applier.apply,
+                          delta.COPY.pack(b"C", 1, 1))
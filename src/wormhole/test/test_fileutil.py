@@ -0,0 +1,75 @@
+import os, errno
+from twisted.trial import unittest
+from .. import fileutil
+
+class Reserve(unittest.TestCase):
+    def setUp(self):
+        self.fn = self.mktemp()
+        with open(self.fn, "wb") as f:
+            f.write(b"partial")
+
+    def test_reserve(self):
+        with open(self.fn, "r+b") as f:
+            f.seek(0, 2)
+            fileutil.reserve_space(f, 2**20)
+        # the apparent size is left alone
+        self.assertEqual(os.stat(self.fn).st_size, 7)
+
+    def test_full(self):
+        def _allocate(fd, offset, length):
+            raise EnvironmentError(errno.ENOSPC, "No space left on device")
+        self.patch(fileutil, "platform", "linux")
+        self.patch(fileutil, "_allocate", _allocate)
+        with open(self.fn, "r+b") as f:
+            f.seek(0, 2)
+            e = self.assertRaises(EnvironmentError,
+                                  fileutil.reserve_space, f, 2**20)
+        self.assertEqual(e.errno, errno.ENOSPC)
+        self.assertEqual(os.stat(self.fn).st_size, 7)
+
+    def test_full_releases_space(self):
+        # fallocate() can reserve part of the range before it runs out:
+        # that part is given back, not left allocated past EOF
+        if not fileutil.platform.startswith("linux"):
+            raise unittest.SkipTest("fallocate() is linux-only")
+        real_allocate = fileutil._allocate
+        def _allocate(fd, offset, length):
+            real_allocate(fd, offset, length)
+            raise EnvironmentError(errno.ENOSPC, "No space left on device")
+        self.patch(fileutil, "_allocate", _allocate)
+        with open(self.fn, "r+b") as f:
+            f.seek(0, 2)
+            try:
+                real_allocate(f.fileno(), 7, 2**20)
+            except EnvironmentError as e:
+                raise unittest.SkipTest("can't preallocate here: %s" % e)
+            self.assertTrue(os.fstat(f.fileno()).st_blocks*512 >= 2**20)
+            self.assertRaises(EnvironmentError,
+                              fileutil.reserve_space, f, 2**20)
+        st = os.stat(self.fn)
+        self.assertEqual(st.st_size, 7)
+        self.assertTrue(st.st_blocks*512 < 2**20, st.st_blocks)
+
+    def test_unsupported(self):
+        # filesystems that can't preallocate fall back to checking statvfs
+        def _allocate(fd, offset, length):
+            raise EnvironmentError(errno.EOPNOTSUPP, "Operation not supported")
+        self.patch(fileutil, "platform", "linux")
+        self.patch(fileutil, "_allocate", _allocate)
+        checked = []
+        self.patch(fileutil, "_check_free_space",
+                   lambda fd, needed: checked.append(needed))
+        with open(self.fn, "r+b") as f:
+            f.seek(0, 2)
+            fileutil.reserve_space(f, 100)
+        self.assertEqual(checked, [93])
+
+    def test_free_space(self):
+        if not hasattr(os, "fstatvfs"):
+            raise unittest.SkipTest("no fstatvfs() on this platform")
+        with open(self.fn, "rb") as f:
+            fileutil._check_free_space(f.fileno(), 1)
+            e = self.assertRaises(EnvironmentError,
+                                  fileutil._check_free_space, f.fileno(),
+                                  2**80)
+        self.assertEqual(e.errno, errno.ENOSPC)
@@ -0,0 +1,24 @@
+from binascii import unhexlify
+from twisted.trial import unittest
+from .. import framing
+
+class Framing(unittest.TestCase):
+    def test_length(self):
+        for length in [0, 1, 40, 2**14+40, 2**32-1]:
+            b = framing.encode_length(length)
+            self.assertIsInstance(b, type(b""))
+            self.assertEqual(b, unhexlify("%08x" % length))
+            self.assertEqual(framing.decode_length(b), length)
+
+    def test_length_offset(self):
+        buf = bytearray(b"junk" + framing.encode_length(1234) + b"more")
+        self.assertEqual(framing.decode_length(buf, 4), 1234)
+
+    def test_nonce(self):
+        for counter in [0, 1, 255, 2**32, 2**64-1, 2**64, 2**(8*24)-1]:
+            b = framing.encode_nonce(counter)
+            self.assertIsInstance(b, type(b""))
+            self.assertEqual(len(b), framing.NONCE_SIZE)
+            self.assertEqual(b, unhexlify("%048x" % counter))
+            # decode_nonce() is given the whole ciphertext
+            self.assertEqual(framing.decode_nonce(b + b"ciphertext"), counter)
@@ -0,0 +1,70 @@
+import hashlib
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from .. import hashing
+
+class Choose(unittest.TestCase):
+    def test_preferred(self):
+        self.patch(hashing, "_preferred", None)
+        preferred = hashing.preferred_hashes()
+        self.assertEqual(preferred,
+                         [n for n in [u"blake2b", u"sha256"]
+                          if hasattr(hashlib, n)])
+        # the same every time
+        self.assertEqual(hashing.preferred_hashes(), preferred)
+        self.patch(hashing, "_preferred", [u"sha256"])
+        self.assertEqual(hashing.preferred_hashes(), [u"sha256"])
+
+    def test_choose(self):
+        self.assertEqual(hashing.choose_hash(None), u"sha256")
+        self.assertEqual(hashing.choose_hash([]), u"sha256")
+        self.assertEqual(hashing.choose_hash([u"md17", u"sha256"]),
+                         u"sha256")
+        if hasattr(hashlib, "blake2b"):
+            self.assertEqual(hashing.choose_hash([u"blake2b", u"sha256"]),
+                             u"blake2b")
+
+class Threaded(unittest.TestCase):
+    @inlineCallbacks
+    def test_hash(self):
+        hasher = hashlib.sha256()
+        th = hashing.ThreadedHasher(reactor, hasher)
+        for i in range(200):
+            th.update(str(i).encode("ascii"))
+        result = yield th.finish()
+        self.assertIs(result, hasher)
+        expected = hashlib.sha256(b"".join(str(i).encode("ascii")
+                                           for i in range(200)))
+        self.assertEqual(hasher.digest(), expected.digest())
+
+    @inlineCallbacks
+    def test_failed(self):
+        class BadHasher:
+            def update(self, data):
+                raise ValueError("oops")
+        th = hashing.ThreadedHasher(reactor, BadHasher())
+        th.update(b"data")
+        f = yield self.assertFailure(th.finish(), ValueError)
+        self.assertEqual(str(f), "oops")
+        self.assertRaises(ValueError, th.update, b"more")
+
+    @inlineCallbacks
+    def test_dead_worker(self):
+        # a full queue and no worker to empty it: don't wait forever
+        self.patch(hashing, "HASH_QUEUE_SIZE", 1)
+        self.patch(hashing, "HASH_WAIT", 0.01)
+        th = hashing.ThreadedHasher(reactor, hashlib.sha256())
+        yield th.finish()
+        th._thread.join()
+        th.update(b"one")
+        self.assertRaises(RuntimeError, th.update, b"two")
+
+    @inlineCallbacks
+    def test_inline(self):
+        hasher = hashlib.sha256()
+        ih = hashing.InlineHasher(hasher)
+        ih.update(b"data")
+        self.assertEqual(hasher.digest(), hashlib.sha256(b"data").digest())
+        result = yield ih.finish()
+        self.assertIs(result, hasher)
@@ -0,0 +1,56 @@
+import socket
+from twisted.trial import unittest
+from .. import ipaddrs
+
+class FindAddresses(unittest.TestCase):
+    def setUp(self):
+        self.patch(ipaddrs, "_cache", None)
+        self.now = 1000.0
+        self.native_calls = 0
+        self.native = [(socket.AF_INET, "127.0.0.1"),
+                       (socket.AF_INET, "10.0.0.1"),
+                       (socket.AF_INET6, "::1")]
+        def _native_addresses():
+            self.native_calls += 1
+            if isinstance(self.native, Exception):
+                raise self.native
+            return self.native
+        self.patch(ipaddrs, "_native_addresses", _native_addresses)
+        self.patch(ipaddrs, "_tool_addresses", lambda: ["192.168.1.1"])
+
+    def find(self, ipv6=False):
+        return ipaddrs.find_addresses(ipv6=ipv6, now=lambda: self.now)
+
+    def test_native(self):
+        self.assertEqual(self.find(), ["127.0.0.1", "10.0.0.1"])
+        self.assertEqual(self.find(ipv6=True),
+                         ["127.0.0.1", "10.0.0.1", "::1"])
+        self.assertEqual(self.native_calls, 1)
+
+    def test_ttl(self):
+        self.find()
+        self.now += ipaddrs.CACHE_TTL - 1
+        self.find()
+        self.assertEqual(self.native_calls, 1)
+        self.now += 1
+        self.find()
+        self.assertEqual(self.native_calls, 2)
+
+    def test_fallback(self):
+        self.native = OSError("no getifaddrs here")
+        self.assertEqual(self.find(), ["192.168.1.1"])
+        self.patch(ipaddrs, "_cache", None)
+        self.native = []
+        self.assertEqual(self.find(), ["192.168.1.1"])
+
+class Native(unittest.TestCase):
+    def test_native(self):
+        try:
+            addresses = ipaddrs._native_addresses()
+        except Exception as e:
+            raise unittest.SkipTest("getifaddrs unavailable: %s" % (e,))
+        for (family, address) in addresses:
+            self.assertIn(family, (socket.AF_INET, socket.AF_INET6))
+            socket.inet_pton(family, address)
+        if addresses:
+            self.assertIn((socket.AF_INET, "127.0.0.1"), addresses)
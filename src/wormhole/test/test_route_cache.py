@@ -0,0 +1,82 @@
+from __future__ import absolute_import
+import os, json
+from twisted.trial import unittest
+from .. import route_cache
+from ..transit import DirectTCPV1Hint, TorTCPV1Hint
+
+class Key(unittest.TestCase):
+    def test_ignores_ports_and_order(self):
+        a = [DirectTCPV1Hint(u"10.0.0.1", 1234),
+             DirectTCPV1Hint(u"relay.example", 4001)]
+        b = [DirectTCPV1Hint(u"relay.example", 4001),
+             DirectTCPV1Hint(u"10.0.0.1", 5678)]
+        self.assertEqual(route_cache.hints_key(a), route_cache.hints_key(b))
+        c = [TorTCPV1Hint(u"10.0.0.1", 1234),
+             DirectTCPV1Hint(u"relay.example", 4001)]
+        self.assertNotEqual(route_cache.hints_key(a), route_cache.hints_key(c))
+
+class Cache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.path = self.mktemp()
+
+    def make(self, max_age=60):
+        return route_cache.RouteCache(self.path, max_age=max_age,
+                                      now=lambda: self.now)
+
+    def test_remember(self):
+        c = self.make()
+        self.assertEqual(c.lookup(u"key"), None)
+        c.remember(u"key", u"10.0.0.1", False, 0.25)
+        entry = c.lookup(u"key")
+        self.assertEqual(entry[u"hostname"], u"10.0.0.1")
+        self.assertEqual(entry[u"relay"], False)
+        self.assertEqual(entry[u"latency"], 0.25)
+
+        # and it survives a restart
+        entry = self.make().lookup(u"key")
+        self.assertEqual(entry[u"hostname"], u"10.0.0.1")
+        self.assertEqual(os.listdir(os.path.dirname(self.path)),
+                         [os.path.basename(self.path)])
+
+    def test_expire(self):
+        c = self.make()
+        c.remember(u"old", u"10.0.0.1", False, 0.25)
+        self.now += 30
+        c.remember(u"new", u"10.0.0.2", True, 0.5)
+        self.now += 40
+        self.assertEqual(c.lookup(u"old"), None)
+        self.assertEqual(c.lookup(u"new")[u"hostname"], u"10.0.0.2")
+        # expired entries are dropped from the file on the next write
+        c.remember(u"newer", u"10.0.0.3", False, 0.1)
+        with open(self.path) as f:
+            self.assertEqual(sorted(json.load(f).keys()), [u"new", u"newer"])
+
+    def test_rtt(self):
+        c = self.make()
+        self.assertEqual(c.lookup_rtt(u"->relay:tcp:relay:4001"), None)
+        c.remember_rtt(u"->relay:tcp:relay:4001", 0.05)
+        self.assertEqual(self.make().lookup_rtt(u"->relay:tcp:relay:4001"),
+                         0.05)
+        self.now += 70
+        self.assertEqual(c.lookup_rtt(u"->relay:tcp:relay:4001"), None)
+
+    def test_corrupt(self):
+        with open(self.path, "w") as f:
+            f.write("not json")
+        c = self.make()
+        self.assertEqual(c.lookup(u"key"), None)
+        c.remember(u"key", u"10.0.0.1", False, 0.25)
+        self.assertEqual(self.make().lookup(u"key")[u"hostname"], u"10.0.0.1")
+
+    def test_write_failed(self):
+        def replace(src, dst):
+            raise OSError("nope")
+        self.patch(os, "replace", replace)
+        self.patch(os, "rename", replace)
+        c = self.make()
+        c.remember(u"key", u"10.0.0.1", False, 0.25)
+        self.assertEqual(len(self.flushLoggedErrors(OSError)), 1)
+        # the temporary file is cleaned up, and we still remember the route
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+        self.assertEqual(c.lookup(u"key")[u"hostname"], u"10.0.0.1")
@@ -0,0 +1,232 @@
+from __future__ import print_function, absolute_import
+import random
+from twisted.trial import unittest
+from twisted.internet import task, protocol, error, defer
+from .. import rudp
+
+class Collector(protocol.Protocol):
+    def __init__(self):
+        self.data = []
+        self.lost = []
+    def dataReceived(self, data):
+        self.data.append(data)
+    def connectionLost(self, reason=None):
+        self.lost.append(reason)
+    def received(self):
+        return b"".join(self.data)
+
+class FakeUDPTransport:
+    def __init__(self, network, addr):
+        self._network = network
+        self._addr = addr
+    def write(self, packet, addr):
+        self._network.send(self._addr, addr, packet)
+
+class Network:
+    """Carry datagrams between UDPEndpoints, 'delay' seconds later, losing
+    a 'loss' fraction of them (chosen by a seeded RNG, so every run is the
+    same)."""
+    def __init__(self, clock, delay=0.01, loss=0.0, seed=1):
+        self._clock = clock
+        self.delay = delay
+        self.loss = loss
+        self._rng = random.Random(seed)
+        self._endpoints = {}
+        self.sent = 0
+        self.dropped = 0
+
+    def add(self, addr, factory=None):
+        ep = rudp.UDPEndpoint(self._clock, factory)
+        ep.transport = FakeUDPTransport(self, addr)
+        self._endpoints[addr] = ep
+        return ep
+
+    def send(self, src, dst, packet):
+        self.sent += 1
+        if self._rng.random() < self.loss:
+            self.dropped += 1
+            return
+        ep = self._endpoints.get(dst)
+        if ep is not None:
+            self._clock.callLater(self.delay, ep.datagramReceived, packet, src)
+
+SERVER = ("10.0.0.2", 4001)
+CLIENT = ("10.0.0.1", 4002)
+
+class Packets(unittest.TestCase):
+    def test_ack(self):
+        packet = rudp.encode_ack(b"c"*8, 7, 100, [(9, 11), (12, 20)])
+        self.assertEqual(rudp.decode_ack(packet), (7, 100, [(9, 11), (12, 20)]))
+        self.assertRaises(ValueError, rudp.decode_ack, packet[:-1])
+        self.assertRaises(ValueError, rudp.decode_ack, packet[:12])
+
+    def test_sack_blocks(self):
+        self.assertEqual(rudp.sack_blocks([]), [])
+        self.assertEqual(rudp.sack_blocks([3, 4, 5, 8, 10, 11]),
+                         [(3, 6), (8, 9), (10, 12)])
+
+class Sessions(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def connect(self, network):
+        self.server_factory = protocol.Factory.forProtocol(Collector)
+        server = network.add(SERVER, self.server_factory)
+        client = network.add(CLIENT)
+        results = []
+        d = client.connect(SERVER[0], SERVER[1],
+                           protocol.Factory.forProtocol(Collector))
+        d.addBoth(results.append)
+        self.run_until(lambda: results)
+        self.assertIsInstance(results[0], Collector)
+        (session,) = server._sessions.values()
+        return server, client, session.protocol, results[0]
+
+    def run_until(self, done, limit=600.0):
+        while not done():
+            self.assertTrue(self.clock.seconds() < limit, "took too long")
+            self.clock.advance(0.001)
+
+    def transfer(self, network, size=300000):
+        server, client, server_p, client_p = self.connect(network)
+        rng = random.Random(2)
+        data = bytes(bytearray(rng.getrandbits(8) for i in range(size)))
+        for i in range(0, size, 10000):
+            client_p.transport.write(data[i:i+10000])
+        client_p.transport.loseConnection()
+        self.run_until(lambda: server_p.lost and client_p.lost)
+        self.assertEqual(server_p.received(), data)
+        server_p.lost[0].trap(error.ConnectionDone)
+        client_p.lost[0].trap(error.ConnectionDone)
+        self.assertEqual(server._sessions, {})
+        self.assertEqual(client._sessions, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        return client_p.transport.get_stats()
+
+    def test_transfer(self):
+        stats = self.transfer(Network(self.clock))
+        self.assertEqual(stats["udp_retransmits"], 0)
+        self.assertEqual(stats["udp_loss_events"], 0)
+
+    def test_transfer_lossy(self):
+        network = Network(self.clock, delay=0.05, loss=0.1)
+        stats = self.transfer(network)
+        self.assertTrue(network.dropped > 0)
+        self.assertTrue(stats["udp_retransmits"] > 0)
+        self.assertTrue(stats["udp_loss_events"] > 0)
+
+    def test_both_directions(self):
+        network = Network(self.clock, loss=0.05)
+        server, client, server_p, client_p = self.connect(network)
+        client_p.transport.write(b"ping" * 1000)
+        server_p.transport.write(b"pong" * 1000)
+        self.run_until(lambda: (len(server_p.received()) == 4000
+                                and len(client_p.received()) == 4000))
+        self.assertEqual(client_p.received(), b"pong" * 1000)
+        # the FIN is retransmitted like data, and closes the other side
+        server_p.transport.loseConnection()
+        self.run_until(lambda: server_p.lost and client_p.lost)
+        client_p.lost[0].trap(error.ConnectionDone)
+
+    def test_window(self):
+        # a paused receiver holds on to what it has, and the sender stops
+        # once the receiver's window is full
+        self.patch(rudp, "RECEIVE_WINDOW", 8)
+        network = Network(self.clock)
+        server, client, server_p, client_p = self.connect(network)
+        server_p.transport.pauseProducing()
+        client_p.transport.write(b"x" * (20 * rudp.MSS))
+        self.clock.advance(1.0)
+        self.assertEqual(server_p.data, [])
+        session = client_p.transport
+        self.assertEqual(session._next_seq, 8)
+        self.assertTrue(session._pending_size > 0)
+
+        server_p.transport.resumeProducing()
+        self.run_until(lambda: len(server_p.received()) == 20 * rudp.MSS)
+
+        # a lost window update is recovered by probing
+        server_p.transport.pauseProducing()
+        client_p.transport.write(b"y" * (20 * rudp.MSS))
+        self.clock.advance(1.0)
+        network.loss = 1.0
+        server_p.transport.resumeProducing()
+        network.loss = 0.0
+        self.run_until(lambda: len(server_p.received()) == 40 * rudp.MSS)
+
+    def test_resume_later(self):
+        # what arrived while we were paused is delivered on a later turn,
+        # not from inside resumeProducing()
+        network = Network(self.clock)
+        server, client, server_p, client_p = self.connect(network)
+        server_p.transport.pauseProducing()
+        client_p.transport.write(b"one")
+        self.clock.advance(1.0)
+        self.assertEqual(server_p.data, [])
+        server_p.transport.resumeProducing()
+        self.assertEqual(server_p.data, [])
+        server_p.transport.pauseProducing()
+        server_p.transport.resumeProducing() # only one delivery is queued
+        self.clock.advance(0)
+        self.assertEqual(server_p.data, [b"one"])
+        client_p.transport.write(b"two")
+        self.run_until(lambda: len(server_p.data) == 2)
+        self.assertEqual(server_p.received(), b"onetwo")
+
+    def test_producer(self):
+        # a pull producer is asked for more as the send buffer drains
+        network = Network(self.clock)
+        server, client, server_p, client_p = self.connect(network)
+        chunks = [b"%d" % i * 50000 for i in range(10)]
+        class Producer:
+            def resumeProducing(self):
+                if chunks:
+                    client_p.transport.write(chunks.pop(0))
+                else:
+                    client_p.transport.unregisterProducer()
+            def stopProducing(self):
+                pass
+        client_p.transport.registerProducer(Producer(), False)
+        self.run_until(lambda: len(server_p.received()) == 500000)
+
+    def test_connect_timeout(self):
+        network = Network(self.clock, loss=1.0)
+        client = network.add(CLIENT)
+        results = []
+        d = client.connect(SERVER[0], SERVER[1],
+                           protocol.Factory.forProtocol(Collector))
+        d.addBoth(results.append)
+        self.run_until(lambda: results, limit=100)
+        results[0].trap(error.ConnectError)
+        self.assertEqual(client._sessions, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_refused(self):
+        # an endpoint that isn't accepting answers with RST
+        network = Network(self.clock)
+        network.add(SERVER)
+        client = network.add(CLIENT)
+        results = []
+        d = client.connect(SERVER[0], SERVER[1],
+                           protocol.Factory.forProtocol(Collector))
+        d.addBoth(results.append)
+        self.run_until(lambda: results)
+        results[0].trap(error.ConnectionRefusedError)
+
+    def test_cancel(self):
+        network = Network(self.clock, loss=1.0)
+        client = network.add(CLIENT)
+        d = client.connect(SERVER[0], SERVER[1],
+                           protocol.Factory.forProtocol(Collector))
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(client._sessions, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_peer_gone(self):
+        network = Network(self.clock)
+        server, client, server_p, client_p = self.connect(network)
+        network.loss = 1.0
+        client_p.transport.write(b"hello?")
+        self.run_until(lambda: client_p.lost)
+        client_p.lost[0].trap(error.ConnectionLost)
@@ -1,12 +1,15 @@
 from __future__ import print_function
-import os, sys, re, io, zipfile, six
+import os, sys, re, io, errno, zipfile, hashlib, six
 from twisted.trial import unittest
 from twisted.python import procutils, log
 from twisted.internet.utils import getProcessOutputAndValue
-from twisted.internet.defer import gatherResults, inlineCallbacks
+from twisted.internet import defer, error
+from twisted.internet.defer import (gatherResults, inlineCallbacks,
+                                    returnValue)
 from .. import __version__
 from .common import ServerBase
 from ..cli import runner, cmd_send, cmd_receive
+from .. import hashing
 from ..errors import TransferError, WrongPasswordError, WelcomeError
 from ..timing import DebugTiming
 
@@ -235,11 +238,14 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
 
     @inlineCallbacks
     def _do_test(self, as_subprocess=False,
-                 mode="text", addslash=False, override_filename=False):
+                 mode="text", addslash=False, override_filename=False,
+                 stripes=1, crypto_threads=False):
         assert mode in ("text", "file", "directory")
         common_args = ["--hide-progress",
                        "--relay-url", self.relayurl,
                        "--transit-helper", ""]
+        if crypto_threads:
+            common_args.append("--crypto-threads")
         code = u"1-abc"
         message = "test message"
 
@@ -247,6 +253,8 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
             "send",
             "--code", code,
             ]
+        if stripes > 1:
+            send_args.extend(["--stripes", str(stripes)])
 
         receive_args = common_args + [
             "receive",
@@ -422,6 +430,10 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
         return self._do_test(mode="file")
     def test_file_override(self):
         return self._do_test(mode="file", override_filename=True)
+    def test_file_striped(self):
+        return self._do_test(mode="file", stripes=3)
+    def test_file_crypto_threads(self):
+        return self._do_test(mode="file", crypto_threads=True)
 
     def test_directory(self):
         return self._do_test(mode="directory")
@@ -517,6 +529,313 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
         with open(fn, "r") as f:
             self.failUnlessEqual(f.read(), PRESERVE)
 
+class NoSpace(ServerBase, unittest.TestCase):
+    @inlineCallbacks
+    def test_file(self):
+        # the receiver checks for disk space before the transfer starts
+        def reserve_space(f, size):
+            raise EnvironmentError(errno.ENOSPC, "No space left on device")
+        self.patch(cmd_receive, "reserve_space", reserve_space)
+        common_args = ["--hide-progress", "--no-listen",
+                       "--relay-url", self.relayurl,
+                       "--transit-helper", ""]
+        code = u"1-abc"
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        receive_dir = self.mktemp()
+        os.mkdir(receive_dir)
+        with open(os.path.join(send_dir, "testfile"), "w") as f:
+            f.write("test message")
+
+        sargs = runner.parser.parse_args(common_args +
+                                         ["send", "--code", code, "testfile"])
+        sargs.cwd = send_dir
+        sargs.stdout = io.StringIO()
+        sargs.stderr = io.StringIO()
+        sargs.timing = DebugTiming()
+        rargs = runner.parser.parse_args(common_args +
+                                         ["receive", "--accept-file", code])
+        rargs.cwd = receive_dir
+        rargs.stdout = io.StringIO()
+        rargs.stderr = io.StringIO()
+        rargs.timing = DebugTiming()
+        send_d = cmd_send.send(sargs)
+        receive_d = cmd_receive.receive(rargs)
+
+        f = yield self.assertFailure(send_d, TransferError)
+        self.assertEqual(str(f), "remote error, transfer abandoned: "
+                         "not enough disk space")
+        f = yield self.assertFailure(receive_d, TransferError)
+        self.assertEqual(str(f), "not enough disk space")
+        self.failUnlessIn("Error: not enough free disk space for "
+                          "testfile.tmp", rargs.stdout.getvalue())
+        self.assertEqual(os.listdir(receive_dir), [])
+
+class FileTransferBase(ServerBase):
+    @inlineCallbacks
+    def _do_test(self, message, partial=None, extra_args=[], existing=None,
+                 send_args=[], receive_args=[]):
+        common_args = ["--hide-progress",
+                       "--relay-url", self.relayurl,
+                       "--transit-helper", ""] + extra_args
+        code = u"1-abc"
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        receive_dir = self.mktemp()
+        os.mkdir(receive_dir)
+        with open(os.path.join(send_dir, "testfile"), "wb") as f:
+            f.write(message)
+        if partial is not None:
+            # left behind by an earlier 'wormhole receive'
+            with open(os.path.join(receive_dir, "testfile.tmp"), "wb") as f:
+                f.write(partial)
+        if existing is not None:
+            # an older copy, from an earlier 'wormhole receive'
+            with open(os.path.join(receive_dir, "testfile"), "wb") as f:
+                f.write(existing)
+
+        sargs = runner.parser.parse_args(common_args +
+                                         ["send", "--code", code, "testfile"]
+                                         + send_args)
+        sargs.cwd = send_dir
+        sargs.stdout = io.StringIO()
+        sargs.stderr = io.StringIO()
+        sargs.timing = DebugTiming()
+        rargs = runner.parser.parse_args(common_args +
+                                         ["receive", "--accept-file", code]
+                                         + receive_args)
+        rargs.cwd = receive_dir
+        rargs.stdout = io.StringIO()
+        rargs.stderr = io.StringIO()
+        rargs.timing = DebugTiming()
+        send_d = cmd_send.send(sargs)
+        receive_d = cmd_receive.receive(rargs)
+        yield gatherResults([send_d, receive_d], True)
+
+        self.failUnlessEqual(sargs.stderr.getvalue(), "")
+        self.failUnlessEqual(rargs.stderr.getvalue(), "")
+        self.failUnlessIn("Confirmation received. Transfer complete.",
+                          sargs.stdout.getvalue())
+        with open(os.path.join(receive_dir, "testfile"), "rb") as f:
+            self.failUnlessEqual(f.read(), message)
+        self.sargs, self.rargs = sargs, rargs
+        offsets = [e._details["offset"] for e in sargs.timing._events
+                   if e._name == "tx file"]
+        returnValue((sargs.stdout.getvalue(), rargs.stdout.getvalue(),
+                     offsets))
+
+    def tx_hashes(self):
+        return self.tx_details("hash")
+
+    def tx_details(self, name):
+        return [e._details[name] for e in self.sargs.timing._events
+                if e._name == "tx file"]
+
+    def rx_details(self, name):
+        return [e._details.get(name) for e in self.rargs.timing._events
+                if e._name == "rx file"]
+
+class Resume(FileTransferBase, unittest.TestCase):
+    @inlineCallbacks
+    def test_partial(self):
+        message = os.urandom(100000)
+        send_stdout, receive_stdout, offsets = yield self._do_test(
+            message, partial=message[:30000])
+        self.failUnlessIn("Found 30000 bytes from an earlier attempt",
+                          receive_stdout)
+        self.assertEqual(offsets, [30000])
+
+    @inlineCallbacks
+    def test_partial_mismatch(self):
+        message = os.urandom(100000)
+        send_stdout, receive_stdout, offsets = yield self._do_test(
+            message, partial=b"something else")
+        self.assertEqual(offsets, [0])
+
+    @inlineCallbacks
+    def test_partial_too_big(self):
+        message = os.urandom(1000)
+        send_stdout, receive_stdout, offsets = yield self._do_test(
+            message, partial=message*2)
+        self.failIfIn("from an earlier attempt", receive_stdout)
+        self.assertEqual(offsets, [0])
+
+    @inlineCallbacks
+    def test_dropped(self):
+        # cut the first connection as soon as some data has arrived: both
+        # sides should set up a new one and finish the file over that
+        receive_data = cmd_receive.TwistedReceiver._receive_data
+        dropped = []
+        def _receive_data(receiver, record_pipe, f):
+            if not dropped:
+                dropped.append(record_pipe)
+                writeToFile = record_pipe.writeToFile
+                def _write(f, expected, progress, hasher, **kwargs):
+                    def _progress(size):
+                        progress(size)
+                        record_pipe.transport.loseConnection()
+                    return writeToFile(f, expected, _progress, hasher,
+                                       **kwargs)
+                record_pipe.writeToFile = _write
+            return receive_data(receiver, record_pipe, f)
+        self.patch(cmd_receive.TwistedReceiver, "_receive_data",
+                   _receive_data)
+
+        message = os.urandom(4*1000*1000)
+        send_stdout, receive_stdout, offsets = yield self._do_test(message)
+        self.failUnlessIn("Connection dropped, waiting for the receiver "
+                          "to resume..", send_stdout)
+        self.failUnlessIn("Connection dropped, resuming at byte",
+                          receive_stdout)
+        self.assertEqual(len(offsets), 2)
+        self.assertEqual(offsets[0], 0)
+        self.assertTrue(0 < offsets[1] < len(message), offsets)
+
+    @inlineCallbacks
+    def test_dropped_striped(self):
+        # when one stripe is cut, the others must be hung up before the
+        # transfer resumes over a new connection
+        receive_data = cmd_receive.TwistedReceiver._receive_data
+        dropped = []
+        def _receive_data(receiver, record_pipe, f):
+            if not dropped:
+                dropped.append(record_pipe)
+                writeToFile = record_pipe.writeToFile
+                def _write(f, expected, progress, hasher, **kwargs):
+                    def _progress(size):
+                        progress(size)
+                        record_pipe._connections[0].transport.loseConnection()
+                    return writeToFile(f, expected, _progress, hasher,
+                                       **kwargs)
+                record_pipe.writeToFile = _write
+            return receive_data(receiver, record_pipe, f)
+        self.patch(cmd_receive.TwistedReceiver, "_receive_data",
+                   _receive_data)
+
+        message = os.urandom(4*1000*1000)
+        _, _, offsets = yield self._do_test(message,
+                                            send_args=["--stripes", "3"])
+        self.assertEqual(len(offsets), 2)
+        [striped] = dropped
+        self.assertEqual(len(striped._connections), 3)
+        for c in striped._connections:
+            self.assertTrue(c._lost)
+
+class Hashes(FileTransferBase, unittest.TestCase):
+    @inlineCallbacks
+    def test_blake2b(self):
+        if not hasattr(hashlib, "blake2b"):
+            raise unittest.SkipTest("no blake2b in this hashlib")
+        self.patch(hashing, "_preferred", [u"blake2b", u"sha256"])
+        yield self._do_test(os.urandom(100000))
+        self.assertEqual(self.tx_hashes(), [u"blake2b"])
+
+    @inlineCallbacks
+    def test_old_sender(self):
+        # a sender that doesn't offer hashes-v1 gets sha256
+        build_offer = cmd_send.Sender._build_offer
+        def _build_offer(sender):
+            offer, fd_to_send = build_offer(sender)
+            del offer["file"]["hashes-v1"]
+            return offer, fd_to_send
+        self.patch(cmd_send.Sender, "_build_offer", _build_offer)
+        self.patch(hashing, "_preferred", [u"blake2b", u"sha256"])
+        yield self._do_test(os.urandom(100000))
+        self.assertEqual(self.tx_hashes(), [u"sha256"])
+
+    @inlineCallbacks
+    def test_resume(self):
+        # the partial file is checked with the negotiated hash
+        self.patch(hashing, "_preferred", [u"blake2b", u"sha256"])
+        message = os.urandom(100000)
+        _, _, offsets = yield self._do_test(message, partial=message[:500])
+        self.assertEqual(offsets, [500])
+
+class Compression(FileTransferBase, unittest.TestCase):
+    @inlineCallbacks
+    def test_text(self):
+        message = "".join("line %d of a very boring log file\n" % i
+                          for i in range(100000)).encode("ascii")
+        yield self._do_test(message, extra_args=["--compress", "1"])
+        [compressed] = self.tx_details("records_compressed")
+        self.assertTrue(compressed > 0)
+        [saved] = self.tx_details("compression_saved")
+        self.assertTrue(saved > len(message) // 2, saved)
+
+    @inlineCallbacks
+    def test_random(self):
+        # after the first sample, compression turns itself off
+        message = os.urandom(4*1000*1000)
+        yield self._do_test(message, extra_args=["--compress", "1"])
+        self.assertEqual(self.tx_details("records_compressed"), [0])
+
+    @inlineCallbacks
+    def test_not_asked(self):
+        message = b"a" * 100000
+        yield self._do_test(message)
+        self.assertEqual(self.tx_details("records_compressed"), [0])
+
+class Delta(FileTransferBase, unittest.TestCase):
+    def setUp(self):
+        self.old = os.urandom(500000)
+        # an insertion, a deletion, and a change of length
+        self.new = (self.old[:1000] + b"new stuff" + self.old[1000:300000]
+                    + self.old[310000:] + b"more")
+        return FileTransferBase.setUp(self)
+
+    @inlineCallbacks
+    def test_delta(self):
+        send_stdout, receive_stdout, offsets = yield self._do_test(
+            self.new, existing=self.old, receive_args=["--delta"])
+        self.failUnlessIn("Updating existing file testfile", receive_stdout)
+        self.failUnlessIn("Receiving changes", receive_stdout)
+        self.assertEqual(self.tx_details("delta"), [True])
+        [copied] = self.rx_details("delta_copied")
+        [literal] = self.rx_details("delta_literal")
+        self.assertEqual(copied + literal, len(self.new))
+        # a block is 1KiB here, so each change costs at most two of them
+        self.assertTrue(literal < 3*2**11, literal)
+        self.assertEqual(self.tx_details("delta_literal"), [literal])
+
+    @inlineCallbacks
+    def test_old_sender(self):
+        # a sender that can't do deltas just sends the whole file
+        build_offer = cmd_send.Sender._build_offer
+        def _build_offer(sender):
+            offer, fd_to_send = build_offer(sender)
+            del offer["file"]["delta-v1"]
+            return offer, fd_to_send
+        self.patch(cmd_send.Sender, "_build_offer", _build_offer)
+        yield self._do_test(self.new, existing=self.old,
+                            receive_args=["--delta"])
+        self.assertEqual(self.rx_details("delta"), [None])
+
+    @inlineCallbacks
+    def test_dropped(self):
+        # the delta connection drops: the rest is resumed in full
+        receive_delta = cmd_receive.TwistedReceiver._receive_delta
+        def _receive_delta(receiver, record_pipe, f):
+            receive_record = record_pipe.receive_record
+            records = []
+            def _receive_record():
+                records.append(None)
+                if len(records) == 3:
+                    # by now the sender has sent everything, and it's all
+                    # waiting for us: pretend it was lost in transit
+                    record_pipe.transport.loseConnection()
+                    return defer.fail(error.ConnectionLost())
+                return receive_record()
+            record_pipe.receive_record = _receive_record
+            return receive_delta(receiver, record_pipe, f)
+        self.patch(cmd_receive.TwistedReceiver, "_receive_delta",
+                   _receive_delta)
+        send_stdout, receive_stdout, offsets = yield self._do_test(
+            self.new, existing=self.old, receive_args=["--delta"])
+        self.failUnlessIn("Connection dropped, resuming at byte",
+                          receive_stdout)
+        self.assertEqual(self.rx_details("delta"), [True, None])
+        self.assertEqual(len(offsets), 2)
+
 class NotWelcome(ServerBase, unittest.TestCase):
     def setUp(self):
         self._setup_relay(error=u"please upgrade XYZ")
@@ -1,13 +1,18 @@
 from __future__ import print_function
-import io
+import io, os, gc, mmap, zlib, shutil, socket, tempfile
+import six
 from binascii import hexlify, unhexlify
 from twisted.trial import unittest
-from twisted.internet import defer, task, endpoints, protocol, address, error
+from twisted.internet import (reactor, defer, task, endpoints, protocol,
+                              address, error, interfaces)
 from twisted.internet.defer import gatherResults, inlineCallbacks
 from twisted.python import log, failure
 from twisted.test import proto_helpers
-from .. import transit
+from twisted.protocols import basic
+from .. import transit, compression, ipaddrs
 from ..errors import UsageError
+from ..timing import DebugTiming
+from ..route_cache import RouteCache
 from nacl.secret import SecretBox
 from nacl.exceptions import CryptoError
 
@@ -122,6 +127,19 @@ class Forever(unittest.TestCase):
         self.assertIsInstance(result[0].value, defer.CancelledError)
         self.assertNot(clock.getDelayedCalls())
 
+def ipv6_loopback():
+    if not socket.has_ipv6:
+        return False
+    try:
+        s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        try:
+            s.bind(("::1", 0))
+        finally:
+            s.close()
+    except socket.error:
+        return False
+    return True
+
 class Misc(unittest.TestCase):
     def test_allocate_port(self):
         portno = transit.allocate_tcp_port()
@@ -135,6 +153,24 @@ class Hints(unittest.TestCase):
         ep = c._endpoint_from_hint_obj("unknown:stuff:yowza:pivlor")
         self.assertEqual(ep, None)
 
+    def test_classify(self):
+        def classify(hostname):
+            hint = transit.DirectTCPV1Hint(hostname, 1234)
+            return transit.classify_hint_obj(hint, ["127.0.0.1",
+                                                    "192.168.1.5"])
+        self.assertEqual(classify(u"127.0.0.1"), transit.ADDR_LOOPBACK)
+        self.assertEqual(classify(u"::1"), transit.ADDR_LOOPBACK)
+        self.assertEqual(classify(u"192.168.1.20"), transit.ADDR_SAME_SUBNET)
+        self.assertEqual(classify(u"192.168.2.20"), transit.ADDR_PRIVATE)
+        self.assertEqual(classify(u"10.0.0.1"), transit.ADDR_PRIVATE)
+        self.assertEqual(classify(u"172.20.0.1"), transit.ADDR_PRIVATE)
+        self.assertEqual(classify(u"fe80::1"), transit.ADDR_PRIVATE)
+        self.assertEqual(classify(u"172.32.0.1"), transit.ADDR_PUBLIC)
+        self.assertEqual(classify(u"8.8.8.8"), transit.ADDR_PUBLIC)
+        self.assertEqual(classify(u"fdomain.example"), transit.ADDR_PUBLIC)
+        tor = transit.TorTCPV1Hint(u"abc.onion", 80)
+        self.assertEqual(transit.classify_hint_obj(tor), transit.ADDR_PUBLIC)
+
 
 class Basic(unittest.TestCase):
     @inlineCallbacks
@@ -155,13 +191,127 @@ class Basic(unittest.TestCase):
         hints = yield c.get_connection_hints()
         self.assertEqual(hints, [])
 
+    def test_ipv6_hints(self):
+        c = transit.Common(u"")
+        c.add_connection_hints([
+            {u"type": u"direct-tcp-v1", u"hostname": u"::1", u"port": 1},
+            {u"type": u"direct-tcp-v1", u"hostname": u"[FD00::0002]",
+             u"port": 2},
+            {u"type": u"direct-tcp-v1", u"hostname": u"fd00::zz", u"port": 3},
+            ])
+        self.assertEqual(c._their_direct_hints,
+                         [transit.DirectTCPV1Hint(u"::1", 1),
+                          transit.DirectTCPV1Hint(u"fd00::2", 2)])
+        self.assertEqual(transit.describe_hint_obj(c._their_direct_hints[1]),
+                         u"tcp:[fd00::2]:2")
+        self.assertEqual(transit.parse_hint_argv(u"tcp:[::1]:4001"),
+                         transit.DirectTCPV1Hint(u"::1", 4001))
+        self.assertEqual(transit.parse_hint_argv(u"tcp:::1:4001"),
+                         transit.DirectTCPV1Hint(u"::1", 4001))
+
     def test_ignore_bad_hints(self):
         c = transit.Common(u"")
         c.add_connection_hints([{"type": "unknown"}])
         c.add_connection_hints([{"type": "relay-v1",
                                  "hints": [{"type": "unknown"}]}])
         self.assertEqual(c._their_direct_hints, [])
-        self.assertEqual(c._their_relay_hints, [])
+        self.assertEqual(c._their_relays, [])
+
+    def test_unix_hints(self):
+        c = transit.Common(u"")
+        good = {u"type": u"unix-v1", u"hostname": u"box",
+                u"path": u"/nonexistent/transit.sock"}
+        c.add_connection_hints([good,
+                                {u"type": u"unix-v1", u"hostname": u"box",
+                                 u"path": u"relative.sock"},
+                                {u"type": u"unix-v1", u"path": u"/a.sock"}])
+        hint = transit.UnixV1Hint(u"box", u"/nonexistent/transit.sock")
+        self.assertEqual(c._their_direct_hints, [hint])
+        self.assertEqual(transit.describe_hint_obj(hint),
+                         u"unix:/nonexistent/transit.sock")
+        self.assertEqual(transit.classify_hint_obj(hint),
+                         transit.ADDR_LOOPBACK)
+        # a path that isn't a socket here belongs to some other host
+        self.assertEqual(c._endpoint_from_hint_obj(hint), None)
+        if not interfaces.IReactorUNIX.providedBy(reactor):
+            return
+        socket_dir = six.u(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, socket_dir)
+        name = u"wormhole-transit-0123456789abcdef.sock"
+        path = os.path.join(socket_dir, name)
+        lp = reactor.listenUNIX(path, protocol.Factory())
+        self.addCleanup(lp.stopListening)
+        ours = transit.UnixV1Hint(u"box", path)
+        # we only connect to sockets if we'd make them ourselves
+        self.assertEqual(c._endpoint_from_hint_obj(ours), None)
+        c = transit.Common(u"", unix_socket_dir=socket_dir)
+        ep = c._endpoint_from_hint_obj(ours)
+        self.assertIsInstance(ep, endpoints.UNIXClientEndpoint)
+
+        # and only to the ones that _listen_unix() would make
+        other_dir = six.u(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, other_dir)
+        for (d, n) in [(socket_dir, u"docker.sock"),
+                       (socket_dir, u"wormhole-transit-x.sock"),
+                       (other_dir, name)]:
+            other = os.path.join(d, n)
+            lp = reactor.listenUNIX(other, protocol.Factory())
+            self.addCleanup(lp.stopListening)
+            self.assertEqual(c._endpoint_from_hint_obj(
+                transit.UnixV1Hint(u"box", other)), None)
+        c._their_direct_hints = [hint]
+
+        # they go first, whatever else we know
+        tcp = transit.DirectTCPV1Hint(u"127.0.0.1", 1234)
+        c._their_direct_hints.insert(0, tcp)
+        self.assertEqual(c._sorted_direct_hints(), [hint, tcp])
+
+    def test_relay_hints_separate(self):
+        c = transit.Common(u"")
+        relay1 = {u"type": u"relay-v1",
+                  u"hints": [{u"type": u"direct-tcp-v1",
+                              u"hostname": u"relay1", u"port": 4001},
+                             {u"type": u"direct-tcp-v1",
+                              u"hostname": u"10.0.0.1", u"port": 4001}]}
+        relay2 = {u"type": u"relay-v1",
+                  u"hints": [{u"type": u"direct-tcp-v1",
+                              u"hostname": u"relay2", u"port": 4001}]}
+        c.add_connection_hints([relay1, relay2, relay1])
+        self.assertEqual(c._their_relays, [
+            transit.RelayV1Hint((transit.DirectTCPV1Hint(u"relay1", 4001),
+                                 transit.DirectTCPV1Hint(u"10.0.0.1", 4001))),
+            transit.RelayV1Hint((transit.DirectTCPV1Hint(u"relay2", 4001),)),
+            ])
+
+    def test_record_size(self):
+        c = transit.Common(u"", no_listen=True)
+        abilities = c.get_connection_abilities()
+        self.assertIn({u"type": u"record-size-v1",
+                       u"max": c.MAX_RECORD_SIZE}, abilities)
+        # peers that don't mention record sizes get the old 16KiB records
+        c.add_connection_abilities([{u"type": u"direct-tcp-v1"},
+                                    {u"type": u"relay-v1"}])
+        self.assertEqual(c.get_record_size(), 2**14)
+        c.add_connection_abilities([{u"type": u"record-size-v1",
+                                     u"max": u"big"}])
+        self.assertEqual(c.get_record_size(), 2**14)
+        c.add_connection_abilities([{u"type": u"record-size-v1",
+                                     u"max": 2**15}])
+        self.assertEqual(c.get_record_size(), 2**15)
+        c.add_connection_abilities([{u"type": u"record-size-v1",
+                                     u"max": 2**30}])
+        self.assertEqual(c.get_record_size(), c.MAX_RECORD_SIZE)
+
+    def test_compression(self):
+        c = transit.Common(u"", no_listen=True)
+        self.assertIn({u"type": u"compress-v1", u"methods": [u"zlib"]},
+                      c.get_connection_abilities())
+        c.add_connection_abilities([{u"type": u"compress-v1",
+                                     u"methods": [u"lz4"]}])
+        self.assertEqual(c._their_compression, False)
+        c.add_connection_abilities([{u"type": u"compress-v1",
+                                     u"methods": [u"lz4", u"zlib"]}])
+        self.assertEqual(c._their_compression, True)
 
     def test_transit_key_wait(self):
         KEY = b"123"
@@ -222,7 +372,40 @@ class Listener(unittest.TestCase):
         self.assertIsInstance(hints, (list, set))
         if hints:
             self.assertIsInstance(hints[0], transit.DirectTCPV1Hint)
-        self.assertIsInstance(ep, endpoints.TCP4ServerEndpoint)
+        self.assertIsInstance(ep, transit.DualStackServerEndpoint)
+
+    @inlineCallbacks
+    def test_dual_stack(self):
+        if not ipv6_loopback():
+            raise unittest.SkipTest("no IPv6 loopback")
+        ep = transit.DualStackServerEndpoint(reactor, 0)
+        f = protocol.Factory.forProtocol(protocol.Protocol)
+        lp = yield ep.listen(f)
+        try:
+            self.assertIsInstance(lp.getHost(), address.IPv6Address)
+            port = lp.getHost().port
+            cf = protocol.Factory.forProtocol(protocol.Protocol)
+            for host in ["127.0.0.1", "::1"]:
+                p = yield endpoints.HostnameEndpoint(reactor, host,
+                                                     port).connect(cf)
+                p.transport.loseConnection()
+        finally:
+            yield lp.stopListening()
+
+    @inlineCallbacks
+    def test_ipv4_fallback(self):
+        # if we can't listen on both stacks, don't offer IPv6 hints
+        self.patch(ipaddrs, "find_addresses",
+                   lambda ipv6=False: [u"127.0.0.1", u"::1"])
+        def startListening(port):
+            raise error.CannotListenError("::", port.port, "no IPv6")
+        self.patch(transit._DualStackPort, "startListening", startListening)
+        c = transit.TransitSender(u"")
+        hints = yield c.get_connection_hints()
+        c._stop_listening()
+        self.assertEqual([h[u"hostname"] for h in hints
+                          if h[u"type"] == u"direct-tcp-v1"],
+                         [u"127.0.0.1"])
 
     def test_get_direct_hints(self):
         # this actually starts the listener
@@ -284,14 +467,21 @@ class FakeTransport:
         self._peeraddr = peeraddr
         self._buf = b""
         self._connected = True
+        self.producing = True
     def write(self, data):
         self._buf += data
+    def writeSequence(self, data):
+        self._buf += b"".join(data)
     def loseConnection(self):
         self._connected = False
         if self.signalConnectionLost:
             self.protocol.connectionLost()
     def getPeer(self):
         return self._peeraddr
+    def pauseProducing(self):
+        self.producing = False
+    def resumeProducing(self):
+        self.producing = True
 
     def read_buf(self):
         b = self._buf
@@ -325,7 +515,10 @@ class InboundConnectionFactory(unittest.TestCase):
         addr4 = address.IPv4Address("TCP", "1.2.3.4", 1234)
         self.assertEqual(f._describePeer(addr4), "<-1.2.3.4:1234")
         addr6 = address.IPv6Address("TCP", "::1", 1234)
-        self.assertEqual(f._describePeer(addr6), "<-::1:1234")
+        self.assertEqual(f._describePeer(addr6), "<-[::1]:1234")
+        # IPv4 clients of a dual-stack listener show up as mapped addresses
+        addr46 = address.IPv6Address("TCP", "::ffff:1.2.3.4", 1234)
+        self.assertEqual(f._describePeer(addr46), "<-1.2.3.4:1234")
         addrU = address.UNIXAddress("/dev/unlikely")
         self.assertEqual(f._describePeer(addrU),
                          "<-UNIXAddress('/dev/unlikely')")
@@ -419,8 +612,11 @@ class InboundConnectionFactory(unittest.TestCase):
 
         log.msg("=== note: the next RandomError is expected ===")
         # Make sure the Deferred has gone out of scope, so the UnhandledError
-        # happens quickly. We must manually break the gc cycle.
+        # happens quickly. We must manually break the gc cycle, and collect
+        # the Deferred (which references itself through its _remove
+        # callback) now rather than during some later test.
         del p1._d
+        gc.collect()
         self.flushLoggedErrors(RandomError)
         log.msg("=== note: the preceding RandomError was expected ===")
 
@@ -473,10 +669,14 @@ class OutboundConnectionFactory(unittest.TestCase):
 
 class MockOwner:
     _connection_ready_called = False
+    _hold = False
     def connection_ready(self, connection):
         self._connection_ready_called = True
         self._connection = connection
         return self._state
+    def connection_negotiated(self, connection):
+        if self._hold:
+            connection.hold_records()
     def _send_this(self):
         return b"send_this"
     def _expect_this(self):
@@ -486,6 +686,26 @@ class MockOwner:
     def _receiver_record_key(self):
         return b"r"*32
 
+class FakeReactor:
+    # enough of a reactor for threads.deferToThreadPool()
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+class FakeThreadPool:
+    # jobs only run when the test says so, in whatever order it likes
+    def __init__(self):
+        self.jobs = []
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        self.jobs.append((onResult, f, args, kwargs))
+    def run(self, index):
+        onResult, f, args, kwargs = self.jobs.pop(index)
+        try:
+            result = f(*args, **kwargs)
+        except Exception:
+            onResult(False, failure.Failure())
+        else:
+            onResult(True, result)
+
 class MockFactory:
     _connectionWasMade_called = False
     def connectionWasMade(self, p):
@@ -913,6 +1133,33 @@ class Connection(unittest.TestCase):
         c.dataReceived(r5+r6)
         self.assertEqual(inbound_records, [RECORD5, RECORD6])
 
+    def test_records_burst(self):
+        # many records arriving in a single chunk should all be delivered,
+        # and only the trailing partial record should remain buffered
+        t, c, owner = self.make_connection()
+
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        send_box = SecretBox(owner._receiver_record_key())
+
+        records = [("record%d" % i).encode("ascii") for i in range(100)]
+        wire = b""
+        for i, r in enumerate(records):
+            encrypted = send_box.encrypt(r, unhexlify("%048x" % i))
+            wire += unhexlify("%08x" % len(encrypted)) + encrypted
+        RECORD = b"the last one"
+        encrypted = send_box.encrypt(RECORD, unhexlify("%048x" % 100))
+        last = unhexlify("%08x" % len(encrypted)) + encrypted
+
+        c.dataReceived(wire + last[:10])
+        self.assertEqual(inbound_records, records)
+        self.assertEqual(bytes(c.buf), last[:10])
+        self.assertEqual(c._buf_offset, 0)
+
+        c.dataReceived(last[10:])
+        self.assertEqual(inbound_records, records + [RECORD])
+        self.assertEqual(bytes(c.buf), b"")
+
     def corrupt(self, orig):
         last_byte = orig[-1:]
         num = int(hexlify(last_byte).decode("ascii"), 16)
@@ -1006,6 +1253,18 @@ class Connection(unittest.TestCase):
         self.assertIsInstance(f, failure.Failure)
         self.assertIsInstance(f.value, error.ConnectionClosed)
 
+    def test_receive_lost(self):
+        # if the other side goes away, pending reads must not hang
+        c = transit.Connection(None, None, None, "description")
+        c._negotiation_d.addErrback(lambda err: None) # eat it
+        c.transport = proto_helpers.StringTransport()
+        results = []
+        c.receive_record().addBoth(results.append)
+        c.connectionLost()
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], failure.Failure)
+        self.assertIsInstance(results[0].value, error.ConnectionClosed)
+
     def test_producer(self):
         # a Transit object (receiving data from the remote peer) produces
         # data and writes it into a local Consumer
@@ -1037,6 +1296,159 @@ class Connection(unittest.TestCase):
         c.stopProducing()
         self.assertEqual(c.transport.producerState, "stopped")
 
+    def test_inbound_queue_limit(self):
+        # records that nobody reads pause the transport once enough of them
+        # are queued, and reading them resumes it
+        c = transit.Connection(None, None, None, "description")
+        c.transport = proto_helpers.StringTransport()
+        c.set_inbound_queue_size(16)
+        for i in range(3):
+            c.recordReceived(b"abcd")
+            self.assertEqual(c.transport.producerState, "producing")
+        c.recordReceived(b"abcd")
+        self.assertEqual(c.transport.producerState, "paused")
+        # the transport may still deliver what it already read, but all of
+        # it is kept, and the queue only grows by that much
+        c.recordReceived(b"efgh")
+        self.assertEqual(c._inbound_size, 20)
+        self.assertEqual(c.get_stats()["queue_pauses"], 1)
+
+        results = []
+        c.receive_record().addBoth(results.append)
+        self.assertEqual(c.transport.producerState, "paused")
+        c.receive_record().addBoth(results.append)
+        self.assertEqual(c.transport.producerState, "producing")
+        self.assertEqual(c._inbound_size, 12)
+
+        # a waiting reader takes a record before it is ever queued
+        for i in range(4):
+            c.receive_record().addBoth(results.append)
+        for i in range(4):
+            c.recordReceived(b"ijkl")
+        self.assertEqual(c.transport.producerState, "producing")
+        self.assertEqual(results, [b"abcd"]*4 + [b"efgh", b"ijkl"])
+        self.assertEqual(c._inbound_size, 12)
+        self.assertEqual(c.get_stats()["queue_pauses"], 1)
+
+    def test_inbound_queue_limit_consumer(self):
+        # a paused consumer and a full queue both keep the transport paused
+        c = transit.Connection(None, None, None, "description")
+        c.transport = proto_helpers.StringTransport()
+        c.set_inbound_queue_size(4)
+        c.recordReceived(b"r1.r1.")
+        self.assertEqual(c.transport.producerState, "paused")
+
+        c.resumeProducing() # nobody has read the queue yet
+        self.assertEqual(c.transport.producerState, "paused")
+
+        consumer = proto_helpers.StringTransport()
+        c.pauseProducing()
+        c.connectConsumer(consumer) # which drains the queue ..
+        self.assertEqual(consumer.value(), b"r1.r1.")
+        # .. but StringTransport consumers don't call resumeProducing, so
+        # we're still paused on their behalf
+        self.assertEqual(c.transport.producerState, "paused")
+        c.resumeProducing()
+        self.assertEqual(c.transport.producerState, "producing")
+
+    def test_read(self):
+        c = transit.Connection(None, None, None, "description")
+        c._negotiation_d.addErrback(lambda err: None) # eat it
+        c.transport = proto_helpers.StringTransport()
+        self.assertRaises(UsageError, c.read, 0)
+        c.recordReceived(b"r1.")
+        c.recordReceived(b"")
+        c.recordReceived(b"r2.")
+        results = []
+        c.read().addBoth(results.append)
+        self.assertEqual(results, [b"r1.r2."])
+
+        # readers wait for data, skipping empty records
+        c.read(4).addBoth(results.append)
+        c.recordReceived(b"")
+        self.assertEqual(len(results), 1)
+        c.recordReceived(b"r3.")
+        c.recordReceived(b"r4.")
+        c.recordReceived(b"r5.")
+        self.assertEqual(results, [b"r1.r2.", b"r3."])
+        # a record can be split across reads
+        c.read(4).addBoth(results.append)
+        c.read(1).addBoth(results.append)
+        self.assertEqual(results[2:], [b"r4.r", b"5"])
+        c.read_chunks().addBoth(results.append)
+        self.assertEqual(results[4:], [[b"."]])
+        # and interleaved with receive_record()
+        c.recordReceived(b"r6.")
+        c.recordReceived(b"r7.")
+        c.read(2).addBoth(results.append)
+        c.receive_record().addBoth(results.append)
+        self.assertEqual(results[5:], [b"r6", b"."])
+
+        c.recordReceived(b"r8.")
+        c.connectionLost()
+        # what was queued is still available, then we get EOF
+        c.read_chunks().addBoth(results.append)
+        c.read_chunks().addBoth(results.append)
+        c.read().addBoth(results.append)
+        self.assertEqual(results[7:], [[b"r7.", b"r8."], [], b""])
+
+    def test_read_closed(self):
+        # waiting stream readers see EOF, record readers an error
+        c = transit.Connection(None, None, None, "description")
+        c._negotiation_d.addErrback(lambda err: None) # eat it
+        c.transport = proto_helpers.StringTransport()
+        results = []
+        c.read().addBoth(results.append)
+        c.read_chunks().addBoth(results.append)
+        c.receive_record().addBoth(results.append)
+        c.connectionLost()
+        self.assertEqual(results[:2], [b"", []])
+        self.assertIsInstance(results[2], failure.Failure)
+        self.assertIsInstance(results[2].value, error.ConnectionClosed)
+
+    def test_receive_record_after_lost(self):
+        # records that arrived first are still there, then it's an error
+        c = transit.Connection(None, None, None, "description")
+        c._negotiation_d.addErrback(lambda err: None) # eat it
+        c.transport = proto_helpers.StringTransport()
+        c.recordReceived(b"last")
+        c.connectionLost()
+        self.assertEqual(self.successResultOf(c.receive_record()), b"last")
+        f = self.failureResultOf(c.receive_record())
+        self.assertIsInstance(f.value, error.ConnectionClosed)
+
+    def test_read_queue_limit(self):
+        # partial reads still resume the transport
+        c = transit.Connection(None, None, None, "description")
+        c.transport = proto_helpers.StringTransport()
+        c.set_inbound_queue_size(8)
+        c.recordReceived(b"abcdefghij")
+        self.assertEqual(c.transport.producerState, "paused")
+        results = []
+        c.read(4).addBoth(results.append)
+        self.assertEqual(results, [b"abcd"])
+        self.assertEqual(c._inbound_size, 6)
+        self.assertEqual(c.transport.producerState, "producing")
+
+    def test_chunks(self):
+        c = transit.Connection(None, None, None, "description")
+        c._negotiation_d.addErrback(lambda err: None) # eat it
+        c.transport = proto_helpers.StringTransport()
+        it = c.chunks()
+        self.assertIs(it.__aiter__(), it)
+        c.recordReceived(b"r1.")
+        c.recordReceived(b"r2.")
+        results = []
+        it.__anext__().addBoth(results.append)
+        self.assertEqual(results, [b"r1.r2."])
+        it.__anext__().addBoth(results.append)
+        c.recordReceived(b"r3.")
+        self.assertEqual(results, [b"r1.r2.", b"r3."])
+        it.__anext__().addBoth(results.append)
+        c.connectionLost()
+        self.assertIsInstance(results[2], failure.Failure)
+        self.assertIsInstance(results[2].value, transit.StopAsyncIteration)
+
     def test_connectConsumer(self):
         # connectConsumer() takes an optional number of bytes to expect, and
         # fires a Deferred when that many have been written
@@ -1081,6 +1493,25 @@ class Connection(unittest.TestCase):
         self.assertIsInstance(f, failure.Failure)
         self.assertIsInstance(f.value, error.ConnectionClosed)
 
+    @inlineCallbacks
+    def test_writeToFile_threaded(self):
+        c = transit.Connection(None, None, None, "description")
+        c._negotiation_d.addErrback(lambda err: None) # eat it
+        c.transport = proto_helpers.StringTransport()
+        c.recordReceived(b"r1.")
+        f = io.BytesIO()
+        d = c.writeToFile(f, 7, reactor=reactor)
+        c.recordReceived(b"r2.")
+        c.recordReceived(b"!")
+        c.recordReceived(b"overflow")
+        received = yield d
+        # it doesn't fire until the writer thread has finished
+        self.assertEqual(received, 7)
+        self.assertEqual(f.getvalue(), b"r1.r2.!")
+        stats = c.get_stats()
+        self.assertEqual(stats["writer_queued"], 0)
+        self.assertTrue(stats["writer_batches"] >= 1)
+
     def test_writeToFile(self):
         c = transit.Connection(None, None, None, "description")
         c._negotiation_d.addErrback(lambda err: None) # eat it
@@ -1157,6 +1588,296 @@ class Connection(unittest.TestCase):
         c.unregisterProducer()
         self.assertEqual(c.transport.producer, None)
 
+    def decrypt_outbound(self, owner, data):
+        receive_box = SecretBox(owner._sender_record_key())
+        records = []
+        while data:
+            length = int(hexlify(data[:4]), 16)
+            records.append(receive_box.decrypt(data[4:4+length]))
+            data = data[4+length:]
+        return records
+
+    def test_coalesce_pull_producer(self):
+        # a pull producer (like FileSender) writes one chunk per
+        # resumeProducing(). We ask it for several, and write them together.
+        t, c, owner = self.make_connection()
+        c.transport = proto_helpers.StringTransport()
+        self.patch(transit, "OUTBOUND_BATCH_SIZE", 3*(1000+44))
+
+        fs = basic.FileSender()
+        fs.CHUNK_SIZE = 1000
+        chunks = [("%d" % i).encode("ascii") * 1000 for i in range(5)]
+        results = []
+        d = fs.beginFileTransfer(io.BytesIO(b"".join(chunks)), c)
+        d.addBoth(results.append)
+        producer = c.transport.producer
+        self.assertIsInstance(producer, transit._CoalescingProducer)
+        self.assertEqual(c.transport.value(), b"")
+
+        # the first round stops once a batch worth of records is pending
+        producer.resumeProducing()
+        self.assertEqual(self.decrypt_outbound(owner, c.transport.value()),
+                         chunks[:3])
+        stats = c.get_stats()
+        self.assertEqual((stats["records_sent"], stats["write_calls"],
+                          stats["writes_saved"]), (3, 1, 5))
+        self.assertEqual(stats["send_waits"], 0)
+        self.assertEqual(results, [])
+
+        # the second round runs out of file, which must flush the remaining
+        # records before the Deferred fires
+        def _check(res):
+            self.assertEqual(self.decrypt_outbound(owner,
+                                                   c.transport.value()),
+                             chunks)
+            return res
+        d.addCallback(_check)
+        producer.resumeProducing()
+        self.assertEqual(len(results), 1)
+        self.assertEqual(c.transport.producer, None)
+        stats = c.get_stats()
+        self.assertEqual((stats["records_sent"], stats["write_calls"],
+                          stats["writes_saved"]), (5, 2, 8))
+        # the transport asked for more once, after draining the first batch
+        self.assertEqual(stats["send_waits"], 1)
+
+        # with no producer attached, records are written right away
+        c.send_record(b"ack")
+        self.assertEqual(self.decrypt_outbound(owner, c.transport.value()),
+                         chunks + [b"ack"])
+        self.assertEqual(c.get_stats()["write_calls"], 3)
+
+    def test_stats(self):
+        t, c, owner = self.make_connection()
+        stats = c.get_stats()
+        self.assertTrue(stats["handshake_time"] >= 0)
+        self.assertNotIn("first_byte_time", stats)
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+
+        c.send_record(b"one")
+        c.send_record(b"two")
+        sent = t.read_buf()
+        send_box = SecretBox(owner._receiver_record_key())
+        wire = b""
+        for i, r in enumerate([b"three", b"four", b"five"]):
+            encrypted = send_box.encrypt(r, unhexlify("%048x" % i))
+            wire += unhexlify("%08x" % len(encrypted)) + encrypted
+        c.dataReceived(wire)
+        self.assertEqual(len(inbound_records), 3)
+
+        t.pauseProducing = t.resumeProducing = lambda: None
+        c.pauseProducing()
+        c.pauseProducing() # already paused, so not counted again
+        c.resumeProducing()
+
+        stats = c.get_stats()
+        self.assertEqual(stats["records_sent"], 2)
+        self.assertEqual(stats["bytes_sent"], len(sent))
+        self.assertEqual(stats["records_received"], 3)
+        self.assertEqual(stats["bytes_received"], len(wire))
+        self.assertEqual(stats["receive_pauses"], 1)
+        self.assertTrue(stats["first_byte_time"] >= 0)
+        for name in ("encrypt_time", "decrypt_time", "receive_pause_time"):
+            self.assertTrue(stats[name] >= 0, name)
+
+    def test_crypto_threads_send(self):
+        # batches may finish in any order, but are written in nonce order
+        t, c, owner = self.make_connection()
+        pool = FakeThreadPool()
+        c.use_crypto_threads(FakeReactor(), pool)
+
+        c.send_record(b"one")
+        c.send_record(b"two")
+        self.assertEqual(len(pool.jobs), 2)
+        self.assertEqual(t.read_buf(), b"")
+        pool.run(1)
+        self.assertEqual(t.read_buf(), b"")
+        c.close()
+        self.assertEqual(t._connected, True) # still encrypting
+        pool.run(0)
+        self.assertEqual(self.decrypt_outbound(owner, t.read_buf()),
+                         [b"one", b"two"])
+        self.assertEqual(t._connected, False)
+
+    def test_crypto_threads_encrypt_failed(self):
+        # a batch that fails to encrypt drops the connection, rather than
+        # holding up everything behind it forever
+        t, c, owner = self.make_connection()
+        pool = FakeThreadPool()
+        c.use_crypto_threads(FakeReactor(), pool)
+        def _encrypt_records(box, batch):
+            raise RandomError("boom")
+        self.patch(transit, "_encrypt_records", _encrypt_records)
+        c.send_record(b"one")
+        c.send_record(b"two")
+        pool.run(0)
+        self.assertEqual(len(self.flushLoggedErrors(RandomError)), 1)
+        self.assertEqual(t._connected, False)
+        pool.run(0)
+        self.assertEqual(len(self.flushLoggedErrors(RandomError)), 1)
+        self.assertEqual(t.read_buf(), b"")
+
+    def test_crypto_threads_receive(self):
+        t, c, owner = self.make_connection()
+        pool = FakeThreadPool()
+        c.use_crypto_threads(FakeReactor(), pool)
+        self.patch(transit, "CRYPTO_BATCH_SIZE", 1)
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+
+        send_box = SecretBox(owner._receiver_record_key())
+        wire = b""
+        for i, r in enumerate([b"one", b"two", b"three"]):
+            encrypted = send_box.encrypt(r, unhexlify("%048x" % i))
+            wire += unhexlify("%08x" % len(encrypted)) + encrypted
+        c.dataReceived(wire)
+        self.assertEqual(len(pool.jobs), 3)
+        pool.run(2)
+        pool.run(1)
+        self.assertEqual(inbound_records, [])
+        pool.run(0)
+        self.assertEqual(inbound_records, [b"one", b"two", b"three"])
+        self.assertEqual(c.get_stats()["records_received"], 3)
+
+        # a corrupt record drops the connection, just like without threads
+        encrypted = self.corrupt(send_box.encrypt(b"four",
+                                                  unhexlify("%048x" % 3)))
+        c.dataReceived(unhexlify("%08x" % len(encrypted)) + encrypted)
+        pool.run(0)
+        self.assertEqual(len(self.flushLoggedErrors(CryptoError)), 1)
+        self.assertEqual(inbound_records, [b"one", b"two", b"three"])
+        self.assertEqual(t._connected, False)
+
+    def test_crypto_threads_receive_limit(self):
+        # a stalled pool stops us reading more ciphertext from the socket
+        t, c, owner = self.make_connection()
+        pool = FakeThreadPool()
+        c.use_crypto_threads(FakeReactor(), pool)
+        self.patch(transit, "CRYPTO_BATCH_SIZE", 1)
+        self.patch(transit, "CRYPTO_MAX_INFLIGHT", 100)
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+
+        send_box = SecretBox(owner._receiver_record_key())
+        def wire(i, record):
+            encrypted = send_box.encrypt(record, unhexlify("%048x" % i))
+            return unhexlify("%08x" % len(encrypted)) + encrypted
+        c.dataReceived(wire(0, b"a"*40))
+        self.assertEqual(t.producing, True)
+        c.dataReceived(wire(1, b"b"*40))
+        self.assertEqual(t.producing, False)
+        # the consumer resuming us doesn't override that
+        c.pauseProducing()
+        c.resumeProducing()
+        self.assertEqual(t.producing, False)
+
+        pool.run(0)
+        self.assertEqual(inbound_records, [b"a"*40])
+        self.assertEqual(t.producing, True)
+        pool.run(0)
+        self.assertEqual(inbound_records, [b"a"*40, b"b"*40])
+
+    def test_compression(self):
+        t, c, owner = self.make_connection()
+        c.use_compression(6)
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        text = b"compress me " * 1000
+        c.send_record(text)
+        c.send_record(b"ack")
+        wire = self.decrypt_outbound(owner, t.read_buf())
+        self.assertEqual(wire[0][:1], compression.ZLIB)
+        self.assertEqual(wire[1], compression.RAW + b"ack")
+        self.assertEqual(c.get_stats()["records_compressed"], 1)
+
+        send_box = SecretBox(owner._receiver_record_key())
+        def wire(i, record):
+            encrypted = send_box.encrypt(record, unhexlify("%048x" % i))
+            return unhexlify("%08x" % len(encrypted)) + encrypted
+        c.dataReceived(wire(0, compression.RAW + b"one") +
+                       wire(1, compression.ZLIB + zlib.compress(text)))
+        self.assertEqual(inbound_records, [b"one", text])
+        self.assertRaises(compression.CompressionError,
+                          c.dataReceived, wire(2, b"\x02three"))
+
+    def test_hold_records(self):
+        # records that arrive right behind the "go" wait until the owner
+        # knows how to read them
+        owner = MockOwner()
+        owner._state = "wait-for-decision"
+        owner._hold = True
+        c = transit.Connection(owner, None, None, "description")
+        t = c.transport = FakeTransport(c, None)
+        c.factory = MockFactory()
+        c.connectionMade()
+        results = []
+        c.startNegotiation().addBoth(results.append)
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+
+        send_box = SecretBox(owner._receiver_record_key())
+        record = compression.ZLIB + zlib.compress(b"one")
+        encrypted = send_box.encrypt(record, unhexlify("%048x" % 0))
+        c.dataReceived(b"expect_this" + b"go\n" +
+                       unhexlify("%08x" % len(encrypted)) + encrypted)
+        self.assertEqual(results, [c])
+        self.assertEqual(inbound_records, [])
+        self.assertEqual(t.producing, False)
+        c.resumeProducing() # a consumer doesn't override the hold
+        self.assertEqual(t.producing, False)
+
+        c.use_compression()
+        c.release_records()
+        self.assertEqual(inbound_records, [b"one"])
+        self.assertEqual(t.producing, True)
+
+    def test_compression_threads(self):
+        t, c, owner = self.make_connection()
+        pool = FakeThreadPool()
+        c.use_crypto_threads(FakeReactor(), pool)
+        c.use_compression()
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+
+        c.send_record(b"one")
+        pool.run(0)
+        self.assertEqual(self.decrypt_outbound(owner, t.read_buf()),
+                         [compression.RAW + b"one"])
+
+        send_box = SecretBox(owner._receiver_record_key())
+        for i, r in enumerate([compression.ZLIB + zlib.compress(b"two"),
+                               compression.ZLIB + b"garbage"]):
+            encrypted = send_box.encrypt(r, unhexlify("%048x" % i))
+            c.dataReceived(unhexlify("%08x" % len(encrypted)) + encrypted)
+            pool.run(0)
+        self.assertEqual(inbound_records, [b"two"])
+        self.assertEqual(
+            len(self.flushLoggedErrors(compression.CompressionError)), 1)
+        self.assertEqual(t._connected, False)
+
+    def test_crypto_threads_lost(self):
+        # records decrypted after the connection is lost are still delivered
+        # before the consumer is told about it
+        t, c, owner = self.make_connection()
+        pool = FakeThreadPool()
+        c.use_crypto_threads(FakeReactor(), pool)
+        consumer = proto_helpers.StringTransport()
+        results = []
+        d = c.connectConsumer(consumer, expected=10)
+        d.addBoth(results.append)
+
+        send_box = SecretBox(owner._receiver_record_key())
+        encrypted = send_box.encrypt(b"12345", unhexlify("%048x" % 0))
+        c.dataReceived(unhexlify("%08x" % len(encrypted)) + encrypted)
+        c.connectionLost()
+        self.assertEqual(results, [])
+        pool.run(0)
+        self.assertEqual(consumer.value(), b"12345")
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], failure.Failure)
+        results[0].trap(error.ConnectionClosed)
+
 class FileConsumer(unittest.TestCase):
     def test_basic(self):
         f = io.BytesIO()
@@ -1172,6 +1893,297 @@ class FileConsumer(unittest.TestCase):
         self.assertEqual(f.getvalue(), b"."*99+b"!")
 
 
+class ThreadedFileConsumer(unittest.TestCase):
+    def make(self, f):
+        self.pool = FakeThreadPool()
+        self.progress = []
+        self.hashed = []
+        self.producer = proto_helpers.StringTransport()
+        fc = transit.ThreadedFileConsumer(f, FakeReactor(),
+                                          self.progress.append,
+                                          self.hashed.append,
+                                          threadpool=self.pool,
+                                          high_water=10, low_water=4)
+        fc.registerProducer(self.producer, True)
+        return fc
+
+    def test_watermarks(self):
+        f = io.BytesIO()
+        fc = self.make(f)
+        fc.write(b"abcdef") # goes straight to the thread
+        self.assertEqual(len(self.pool.jobs), 1)
+        fc.write(b"ghi")
+        self.assertEqual(self.producer.producerState, "producing")
+        fc.write(b"jk") # 11 bytes queued
+        self.assertEqual(self.producer.producerState, "paused")
+        self.assertEqual(self.hashed, [b"abcdef", b"ghi", b"jk"])
+        self.assertEqual(len(self.pool.jobs), 1) # one batch at a time
+
+        self.pool.run(0)
+        self.assertEqual(f.getvalue(), b"abcdef")
+        self.assertEqual(self.progress, [6])
+        # 5 bytes are still queued, above the low-water mark
+        self.assertEqual(self.producer.producerState, "paused")
+        self.assertEqual(len(self.pool.jobs), 1)
+
+        drained = []
+        fc.drain().addBoth(drained.append)
+        self.pool.run(0)
+        self.assertEqual(f.getvalue(), b"abcdefghijk")
+        self.assertEqual(self.progress, [6, 5])
+        self.assertEqual(self.producer.producerState, "producing")
+        self.assertEqual(drained, [None])
+        self.assertEqual(fc.get_stats(), {"writer_queued": 0,
+                                          "writer_max_queued": 11,
+                                          "writer_pauses": 1,
+                                          "writer_batches": 2,
+                                          })
+
+    def test_positional(self):
+        # regular files are written with pwrite(), from where 'f' was left
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(b"already here.")
+        with open(fn, "r+b") as f:
+            f.seek(0, 2)
+            fc = self.make(f)
+            fc.write(b"one.")
+            fc.write(b"two.")
+            self.pool.run(0)
+            fc.write(b"three.")
+            fc.unregisterProducer()
+            closed = []
+            fc.close().addBoth(closed.append)
+            while self.pool.jobs:
+                self.pool.run(0)
+            self.assertEqual(closed, [None])
+            self.assertEqual(f.tell(), 27)
+        with open(fn, "rb") as f:
+            self.assertEqual(f.read(), b"already here.one.two.three.")
+
+    def test_unregister_while_paused(self):
+        fc = self.make(io.BytesIO())
+        fc.write(b"x"*20)
+        self.assertEqual(self.producer.producerState, "paused")
+        fc.unregisterProducer()
+        self.assertEqual(self.producer.producerState, "producing")
+        drained = []
+        fc.close().addBoth(drained.append)
+        self.assertEqual(drained, [])
+        self.pool.run(0)
+        self.assertEqual(drained, [None])
+
+    def test_write_failed(self):
+        class BrokenFile(io.BytesIO):
+            def write(self, data):
+                raise IOError("disk full")
+        fc = self.make(BrokenFile())
+        fc.write(b"data")
+        fc.write(b"more")
+        self.pool.run(0)
+        self.assertEqual(self.producer.producerState, "stopped")
+        fc.write(b"ignored")
+        self.assertEqual(self.pool.jobs, [])
+        drained = []
+        fc.drain().addBoth(drained.append)
+        self.assertIsInstance(drained[0], failure.Failure)
+        self.assertIsInstance(drained[0].value, IOError)
+
+
+class FileProducer(unittest.TestCase):
+    def test_basic(self):
+        f = io.BytesIO(b"."*250)
+        consumer = proto_helpers.StringTransport()
+        transformed = []
+        def _transform(data):
+            transformed.append(data)
+            return data.upper()
+        fp = transit.FileProducer(100)
+        results = []
+        d = fp.beginFileTransfer(f, consumer, _transform)
+        d.addBoth(results.append)
+        self.assertIs(consumer.producer, fp)
+        self.assertFalse(consumer.streaming)
+
+        fp.resumeProducing()
+        self.assertEqual(transformed, [b"."*100])
+        fp.resumeProducing()
+        fp.resumeProducing()
+        self.assertEqual(transformed, [b"."*100, b"."*100, b"."*50])
+        self.assertEqual(consumer.value(), b"."*250)
+        self.assertEqual(results, [])
+
+        fp.resumeProducing()
+        self.assertEqual(results, [None])
+        self.assertIs(consumer.producer, None)
+
+    def test_stop(self):
+        consumer = proto_helpers.StringTransport()
+        fp = transit.FileProducer()
+        results = []
+        d = fp.beginFileTransfer(io.BytesIO(b"data"), consumer)
+        d.addBoth(results.append)
+        fp.stopProducing()
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], failure.Failure)
+        self.assertIsInstance(results[0].value, transit.TransitClosed)
+
+    def test_deferred_reads(self):
+        # a file whose read() returns a Deferred is waited for
+        reads = []
+        class SlowFile:
+            def read(self, size):
+                d = defer.Deferred()
+                reads.append(d)
+                return d
+        consumer = proto_helpers.StringTransport()
+        fp = transit.FileProducer()
+        results = []
+        fp.beginFileTransfer(SlowFile(), consumer).addBoth(results.append)
+        fp.resumeProducing()
+        fp.resumeProducing() # still waiting for the first read
+        self.assertEqual(len(reads), 1)
+        reads[0].callback(b"one")
+        self.assertEqual(consumer.value(), b"one")
+        fp.resumeProducing()
+        reads[1].callback(b"")
+        self.assertEqual(results, [None])
+        self.assertIs(consumer.producer, None)
+
+        fp = transit.FileProducer()
+        fp.beginFileTransfer(SlowFile(), consumer).addBoth(results.append)
+        fp.resumeProducing()
+        reads[2].errback(RandomError("disk on fire"))
+        self.assertIsInstance(results[1].value, RandomError)
+        self.assertIs(consumer.producer, None)
+
+    def send_file(self, f, record_size):
+        consumer = proto_helpers.StringTransport()
+        fp = transit.FileProducer(record_size)
+        results = []
+        fp.beginFileTransfer(f, consumer).addBoth(results.append)
+        while not results:
+            fp.resumeProducing()
+        self.assertEqual(results, [None])
+        return consumer.value()
+
+    def test_mapped(self):
+        # regular files are read through a small sliding window, starting
+        # from wherever the file was left (as when resuming a transfer)
+        granularity = mmap.ALLOCATIONGRANULARITY
+        self.patch(transit, "MAP_WINDOW", granularity)
+        data = os.urandom(3*granularity + 100)
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(data)
+        with open(fn, "rb") as f:
+            f.seek(1000)
+            self.assertEqual(self.send_file(f, 999), data[1000:])
+            self.assertEqual(f.tell(), len(data))
+        with open(fn, "rb") as f:
+            self.assertEqual(self.send_file(f, 2*granularity+1), data)
+
+    def test_not_mapped(self):
+        f = tempfile.SpooledTemporaryFile()
+        f.write(b"spooled data")
+        f.seek(0)
+        self.assertEqual(self.send_file(f, 5), b"spooled data")
+        self.assertFalse(f._rolled)
+
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            pass
+        with open(fn, "rb") as f:
+            self.assertEqual(self.send_file(f, 5), b"")
+
+
+class Striped(unittest.TestCase):
+    def make_stripe(self):
+        c = transit.Connection(None, None, None, "description")
+        c._negotiation_d.addErrback(lambda err: None) # eat it
+        c.transport = proto_helpers.StringTransport()
+        return c
+
+    def record(self, seqnum, data):
+        return unhexlify("%016x" % seqnum) + data
+
+    def test_reorder(self):
+        c1 = self.make_stripe()
+        c2 = self.make_stripe()
+        sc = transit.StripedConnection([c1, c2])
+        self.assertEqual(sc.describe(), "striped: description, description")
+        c1.recordReceived(self.record(0, b"r0."))
+
+        f = io.BytesIO()
+        results = []
+        d = sc.writeToFile(f, 12)
+        d.addBoth(results.append)
+        self.assertEqual(f.getvalue(), b"r0.")
+
+        # records that arrive early are held until the gap is filled
+        c2.recordReceived(self.record(2, b"r2."))
+        c2.recordReceived(self.record(3, b"r3."))
+        self.assertEqual(f.getvalue(), b"r0.")
+        c1.recordReceived(self.record(1, b"r1."))
+        self.assertEqual(f.getvalue(), b"r0.r1.r2.r3.")
+        self.assertEqual(results, [12])
+
+        # both stripes are disconnected once we have everything
+        self.assertIs(c1._consumer, None)
+        self.assertIs(c2._consumer, None)
+
+    def test_duplicate(self):
+        c1 = self.make_stripe()
+        c2 = self.make_stripe()
+        sc = transit.StripedConnection([c1, c2])
+        d = sc.writeToFile(io.BytesIO(), 100)
+        c1.recordReceived(self.record(0, b"r0."))
+        self.assertRaises(transit.BadNonce,
+                          c2.recordReceived, self.record(0, b"r0."))
+        del d
+
+    def test_reorder_limit(self):
+        # a stalled stripe can't make us buffer everything the others send
+        self.patch(transit, "INBOUND_QUEUE_SIZE", 9)
+        c1 = self.make_stripe()
+        c2 = self.make_stripe()
+        sc = transit.StripedConnection([c1, c2])
+        f = io.BytesIO()
+        d = sc.writeToFile(f, 18)
+        c2.recordReceived(self.record(1, b"r1."))
+        c2.recordReceived(self.record(2, b"r2."))
+        self.assertEqual(c2.transport.producerState, "producing")
+        c2.recordReceived(self.record(3, b"r3."))
+        self.assertEqual(c2.transport.producerState, "paused")
+        self.assertEqual(c1.transport.producerState, "producing")
+        # the consumer resuming us doesn't let it run ahead any further
+        sc.pauseProducing()
+        sc.resumeProducing()
+        self.assertEqual(c2.transport.producerState, "paused")
+        self.assertEqual(c1.transport.producerState, "producing")
+
+        c1.recordReceived(self.record(0, b"r0."))
+        self.assertEqual(f.getvalue(), b"r0.r1.r2.r3.")
+        self.assertEqual(c2.transport.producerState, "producing")
+        c2.recordReceived(self.record(4, b"r4."))
+        c1.recordReceived(self.record(5, b"r5."))
+        self.assertEqual(f.getvalue(), b"r0.r1.r2.r3.r4.r5.")
+        self.assertEqual(self.successResultOf(d), 18)
+
+    def test_lost_stripe(self):
+        c1 = self.make_stripe()
+        c2 = self.make_stripe()
+        sc = transit.StripedConnection([c1, c2])
+        results = []
+        d = sc.writeToFile(io.BytesIO(), 100)
+        d.addBoth(results.append)
+        c2.connectionLost()
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], failure.Failure)
+        self.assertIsInstance(results[0].value, error.ConnectionClosed)
+        self.assertIs(c1._consumer, None)
+
+
 DIRECT_HINT = {u"type": u"direct-tcp-v1",
                u"hostname": u"direct", u"port": 1234}
 RELAY_HINT = {u"type": u"relay-v1",
@@ -1184,7 +2196,16 @@ RELAY_HINT2 = {u"type": u"relay-v1",
                           UNUSABLE_HINT]}
 DIRECT_HINT_INTERNAL = transit.DirectTCPV1Hint(u"direct", 1234)
 RELAY_HINT_FIRST = transit.DirectTCPV1Hint(u"relay", 1234)
-RELAY_HINT_INTERNAL = transit.RelayV1Hint([RELAY_HINT_FIRST])
+RELAY_HINT_INTERNAL = transit.RelayV1Hint((RELAY_HINT_FIRST,))
+
+class FakeWinner:
+    # enough of a Connection for Common.connect() to return
+    start = None
+    released = False
+    def describe(self):
+        return u"->tcp:direct:1234"
+    def release_records(self):
+        self.released = True
 
 class Transit(unittest.TestCase):
     @inlineCallbacks
@@ -1209,8 +2230,10 @@ class Transit(unittest.TestCase):
         self.assertEqual(len(connectors), 1)
         self.assertIsInstance(connectors[0], defer.Deferred)
 
-        connectors[0].callback("winner")
-        self.assertEqual(results, ["winner"])
+        winner = FakeWinner()
+        connectors[0].callback(winner)
+        self.assertEqual(results, [winner])
+        self.assertTrue(winner.released)
 
     def _endpoint_from_hint_obj(self, hint):
         if hint == DIRECT_HINT_INTERNAL:
@@ -1256,8 +2279,220 @@ class Transit(unittest.TestCase):
         self.assertEqual(len(direct_connectors), 1)
         self.assertEqual(len(relay_connectors), 1)
 
-        direct_connectors[0].callback("winner")
-        self.assertEqual(results, ["winner"])
+        winner = FakeWinner()
+        direct_connectors[0].callback(winner)
+        self.assertEqual(results, [winner])
+
+    @inlineCallbacks
+    def test_stagger(self):
+        clock = task.Clock()
+        s = transit.TransitSender(u"", reactor=clock, no_listen=True)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints() # start the listener
+        del hints
+        s._history.hints[u"->tcp:10.0.0.2:1234"] = False
+        s.add_connection_hints([
+            {u"type": u"direct-tcp-v1", u"hostname": u"8.8.8.8",
+             u"port": 1234},
+            {u"type": u"direct-tcp-v1", u"hostname": u"10.0.0.2",
+             u"port": 1234},
+            {u"type": u"direct-tcp-v1", u"hostname": u"10.0.0.1",
+             u"port": 1234},
+            {u"type": u"direct-tcp-v1", u"hostname": u"127.0.0.1",
+             u"port": 1234},
+            ])
+
+        connectors = []
+        def _start_connector(ep, description, is_relay=False):
+            d = defer.Deferred()
+            connectors.append((description, d))
+            return d
+        s._start_connector = _start_connector
+
+        d = s.connect()
+        results = []
+        d.addBoth(results.append)
+        # loopback goes first, the others follow HINT_STAGGER apart
+        self.assertEqual([desc for (desc, _) in connectors],
+                         [u"->tcp:127.0.0.1:1234"])
+        clock.advance(s.HINT_STAGGER)
+        self.assertEqual([desc for (desc, _) in connectors],
+                         [u"->tcp:127.0.0.1:1234", u"->tcp:10.0.0.1:1234"])
+        # a failure starts the next one right away. 10.0.0.2 failed last
+        # time, so it goes to the back of the line
+        connectors[1][1].errback(error.ConnectionRefusedError())
+        self.assertEqual([desc for (desc, _) in connectors][2:],
+                         [u"->tcp:8.8.8.8:1234"])
+
+        winner = FakeWinner()
+        connectors[0][1].callback(winner)
+        self.assertEqual(results, [winner])
+        self.assertEqual(len(connectors), 3)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_attempt_timing(self):
+        # every attempt gets its own timing event, and its outcome is
+        # remembered by this Transit
+        timing = DebugTiming()
+        s = transit.TransitSender(u"", reactor=task.Clock(), timing=timing)
+        s.set_transit_key(b"key")
+        class RefusingEndpoint:
+            def connect(self, factory):
+                return defer.fail(error.ConnectionRefusedError())
+        d = s._start_connector(RefusingEndpoint(), u"->tcp:example:1234")
+        self.failureResultOf(d, error.ConnectionRefusedError)
+        attempts = [e for e in timing._events
+                    if e._name == "transit attempt"]
+        self.assertEqual(len(attempts), 1)
+        self.assertEqual(attempts[0]._details["hint"], u"->tcp:example:1234")
+        self.assertIn("refused", attempts[0]._details["result"])
+        self.assertNotEqual(attempts[0]._stop, None)
+        self.assertEqual(s._history.hints, {u"->tcp:example:1234": False})
+        # other Transits only know about it if they share the history
+        self.assertEqual(transit.TransitSender(u"")._history.hints, {})
+        s2 = transit.TransitSender(u"", history=s._history)
+        self.assertEqual(s2._history_rank(u"->tcp:example:1234"), 2)
+
+    @inlineCallbacks
+    def test_fast_failover(self):
+        # once every direct connector has failed, the relay is tried right
+        # away instead of waiting for RELAY_DELAY
+        clock = task.Clock()
+        timing = DebugTiming()
+        s = transit.TransitSender(u"", reactor=clock, no_listen=True,
+                                  timing=timing)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints() # start the listener
+        del hints
+        s.add_connection_hints([DIRECT_HINT, RELAY_HINT])
+
+        direct_connectors = []
+        relay_connectors = []
+        s._endpoint_from_hint_obj = self._endpoint_from_hint_obj
+        def _start_connector(ep, description, is_relay=False):
+            d = defer.Deferred()
+            if ep == "direct":
+                direct_connectors.append(d)
+            elif ep == "relay":
+                relay_connectors.append(d)
+            else:
+                raise ValueError
+            return d
+        s._start_connector = _start_connector
+
+        d = s.connect()
+        results = []
+        d.addBoth(results.append)
+        self.assertEqual(len(direct_connectors), 1)
+        self.assertEqual(len(relay_connectors), 0)
+
+        clock.advance(0.5)
+        direct_connectors[0].errback(error.ConnectionRefusedError())
+        self.assertEqual(len(relay_connectors), 1)
+        failovers = [e for e in timing._events
+                     if e._name == "relay failover"]
+        self.assertEqual(len(failovers), 1)
+        self.assertEqual(failovers[0]._details["saved"],
+                         s.RELAY_DELAY - 0.5)
+        # only the overall connection timeout is left
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+
+        winner = FakeWinner()
+        relay_connectors[0].callback(winner)
+        self.assertEqual(results, [winner])
+
+    @inlineCallbacks
+    def test_route_cache(self):
+        # the relay worked last time, so it isn't held back. The direct hint
+        # wins this time, and the cache is updated to say so.
+        clock = task.Clock()
+        cache = RouteCache(self.mktemp())
+        s = transit.TransitSender(u"", reactor=clock, no_listen=True,
+                                  route_cache=cache)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints() # start the listener
+        del hints
+        s.add_connection_hints([DIRECT_HINT, RELAY_HINT])
+        key = s._route_key()
+        cache.remember(key, u"relay", True, 0.5)
+
+        direct_connectors = []
+        relay_connectors = []
+        s._endpoint_from_hint_obj = self._endpoint_from_hint_obj
+        def _start_connector(ep, description, is_relay=False):
+            d = defer.Deferred()
+            if ep == "direct":
+                direct_connectors.append(d)
+            elif ep == "relay":
+                relay_connectors.append(d)
+            else:
+                raise ValueError
+            return d
+        s._start_connector = _start_connector
+
+        d = s.connect()
+        results = []
+        d.addBoth(results.append)
+        clock.advance(0)
+        self.assertEqual(len(direct_connectors), 1)
+        self.assertEqual(len(relay_connectors), 1)
+
+        winner = FakeWinner()
+        direct_connectors[0].callback(winner)
+        self.assertEqual(results, [winner])
+        route = cache.lookup(key)
+        self.assertEqual(route[u"hostname"], u"direct")
+        self.assertEqual(route[u"relay"], False)
+
+    @inlineCallbacks
+    def test_relays_by_rtt(self):
+        # our own relay and both of theirs are raced, nearest first, and
+        # each of them is one contender however many hints it has
+        clock = task.Clock()
+        s = transit.TransitSender(u"tcp:mine:4001", reactor=clock,
+                                  no_listen=True)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints()
+        del hints
+        s._history.relay_rtts.update({u"->relay:tcp:near:4001": 0.01,
+                                      u"->relay:tcp:far:4001": 0.3})
+        s.add_connection_hints([
+            {u"type": u"relay-v1",
+             u"hints": [{u"type": u"direct-tcp-v1", u"hostname": u"far",
+                         u"port": 4001}]},
+            {u"type": u"relay-v1",
+             u"hints": [{u"type": u"direct-tcp-v1", u"hostname": u"near",
+                         u"port": 4001},
+                        {u"type": u"direct-tcp-v1", u"hostname": u"near6",
+                         u"port": 4001}]},
+            ])
+        s._endpoint_from_hint_obj = lambda hint: hint.hostname
+        connectors = []
+        def _start_connector(ep, description, is_relay=False):
+            self.assertTrue(is_relay)
+            d = defer.Deferred()
+            connectors.append((ep, d))
+            return d
+        s._start_connector = _start_connector
+
+        d = s.connect()
+        results = []
+        d.addBoth(results.append)
+        clock.advance(0) # no direct hints, so no relay delay
+        self.assertEqual([ep for (ep, d) in connectors], [u"near", u"near6"])
+        # a relay that fails starts the next one right away
+        connectors[0][1].errback(error.ConnectionRefusedError())
+        connectors[1][1].errback(error.ConnectionRefusedError())
+        self.assertEqual([ep for (ep, d) in connectors[2:]], [u"far"])
+        # and a slow one lets the next start after RELAY_STAGGER
+        clock.advance(s.RELAY_STAGGER)
+        self.assertEqual([ep for (ep, d) in connectors[3:]], [u"mine"])
+
+        winner = FakeWinner()
+        connectors[3][1].callback(winner)
+        self.assertEqual(results, [winner])
+        self.assertTrue(connectors[2][1].called) # cancelled
+        self.assertEqual(clock.getDelayedCalls(), [])
 
     @inlineCallbacks
     def test_no_direct_hints(self):
@@ -1295,8 +2530,9 @@ class Transit(unittest.TestCase):
         self.assertEqual(len(direct_connectors), 0)
         self.assertEqual(len(relay_connectors), 1)
 
-        relay_connectors[0].callback("winner")
-        self.assertEqual(results, ["winner"])
+        winner = FakeWinner()
+        relay_connectors[0].callback(winner)
+        self.assertEqual(results, [winner])
 
 
 class Full(unittest.TestCase):
@@ -1330,3 +2566,146 @@ class Full(unittest.TestCase):
 
         yield x.close()
         yield y.close()
+
+    @inlineCallbacks
+    def test_ipv6(self):
+        # the receiver only gets to use the sender's ::1 hint
+        if not ipv6_loopback():
+            raise unittest.SkipTest("no IPv6 loopback")
+        KEY = b"k"*32
+        s = transit.TransitSender(None)
+        r = transit.TransitReceiver(None, no_listen=True)
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+
+        shints = yield s.get_connection_hints()
+        shints = [h for h in shints if h.get(u"hostname") == u"::1"]
+        if not shints:
+            s._stop_listening()
+            raise unittest.SkipTest("::1 is not one of our addresses")
+        rhints = yield r.get_connection_hints()
+        s.add_connection_hints(rhints)
+        r.add_connection_hints(shints)
+
+        (x,y) = yield self.doBoth(s.connect(), r.connect())
+        self.assertEqual(y.describe(), u"->tcp:[::1]:%d" % shints[0][u"port"])
+        d = y.receive_record()
+        x.send_record(b"record1")
+        record = yield d
+        self.assertEqual(record, b"record1")
+
+        yield x.close()
+        yield y.close()
+
+    @inlineCallbacks
+    def test_udp(self):
+        KEY = b"k"*32
+        s = transit.TransitSender(None, udp=True)
+        r = transit.TransitReceiver(None, udp=True)
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+
+        def udp_only(hints):
+            return [h for h in hints if h[u"type"] == u"direct-udp-v1"]
+        shints = udp_only((yield s.get_connection_hints()))
+        rhints = udp_only((yield r.get_connection_hints()))
+        if not shints:
+            s._stop_listening()
+            r._stop_listening()
+            raise unittest.SkipTest("no IPv4 addresses")
+        s.add_connection_hints(rhints)
+        r.add_connection_hints(shints)
+
+        (x,y) = yield self.doBoth(s.connect(), r.connect())
+        self.assertIn(u"udp:", x.describe() + y.describe())
+        data = os.urandom(300000)
+        for i in range(0, len(data), 10000):
+            x.send_record(data[i:i+10000])
+        received = []
+        while sum(len(chunk) for chunk in received) < len(data):
+            chunk = yield y.read()
+            received.append(chunk)
+        self.assertEqual(b"".join(received), data)
+        self.assertTrue(x.get_stats()["udp_packets_sent"] > 0)
+
+        yield x.close()
+        yield y.close()
+        # the FINs are acknowledged, then both UDP sockets close
+        while s._udp._port or r._udp._port:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+    @inlineCallbacks
+    def test_unix(self):
+        if not interfaces.IReactorUNIX.providedBy(reactor):
+            raise unittest.SkipTest("no Unix sockets")
+        KEY = b"k"*32
+        socket_dir = six.u(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, socket_dir)
+        s = transit.TransitSender(None, unix_socket_dir=socket_dir)
+        # the receiver needs the directory too, to trust a path in it
+        r = transit.TransitReceiver(None, no_listen=True,
+                                    unix_socket_dir=socket_dir)
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+        shints = yield s.get_connection_hints()
+        rhints = yield r.get_connection_hints()
+        self.assertEqual(shints[0][u"type"], u"unix-v1")
+        path = shints[0][u"path"]
+        self.assertEqual(os.path.dirname(path), socket_dir)
+        s.add_connection_hints(rhints)
+        r.add_connection_hints(shints)
+
+        # the TCP hints are there too, but the socket wins
+        (x,y) = yield self.doBoth(s.connect(), r.connect())
+        self.assertEqual(y.describe(), u"->unix:%s" % path)
+        self.assertEqual(x.describe(), u"<-unix")
+        d = y.receive_record()
+        x.send_record(b"record1")
+        record = yield d
+        self.assertEqual(record, b"record1")
+        # the listener is gone, along with its socket file
+        self.assertFalse(os.path.exists(path))
+
+        yield x.close()
+        yield y.close()
+
+    @inlineCallbacks
+    def test_striped(self):
+        senders = [transit.TransitSender(None) for i in range(3)]
+        receivers = [transit.TransitReceiver(None) for i in range(3)]
+        for i, (s, r) in enumerate(zip(senders, receivers)):
+            key = ("%d" % i).encode("ascii") * 32
+            s.set_transit_key(key)
+            r.set_transit_key(key)
+            shints = yield s.get_connection_hints()
+            rhints = yield r.get_connection_hints()
+            s.add_connection_hints(rhints)
+            r.add_connection_hints(shints)
+
+        (x,y) = yield self.doBoth(transit.connect_striped(senders),
+                                  transit.connect_striped(receivers))
+        self.assertIsInstance(x, transit.StripedConnection)
+        self.assertIsInstance(y, transit.StripedConnection)
+
+        # small batches, so the first stripe can't swallow the whole file
+        self.patch(transit, "OUTBOUND_BATCH_SIZE", 4000)
+        DATA = "".join(["%d" % i for i in range(20000)]).encode("ascii")
+        f = io.BytesIO()
+        d = y.writeToFile(f, len(DATA))
+        fp = transit.FileProducer(1000)
+        yield fp.beginFileTransfer(io.BytesIO(DATA), x)
+        received = yield d
+        self.assertEqual(received, len(DATA))
+        self.assertEqual(f.getvalue(), DATA)
+        self.assertEqual(x.get_stats()["stripes"], 3)
+        for c in x._connections:
+            self.assertNotEqual(c.get_stats()["records_sent"], 0)
+
+        # control records go over the first stripe
+        d = x.receive_record()
+        y.send_record(b"ack")
+        ack = yield d
+        self.assertEqual(ack, b"ack")
+
+        yield x.close()
+        yield y.close()
@@ -1,20 +1,26 @@
 from __future__ import print_function, absolute_import
-import re, sys, time, socket
+import os, re, sys, time, stat, mmap, socket, tempfile
 from collections import namedtuple, deque
-from binascii import hexlify, unhexlify
+from binascii import hexlify
 import six
 from zope.interface import implementer
 from twisted.python import log
 from twisted.python.runtime import platformType
+from twisted.python.threadpool import ThreadPool
 from twisted.internet import (reactor, interfaces, defer, protocol,
-                              endpoints, task, address, error)
+                              endpoints, address, error, threads, tcp)
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.protocols import policies
 from nacl.secret import SecretBox
 from hkdf import Hkdf
 from .errors import UsageError
 from .timing import DebugTiming
-from . import ipaddrs
+from .route_cache import hints_key
+from .framing import (LENGTH_SIZE, encode_length, decode_length,
+                      encode_nonce, decode_nonce, SEQNUM_SIZE, encode_seqnum,
+                      decode_seqnum)
+from . import ipaddrs, rudp
+from .compression import RecordCompressor, decompress_record
 
 def HKDF(skm, outlen, salt=None, CTXinfo=b""):
     return Hkdf(salt, skm).expand(CTXinfo, outlen)
@@ -37,6 +43,11 @@ class TransitClosed(TransitError):
 class BadNonce(TransitError):
     pass
 
+# py2 has no 'async for', but Connection.chunks() still needs something to
+# raise at the end
+StopAsyncIteration = getattr(six.moves.builtins, "StopAsyncIteration",
+                             StopIteration)
+
 # The beginning of each TCP connection consists of the following handshake
 # messages. The sender transmits the same text regardless of whether it is on
 # the initiating/connecting end of the TCP connection, or on the
@@ -91,19 +102,108 @@ def build_relay_handshake(key):
 # * the rest of the connection contains transit data
 DirectTCPV1Hint = namedtuple("DirectTCPV1Hint", ["hostname", "port"])
 TorTCPV1Hint = namedtuple("TorTCPV1Hint", ["hostname", "port"])
-# RelayV1Hint contains a list of DirectTCPV1Hint and TorTCPV1Hint hints. For
-# each one, make the TCP connection, send the relay handshake, then complete
-# the rest of the V1 protocol. Only one hint per relay is useful.
+# A reliable-UDP session (see rudp.py), carrying the same handshake and
+# records as a TCP connection.
+DirectUDPV1Hint = namedtuple("DirectUDPV1Hint", ["hostname", "port"])
+# UnixV1Hint is a listening Unix-domain socket. It only works if the other
+# side is on the same host, or shares the socket's directory (e.g. two
+# containers with a common volume): nobody else will find the path. The
+# hostname is just the advertiser's name for itself.
+UnixV1Hint = namedtuple("UnixV1Hint", ["hostname", "path"])
+# RelayV1Hint describes one relay, with a tuple of DirectTCPV1Hint and
+# TorTCPV1Hint hints: equally-valid ways to reach it. For each one, make the
+# TCP connection, send the relay handshake, then complete the rest of the V1
+# protocol. Only one hint per relay is useful. Each relay (ours and theirs)
+# is a separate contender.
 RelayV1Hint = namedtuple("RelayV1Hint", ["hints"])
 
+def _bracket(hostname):
+    # IPv6 addresses get brackets, so the port is unambiguous
+    if u":" in hostname:
+        return u"[%s]" % hostname
+    return hostname
+
 def describe_hint_obj(hint):
     if isinstance(hint, DirectTCPV1Hint):
-        return u"tcp:%s:%d" % (hint.hostname, hint.port)
+        return u"tcp:%s:%d" % (_bracket(hint.hostname), hint.port)
     elif isinstance(hint, TorTCPV1Hint):
-        return u"tor:%s:%d" % (hint.hostname, hint.port)
+        return u"tor:%s:%d" % (_bracket(hint.hostname), hint.port)
+    elif isinstance(hint, DirectUDPV1Hint):
+        return u"udp:%s:%d" % (_bracket(hint.hostname), hint.port)
+    elif isinstance(hint, UnixV1Hint):
+        return u"unix:%s" % hint.path
     else:
         return str(hint)
 
+def normalize_hostname(hostname):
+    """Strip the brackets from an IPv6 address, and put it in canonical
+    form. Return None if it looks like an IPv6 address but isn't one.
+    Hostnames and IPv4 addresses are returned unchanged."""
+    if hostname.startswith(u"[") and hostname.endswith(u"]"):
+        hostname = hostname[1:-1]
+    if u":" not in hostname:
+        return hostname
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, hostname)
+    except AttributeError: # no inet_pton on windows under py2
+        return hostname
+    except (socket.error, ValueError):
+        return None
+    return six.u(socket.inet_ntop(socket.AF_INET6, packed))
+
+# Address classes, used to decide which direct hints to try first. We don't
+# know our own netmasks, so "same subnet" means the same IPv4 /24 as one of
+# our own addresses.
+ADDR_LOOPBACK, ADDR_SAME_SUBNET, ADDR_PRIVATE, ADDR_PUBLIC = range(4)
+
+def _ipv4_octets(hostname):
+    parts = hostname.split(".")
+    if len(parts) != 4 or not all(p.isdigit() for p in parts):
+        return None
+    octets = [int(p) for p in parts]
+    if max(octets) > 255:
+        return None
+    return octets
+
+def classify_hint_obj(hint, my_addresses=()):
+    if isinstance(hint, UnixV1Hint):
+        return ADDR_LOOPBACK
+    if not isinstance(hint, (DirectTCPV1Hint, DirectUDPV1Hint)):
+        return ADDR_PUBLIC
+    hostname = hint.hostname.lower()
+    if hostname in (u"localhost", u"::1"):
+        return ADDR_LOOPBACK
+    octets = _ipv4_octets(hostname)
+    if octets is None:
+        if u":" in hostname and hostname.startswith((u"fe80:", u"fc", u"fd")):
+            return ADDR_PRIVATE # IPv6 link-local or unique-local
+        return ADDR_PUBLIC
+    if octets[0] == 127:
+        return ADDR_LOOPBACK
+    for addr in my_addresses:
+        mine = _ipv4_octets(addr)
+        if mine and mine[0] != 127 and mine[:3] == octets[:3]:
+            return ADDR_SAME_SUBNET
+    if (octets[0] == 10
+        or (octets[0] == 172 and 16 <= octets[1] <= 31)
+        or octets[:2] == [192, 168]
+        or octets[:2] == [169, 254]):
+        return ADDR_PRIVATE
+    return ADDR_PUBLIC
+
+class ConnectionHistory:
+    """What earlier connection attempts found out. Hand the same one to each
+    Transit that should learn from the others (e.g. the stripes and resumed
+    connections of one transfer). Each Transit gets a fresh one otherwise."""
+    def __init__(self):
+        # by connector description: True if it negotiated, False if the TCP
+        # connection could not be made. Hints that worked before are tried
+        # first, and hints that failed are tried last.
+        self.hints = {}
+        # how long the TCP connection to each relay took (by connector
+        # description). Relays are started nearest first.
+        self.relay_rtts = {}
+
 def parse_hint_argv(hint):
     assert isinstance(hint, type(u""))
     # return tuple or None for an unparseable hint
@@ -120,7 +220,10 @@ def parse_hint_argv(hint):
     if not mo:
         print("unparseable TCP hint '%s'" % (hint,))
         return None
-    hint_host = mo.group(1)
+    hint_host = normalize_hostname(mo.group(1))
+    if hint_host is None:
+        print("invalid IPv6 address in TCP hint '%s'" % (hint,))
+        return None
     try:
         hint_port = int(mo.group(2))
     except ValueError:
@@ -129,12 +232,46 @@ def parse_hint_argv(hint):
     return DirectTCPV1Hint(hint_host, hint_port)
 
 TIMEOUT=15
+# While coalescing, flush outbound records once this many bytes are pending.
+# This matches the amount Twisted's transports try to send per write().
+OUTBOUND_BATCH_SIZE=2**17
+# With use_crypto_threads(), records are encrypted and decrypted in batches of
+# about this many bytes, each batch in a thread of its own. The coalescing
+# producer keeps pulling records until CRYPTO_MAX_INFLIGHT bytes are waiting
+# to be encrypted, so there is enough work queued to keep several cores busy.
+# Inbound, we stop reading from the socket once that many bytes are waiting
+# to be decrypted.
+CRYPTO_BATCH_SIZE=2**16
+CRYPTO_MAX_INFLIGHT=2**20
+# Records that nobody has asked for yet (with receive_record()) are queued,
+# and we stop reading from the socket once this many bytes are waiting.
+INBOUND_QUEUE_SIZE=2**22
+
+# These run in a worker thread. libsodium releases the GIL, so batches in
+# different threads really do run in parallel. Each returns its results and
+# how long it took, for get_stats().
+def _encrypt_records(box, batch):
+    started = time.time()
+    frames = []
+    for (nonce, record) in batch:
+        encrypted = box.encrypt(record, nonce)
+        frames.append(encode_length(len(encrypted)))
+        frames.append(encrypted)
+    return frames, time.time() - started
+
+def _decrypt_records(box, batch, decompress=False):
+    started = time.time()
+    records = [box.decrypt(encrypted) for encrypted in batch]
+    if decompress:
+        records = [decompress_record(record) for record in records]
+    return records, time.time() - started
 
 @implementer(interfaces.IProducer, interfaces.IConsumer)
 class Connection(protocol.Protocol, policies.TimeoutMixin):
     def __init__(self, owner, relay_handshake, start, description):
         self.state = "too-early"
         self.buf = b""
+        self._buf_offset = 0
         self.owner = owner
         self.relay_handshake = relay_handshake
         self.start = start
@@ -145,11 +282,58 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         self._consumer_bytes_written = 0
         self._consumer_bytes_expected = None
         self._consumer_deferred = None
+        self._file_consumer = None # a ThreadedFileConsumer, for get_stats()
         self._inbound_records = deque()
+        self._inbound_size = 0
+        self._inbound_limit = INBOUND_QUEUE_SIZE
+        self._inbound_full = False # we paused the transport ourselves
+        self._held = False # negotiated, but not yet set up by our owner
+        # (Deferred, take, at_eof) for each reader: take() removes what the
+        # reader wants from the queue, at_eof is what it gets once the
+        # connection is gone (or None to errback instead)
         self._waiting_reads = deque()
+        self._lost = False
+        self._outbound = None # list of pending buffers, while corked
+        self._outbound_size = 0
+        self._coalescing_producer = None
+        self._records_sent = 0
+        self._write_calls = 0
+        # more counters, for get_stats()
+        self._bytes_sent = 0
+        self._records_received = 0
+        self._bytes_received = 0
+        self._encrypt_time = 0.0
+        self._decrypt_time = 0.0
+        self._send_waits = 0
+        self._send_wait_time = 0.0
+        self._send_idle_since = None
+        self._receive_pauses = 0
+        self._receive_pause_time = 0.0
+        self._receive_paused_at = None
+        self._queue_pauses = 0
+        self._connected_at = None
+        self._negotiated_at = None
+        self._first_record_at = None
+        self._crypto_reactor = None
+        self._crypto_pool = None
+        # while crypto runs in threads, these hold one [result] slot per
+        # batch, in nonce order, so results are used in the same order
+        # even if the threads finish in a different one
+        self._encrypting = deque()
+        self._encrypt_batch = []
+        self._encrypt_batch_size = 0
+        self._encrypt_pending = 0 # plaintext bytes queued or in a thread
+        self._decrypting = deque()
+        self._decrypt_pending = 0 # ciphertext bytes queued or in a thread
+        self._decrypt_full = False # we paused the transport for that
+        self._close_when_encrypted = False
+        self._lost_while_decrypting = False
+        self._compressor = None
+        self._decompress = False
 
     def connectionMade(self):
         debug("handle %r" %  (self.transport,))
+        self._connected_at = time.time()
         self.setTimeout(TIMEOUT) # does timeoutConnection() when it expires
         self.factory.connectionWasMade(self)
 
@@ -239,6 +423,7 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
 
     def _negotiationSuccessful(self):
         self.state = "records"
+        self._negotiated_at = time.time()
         self.setTimeout(None)
         send_key = self.owner._sender_record_key()
         self.send_box = SecretBox(send_key)
@@ -246,70 +431,411 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         receive_key = self.owner._receiver_record_key()
         self.receive_box = SecretBox(receive_key)
         self.next_receive_nonce = 0
+        # From here on, self.buf is a reassembly buffer for inbound records.
+        # A bytearray can be extended in place, and we only trim consumed
+        # records off the front once per dataReceived() call, so a burst of
+        # many small records costs O(n) instead of O(n^2).
+        self.buf = bytearray(self.buf)
+        # the peer may send records right behind its "go", and the owner
+        # might not know how to read them yet
+        self.owner.connection_negotiated(self)
         d, self._negotiation_d = self._negotiation_d, None
         d.callback(self)
 
     def dataReceivedRECORDS(self):
+        if self._held:
+            return
+        buf = self.buf
+        batch, batch_size = [], 0 # only used with use_crypto_threads()
         while True:
-            if len(self.buf) < 4:
-                return
-            length = int(hexlify(self.buf[:4]), 16)
-            if len(self.buf) < 4+length:
-                return
-            encrypted, self.buf = self.buf[4:4+length], self.buf[4+length:]
-
+            # re-read the offset each time: recordReceived() can re-enter
+            # dataReceived() (via a consumer's resumeProducing), which will
+            # consume records and compact the buffer underneath us
+            offset = self._buf_offset
+            if len(buf) - offset < LENGTH_SIZE:
+                break
+            length = decode_length(buf, offset)
+            start = offset + LENGTH_SIZE
+            if len(buf) - start < length:
+                break
+            # SecretBox wants real bytes, so this copies the one record, but
+            # leaves the rest of the buffer alone
+            encrypted = bytes(buf[start:start+length])
+            self._buf_offset = start + length
+            if self._first_record_at is None:
+                self._first_record_at = time.time()
+            self._records_received += 1
+            self._bytes_received += LENGTH_SIZE + length
+
+            if self._crypto_pool is not None:
+                # nonces are still checked here, in wire order
+                self._check_nonce(encrypted)
+                batch.append(encrypted)
+                batch_size += length
+                if batch_size >= CRYPTO_BATCH_SIZE:
+                    self._dispatch_decrypt(batch, batch_size)
+                    batch, batch_size = [], 0
+                continue
             record = self._decrypt_record(encrypted)
             self.recordReceived(record)
+        if batch:
+            self._dispatch_decrypt(batch, batch_size)
+        if self._buf_offset:
+            del buf[:self._buf_offset]
+            self._buf_offset = 0
 
-    def _decrypt_record(self, encrypted):
+    def _check_nonce(self, encrypted):
         nonce_buf = encrypted[:SecretBox.NONCE_SIZE] # assume it's prepended
-        nonce = int(hexlify(nonce_buf), 16)
+        nonce = decode_nonce(nonce_buf)
         if nonce != self.next_receive_nonce:
             raise BadNonce("received out-of-order record: got %d, expected %d"
                            % (nonce, self.next_receive_nonce))
         self.next_receive_nonce += 1
+
+    def _decrypt_record(self, encrypted):
+        self._check_nonce(encrypted)
+        started = time.time()
         record = self.receive_box.decrypt(encrypted)
+        if self._decompress:
+            record = decompress_record(record)
+        self._decrypt_time += time.time() - started
         return record
 
+    def use_crypto_threads(self, reactor, threadpool=None):
+        """Encrypt and decrypt records in a thread pool (the reactor's own,
+        unless 'threadpool' is given) instead of in the reactor thread. Records
+        are still written to the transport, and delivered to the consumer, in
+        nonce order."""
+        self._crypto_reactor = reactor
+        self._crypto_pool = threadpool or reactor.getThreadPool()
+
+    def use_compression(self, level=None):
+        """Start using the compress-v1 record format, which both sides must
+        have agreed to. Records we send are compressed with zlib at 'level'
+        whenever that seems to pay off, or never if 'level' is None. Records
+        we receive are decompressed as needed."""
+        self._compressor = RecordCompressor(level)
+        self._decompress = True
+
+    def _dispatch_decrypt(self, batch, size):
+        slot = []
+        self._decrypting.append(slot)
+        self._decrypt_pending += size
+        if (self._decrypt_pending >= CRYPTO_MAX_INFLIGHT
+            and not self._decrypt_full):
+            # the threads can't keep up: stop reading until they catch up
+            self._decrypt_full = True
+            self.transport.pauseProducing()
+        d = threads.deferToThreadPool(self._crypto_reactor, self._crypto_pool,
+                                      _decrypt_records, self.receive_box,
+                                      batch, self._decompress)
+        d.addCallbacks(self._decrypted, self._decrypt_failed,
+                       callbackArgs=(slot, size))
+
+    def _decrypted(self, result, slot, size):
+        records, elapsed = result
+        self._decrypt_time += elapsed
+        slot.append(records)
+        self._decrypt_pending -= size
+        if self._decrypt_full and self._decrypt_pending < CRYPTO_MAX_INFLIGHT:
+            self._decrypt_full = False
+            self._resumeTransport()
+        while self._decrypting and self._decrypting[0]:
+            records = self._decrypting.popleft()[0]
+            for record in records:
+                self.recordReceived(record)
+        if not self._decrypting and self._lost_while_decrypting:
+            self._lost_while_decrypting = False
+            self._consumerLost()
+
+    def _decrypt_failed(self, f):
+        # same as a CryptoError raised by dataReceived(): drop the connection,
+        # and everything that was queued behind the bad record
+        log.err(f, "transit record failed to decrypt")
+        self._decrypting.clear()
+        self.setTimeout(None)
+        self._error = f.value
+        self.state = "hung up"
+        self.transport.loseConnection()
+        if self._lost_while_decrypting:
+            self._lost_while_decrypting = False
+            self._consumerLost()
+
     def describe(self):
         return self._description
 
     def send_record(self, record):
         if not isinstance(record, type(b"")): raise UsageError
+        started = time.time()
+        if self._compressor:
+            record = self._compressor.compress(record)
         assert SecretBox.NONCE_SIZE == 24
         assert self.send_nonce < 2**(8*24)
         assert len(record) < 2**(8*4)
-        nonce = unhexlify("%048x" % self.send_nonce) # big-endian
+        nonce = encode_nonce(self.send_nonce) # big-endian
         self.send_nonce += 1
+        self._records_sent += 1
+        if self._crypto_pool is not None:
+            self._encrypt_batch.append((nonce, record))
+            self._encrypt_batch_size += len(record)
+            self._encrypt_pending += len(record)
+            self._encrypt_time += time.time() - started
+            if (self._outbound is None
+                or self._encrypt_batch_size >= CRYPTO_BATCH_SIZE):
+                self._dispatch_encrypt()
+            return
         encrypted = self.send_box.encrypt(record, nonce)
-        length = unhexlify("%08x" % len(encrypted)) # always 4 bytes long
-        self.transport.write(length)
-        self.transport.write(encrypted)
+        self._encrypt_time += time.time() - started
+        length = encode_length(len(encrypted)) # always 4 bytes long
+        self._write_frames([length, encrypted])
+
+    def _write_frames(self, frames):
+        size = sum(len(f) for f in frames)
+        self._bytes_sent += size
+        if self._outbound is not None:
+            self._outbound.extend(frames)
+            self._outbound_size += size
+            return
+        self._write_calls += 1
+        self.transport.writeSequence(frames)
+
+    def _dispatch_encrypt(self):
+        batch, self._encrypt_batch = self._encrypt_batch, []
+        size, self._encrypt_batch_size = self._encrypt_batch_size, 0
+        slot = []
+        self._encrypting.append(slot)
+        d = threads.deferToThreadPool(self._crypto_reactor, self._crypto_pool,
+                                      _encrypt_records, self.send_box, batch)
+        d.addCallbacks(self._encrypted, self._encrypt_failed,
+                       callbackArgs=(slot, size))
+
+    def _encrypted(self, result, slot, size):
+        frames, elapsed = result
+        self._encrypt_time += elapsed
+        slot.append(frames)
+        self._encrypt_pending -= size
+        while self._encrypting and self._encrypting[0]:
+            frames = self._encrypting.popleft()[0]
+            self._write_frames(frames)
+        if not self._encrypting and self._close_when_encrypted:
+            self._close_when_encrypted = False
+            self.transport.loseConnection()
+
+    def _encrypt_failed(self, f):
+        # this batch's slot will never fill, so nothing queued behind it can
+        # be sent either: drop the connection, like a failed decrypt
+        log.err(f, "transit record failed to encrypt")
+        self._encrypting.clear()
+        self._close_when_encrypted = False
+        self._error = f.value
+        self.state = "hung up"
+        self.transport.loseConnection()
+
+    def _outbound_full(self):
+        if self._crypto_pool is not None:
+            return self._encrypt_pending >= CRYPTO_MAX_INFLIGHT
+        return self._outbound_size >= OUTBOUND_BATCH_SIZE
+
+    def _cork(self):
+        # hold outbound records until _uncork(), so a batch of them can be
+        # handed to the transport in a single call
+        if self._outbound is None:
+            self._outbound = []
+            self._outbound_size = 0
+
+    def _uncork(self):
+        if self._encrypt_batch:
+            self._dispatch_encrypt()
+        outbound, self._outbound = self._outbound, None
+        self._outbound_size = 0
+        if outbound:
+            self._write_calls += 1
+            self.transport.writeSequence(outbound)
+
+    def get_stats(self):
+        """Return a dict of counters for this connection. 'writes_saved' is
+        the number of transport writes we avoided, compared to writing the
+        length prefix and the ciphertext of each record separately.
+
+        The byte counts are of ciphertext, including the length prefixes.
+        'encrypt_time' and 'decrypt_time' are seconds spent on records
+        (including compression), whichever thread did the work.
+        'send_waits' and 'send_wait_time' count the times our producer had
+        to wait for the transport to drain, and 'receive_pauses' and
+        'receive_pause_time' the times our consumer paused us. Once the
+        connection is up, 'handshake_time' is how long negotiation took, and
+        'first_byte_time' how long after that the first record arrived."""
+        now = time.time()
+        receive_pause_time = self._receive_pause_time
+        if self._receive_paused_at is not None:
+            receive_pause_time += now - self._receive_paused_at
+        stats = {"records_sent": self._records_sent,
+                 "write_calls": self._write_calls,
+                 "writes_saved": 2*self._records_sent - self._write_calls,
+                 "bytes_sent": self._bytes_sent,
+                 "records_received": self._records_received,
+                 "bytes_received": self._bytes_received,
+                 "encrypt_time": self._encrypt_time,
+                 "decrypt_time": self._decrypt_time,
+                 "send_waits": self._send_waits,
+                 "send_wait_time": self._send_wait_time,
+                 "receive_pauses": self._receive_pauses,
+                 "receive_pause_time": receive_pause_time,
+                 "queue_pauses": self._queue_pauses,
+                 }
+        if self._negotiated_at is not None:
+            if self._connected_at is not None:
+                stats["handshake_time"] = (self._negotiated_at -
+                                           self._connected_at)
+            if self._first_record_at is not None:
+                stats["first_byte_time"] = (self._first_record_at -
+                                            self._negotiated_at)
+        if self._file_consumer:
+            stats.update(self._file_consumer.get_stats())
+        if self._compressor:
+            stats.update(self._compressor.get_stats())
+        transport_stats = getattr(self.transport, "get_stats", None)
+        if transport_stats: # a reliable-UDP session
+            stats.update(transport_stats())
+        return stats
 
     def recordReceived(self, record):
         if self._consumer:
             self._writeToConsumer(record)
             return
         self._inbound_records.append(record)
+        self._inbound_size += len(record)
         self._deliverRecords()
+        if self._inbound_size >= self._inbound_limit and not self._inbound_full:
+            # nobody is reading: let TCP push back on the sender, rather
+            # than buffering everything they send
+            self._inbound_full = True
+            self._queue_pauses += 1
+            self.transport.pauseProducing()
 
     def receive_record(self):
         d = defer.Deferred()
-        self._waiting_reads.append(d)
+        if self._lost and not self._inbound_records:
+            d.errback(error.ConnectionClosed())
+            return d
+        self._waiting_reads.append((d, self._popInbound, None))
         self._deliverRecords()
         return d
 
+    def read(self, size=None):
+        """Return a Deferred that fires with up to 'size' bytes of inbound
+        data (or everything queued, if 'size' is None), once there are any.
+        Record boundaries are not preserved: each call takes as many queued
+        records as fit, and leaves the rest of a partly-read record for the
+        next call. Fires with b"" once the connection has closed and nothing
+        is left."""
+        if size is not None and size < 1: raise UsageError
+        return self._stream_read(lambda: self._take_bytes(size), b"")
+
+    def read_chunks(self):
+        """Return a Deferred that fires with a list of every record queued
+        so far (waiting until there is at least one), or with an empty list
+        once the connection has closed and nothing is left."""
+        return self._stream_read(self._take_chunks, [])
+
+    def chunks(self, size=None, loop=None):
+        """Return an asynchronous iterator of inbound data, for 'async for'.
+        Each step is one read(size). From asyncio code, pass the event
+        'loop' and each step will be a Future instead of a Deferred."""
+        return _ChunkIterator(self, size, loop)
+
+    def _stream_read(self, take, at_eof):
+        d = defer.Deferred()
+        if self._lost and not self._inbound_records:
+            d.callback(at_eof)
+            return d
+        self._waiting_reads.append((d, take, at_eof))
+        self._deliverRecords()
+        return d
+
+    def _take_bytes(self, size):
+        chunks, wanted = [], size
+        while self._inbound_records and (size is None or wanted > 0):
+            r = self._popInbound()
+            if size is not None:
+                if len(r) > wanted:
+                    # put the rest back, without upsetting the queue limit
+                    rest = r[wanted:]
+                    self._inbound_records.appendleft(rest)
+                    self._inbound_size += len(rest)
+                    r = r[:wanted]
+                wanted -= len(r)
+            chunks.append(r)
+        return b"".join(chunks)
+
+    def _take_chunks(self):
+        chunks = []
+        while self._inbound_records:
+            r = self._popInbound()
+            if r:
+                chunks.append(r)
+        return chunks
+
+    def hold_records(self):
+        """Leave inbound records unparsed, and stop reading from the
+        transport, until release_records() is called. This gives the owner
+        time to choose the record format (e.g. use_compression()) before
+        the first record is read."""
+        self._held = True
+        self.transport.pauseProducing()
+
+    def release_records(self):
+        if not self._held:
+            return
+        self._held = False
+        self._resumeTransport()
+        self.dataReceivedRECORDS()
+
+    def set_inbound_queue_size(self, size):
+        """Stop reading from the transport while at least 'size' bytes of
+        records are waiting for receive_record() or connectConsumer()."""
+        self._inbound_limit = size
+
+    def _popInbound(self):
+        r = self._inbound_records.popleft()
+        self._inbound_size -= len(r)
+        if self._inbound_full and self._inbound_size < self._inbound_limit:
+            self._inbound_full = False
+            self._resumeTransport()
+        return r
+
+    def _resumeTransport(self):
+        # the transport stays paused while anything still wants it paused:
+        # the consumer, our own inbound queue, the decrypt threads, or a hold
+        if (self._receive_paused_at is None and not self._inbound_full
+            and not self._decrypt_full and not self._held):
+            self.transport.resumeProducing()
+
     def _deliverRecords(self):
         while self._inbound_records and self._waiting_reads:
-            r = self._inbound_records.popleft()
-            d = self._waiting_reads.popleft()
+            d, take, at_eof = self._waiting_reads[0]
+            r = take()
+            if at_eof is not None and not r:
+                continue # only empty records: stream readers keep waiting
+            self._waiting_reads.popleft()
             d.callback(r)
 
-    def close(self):
-        self.transport.loseConnection()
+    def _failReads(self):
         while self._waiting_reads:
-            d = self._waiting_reads.popleft()
-            d.errback(error.ConnectionClosed())
+            d, take, at_eof = self._waiting_reads.popleft()
+            if at_eof is None:
+                d.errback(error.ConnectionClosed())
+            else:
+                d.callback(at_eof)
+
+    def close(self):
+        self._uncork()
+        if self._encrypting:
+            # let the records we've already accepted reach the wire first
+            self._close_when_encrypted = True
+        else:
+            self.transport.loseConnection()
+        self._failReads()
 
     def timeoutConnection(self):
         self._error = BadHandshake("timeout")
@@ -333,27 +859,56 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             # timeout: BadHandshake("timeout")
 
             d.errback(self._error or BadHandshake("connection lost"))
+        if self._decrypting:
+            # records that arrived before the connection was lost are still
+            # being decrypted, and the consumer should get them first
+            self._lost_while_decrypting = True
+            return
+        self._consumerLost()
+
+    def _consumerLost(self):
         if self._consumer_deferred:
             self._consumer_deferred.errback(error.ConnectionClosed())
+        # nothing more is coming, so don't leave readers hanging
+        self._lost = True
+        self._failReads()
 
     # IConsumer methods, for outbound flow-control. We pass these through to
-    # the transport. The 'producer' is something like a t.p.basic.FileSender
+    # the transport. The 'producer' is something like a t.p.basic.FileSender.
+    # Pull producers get wrapped, so each time the transport asks for more
+    # data we collect several records and write them all at once.
     def registerProducer(self, producer, streaming):
         assert interfaces.IConsumer.providedBy(self.transport)
+        if not streaming:
+            producer = _CoalescingProducer(self, producer)
+            self._coalescing_producer = producer
         self.transport.registerProducer(producer, streaming)
     def unregisterProducer(self):
+        # the producer might be finishing inside a coalesced batch: flush it
+        # before anyone gets a chance to close() the transport
+        self._uncork()
+        if self._coalescing_producer:
+            self._coalescing_producer.detach()
+            self._coalescing_producer = None
         self.transport.unregisterProducer()
     def write(self, data):
         self.send_record(data)
 
     # IProducer methods, for inbound flow-control. We pass these through to
-    # the transport.
+    # the transport, except that it stays paused while our own inbound queue
+    # (or the queue of records waiting to be decrypted) is full.
     def stopProducing(self):
         self.transport.stopProducing()
     def pauseProducing(self):
+        if self._receive_paused_at is None:
+            self._receive_pauses += 1
+            self._receive_paused_at = time.time()
         self.transport.pauseProducing()
     def resumeProducing(self):
-        self.transport.resumeProducing()
+        if self._receive_paused_at is not None:
+            self._receive_pause_time += time.time() - self._receive_paused_at
+            self._receive_paused_at = None
+        self._resumeTransport()
 
     # Helper methods
 
@@ -395,7 +950,7 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         self._consumer_deferred = d
         # drain any pending records
         while self._consumer and self._inbound_records:
-            r = self._inbound_records.popleft()
+            r = self._popInbound()
             self._writeToConsumer(r)
         return d
 
@@ -414,14 +969,83 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         self._consumer_bytes_expected = None
         self._consumer_deferred = None
 
-    # Helper method to write a known number of bytes to a file. This has no
-    # flow control: the filehandle cannot push back. 'progress' is an
-    # optional callable which will be called on each write (with the number
-    # of bytes written). Returns a Deferred that fires (with the number of
-    # bytes written) when the count is reached or the RecordPipe is closed.
-    def writeToFile(self, f, expected, progress=None, hasher=None):
-        fc = FileConsumer(f, progress, hasher)
-        return self.connectConsumer(fc, expected)
+    # Helper method to write a known number of bytes to a file. Without a
+    # 'reactor' this has no flow control: the filehandle cannot push back.
+    # With one, the writes happen in a separate thread (see
+    # ThreadedFileConsumer), and we stop reading from the socket while that
+    # falls behind. 'progress' is an optional callable which will be called
+    # on each write (with the number of bytes written). Returns a Deferred
+    # that fires (with the number of bytes written) when the count is reached
+    # and written, or the RecordPipe is closed.
+    def writeToFile(self, f, expected, progress=None, hasher=None,
+                    reactor=None):
+        if reactor is None:
+            fc = FileConsumer(f, progress, hasher)
+            return self.connectConsumer(fc, expected)
+        self._file_consumer = fc = ThreadedFileConsumer(f, reactor, progress,
+                                                        hasher)
+        return _when_written(fc, self.connectConsumer(fc, expected))
+
+@implementer(interfaces.IPullProducer)
+class _CoalescingProducer:
+    """I wrap a pull producer that is writing records into a Connection.
+    Each time the transport asks for more data, I call the real producer
+    repeatedly (until it stops writing, or OUTBOUND_BATCH_SIZE bytes are
+    pending), then flush all of those records with a single writeSequence().
+    """
+    def __init__(self, connection, producer):
+        self._connection = connection
+        self._producer = producer
+
+    def detach(self):
+        self._producer = None
+        self._connection._send_idle_since = None
+
+    def resumeProducing(self):
+        c = self._connection
+        if c._send_idle_since is not None:
+            # the transport has been draining what we gave it last time
+            c._send_waits += 1
+            c._send_wait_time += time.time() - c._send_idle_since
+            c._send_idle_since = None
+        c._cork()
+        try:
+            while self._producer is not None and not c._outbound_full():
+                before = c._records_sent
+                self._producer.resumeProducing()
+                if c._records_sent == before:
+                    break # finished, or has nothing more for us right now
+        finally:
+            c._uncork()
+        if self._producer is not None:
+            c._send_idle_since = time.time()
+
+    def stopProducing(self):
+        if self._producer is not None:
+            self._producer.stopProducing()
+
+class _ChunkIterator:
+    # what Connection.chunks() returns. Each step is one read(), so there is
+    # a single Deferred for however many records arrived in the meantime.
+    def __init__(self, connection, size, loop):
+        self._connection = connection
+        self._size = size
+        self._loop = loop
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        d = self._connection.read(self._size)
+        d.addCallback(self._check_eof)
+        if self._loop is not None:
+            return d.asFuture(self._loop)
+        return d
+
+    def _check_eof(self, data):
+        if not data:
+            raise StopAsyncIteration
+        return data
 
 class OutboundConnectionFactory(protocol.ClientFactory):
     protocol = Connection
@@ -466,8 +1090,17 @@ class InboundConnectionFactory(protocol.ClientFactory):
     def _describePeer(self, addr):
         if isinstance(addr, address.HostnameAddress):
             return "<-%s:%d" % (addr.hostname, addr.port)
-        elif isinstance(addr, (address.IPv4Address, address.IPv6Address)):
+        elif isinstance(addr, address.IPv4Address):
+            if addr.type == "UDP":
+                return "<-udp:%s:%d" % (addr.host, addr.port)
             return "<-%s:%d" % (addr.host, addr.port)
+        elif isinstance(addr, address.UNIXAddress) and not addr.name:
+            return "<-unix" # a unix-v1 peer: its end has no name
+        elif isinstance(addr, address.IPv6Address):
+            host = addr.host
+            if host.startswith("::ffff:") and "." in host:
+                host = host[len("::ffff:"):] # IPv4, via a dual-stack socket
+            return "<-%s:%d" % (_bracket(host), addr.port)
         return "<-%r" % addr
 
     def buildProtocol(self, addr):
@@ -495,6 +1128,50 @@ class InboundConnectionFactory(protocol.ClientFactory):
         f.trap(BadHandshake, defer.CancelledError)
         pass
 
+@implementer(interfaces.IStreamServerEndpoint)
+class DualStackServerEndpoint:
+    """Listen on 'port' for both IPv4 and IPv6 connections, with a single
+    IPv6 socket that also accepts IPv4-mapped addresses. If this host can't
+    do that, listen on IPv4 only."""
+    def __init__(self, reactor, port):
+        self._reactor = reactor
+        self._port = port
+
+    def listen(self, factory):
+        return defer.execute(self._listen, factory)
+
+    def _listen(self, factory):
+        if socket.has_ipv6 and interfaces.IReactorFDSet.providedBy(
+                self._reactor):
+            p = _DualStackPort(self._port, factory, interface="::",
+                               reactor=self._reactor)
+            try:
+                p.startListening()
+                return p
+            except (error.CannotListenError, socket.error, AttributeError):
+                pass # no IPv6, or no IPV6_V6ONLY
+        return self._reactor.listenTCP(self._port, factory)
+
+class _DualStackPort(tcp.Port):
+    def createInternetSocket(self):
+        s = tcp.Port.createInternetSocket(self)
+        # linux defaults to dual-stack, but windows and the BSDs don't
+        s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        return s
+
+# the names that Common._listen_unix() gives its sockets
+UNIX_SOCKET_NAME = re.compile(r"^wormhole-transit-[0-9a-f]{16}\.sock$")
+
+def _is_ipv6_tcp_hint(hint_obj):
+    return (isinstance(hint_obj, DirectTCPV1Hint)
+            and u":" in hint_obj.hostname)
+
+def _is_unix_socket(path):
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except (OSError, ValueError):
+        return False
+
 def allocate_tcp_port():
     """Return an (integer) available TCP port on localhost. This briefly
     listens on the port in question, then closes it right away."""
@@ -568,28 +1245,166 @@ class _ThereCanBeOnlyOne:
 def there_can_be_only_one(contenders):
     return _ThereCanBeOnlyOne(contenders).run()
 
+class _HintRacer:
+    """I start connectors one at a time, 'stagger' seconds apart, in the
+    order they were added. When one fails, I start the next one right away.
+    Each add() returns a Deferred that fires with the connector's result."""
+    def __init__(self, reactor, stagger):
+        self._reactor = reactor
+        self._stagger = stagger
+        self._waiting = deque()
+        self._timer = None
+
+    def add(self, start_connector, *args):
+        d = defer.Deferred(self._cancel_waiter)
+        # when it is our turn, d fires and then waits for the connector.
+        # Cancelling d after that point cancels the connector too.
+        d.addCallback(self._start, start_connector, args)
+        self._waiting.append(d)
+        return d
+
+    def start(self):
+        self._next()
+
+    def _start(self, _, start_connector, args):
+        d = start_connector(*args)
+        d.addErrback(self._failed)
+        return d
+
+    def _failed(self, f):
+        if not f.check(defer.CancelledError):
+            self._next()
+        return f
+
+    def _next(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        if not self._waiting:
+            return
+        d = self._waiting.popleft()
+        if self._waiting:
+            self._timer = self._reactor.callLater(self._stagger, self._next)
+        d.callback(None)
+
+    def _cancel_waiter(self, d):
+        self._waiting.remove(d)
+        if (not self._waiting and self._timer is not None
+            and self._timer.active()):
+            self._timer.cancel()
+
+class _RelayGate:
+    """I hold back the relay connectors for 'delay' seconds, to give the
+    direct connectors a head start. If every direct connector fails before
+    then, I let the relays go right away, and record how much time that
+    saved."""
+    def __init__(self, reactor, delay, direct_contenders, timing):
+        self._reactor = reactor
+        self._delay = delay
+        self._timing = timing
+        self._waiting = []
+        self._timer = None
+        self._open = False
+        self._failed_early = False
+        self._direct_remaining = len(direct_contenders)
+        for d in direct_contenders:
+            d.addErrback(self._direct_failed)
+
+    def wait(self):
+        if self._open:
+            if self._failed_early:
+                self._failed_early = False
+                self._timing.add("relay failover", saved=self._delay)
+            return defer.succeed(None)
+        d = defer.Deferred(self._cancel_waiter)
+        self._waiting.append(d)
+        if self._timer is None:
+            self._timer = self._reactor.callLater(self._delay, self._release)
+        return d
+
+    def _cancel_waiter(self, d):
+        self._waiting.remove(d)
+        if not self._waiting and self._timer.active():
+            self._timer.cancel()
+
+    def _direct_failed(self, f):
+        # losers are cancelled once somebody wins: that isn't a failure
+        if not f.check(defer.CancelledError):
+            self._direct_remaining -= 1
+            if self._direct_remaining == 0 and not self._open:
+                self._fail_over()
+        return f
+
+    def _fail_over(self):
+        if self._timer is None:
+            # they all failed before the first relay was queued, or there
+            # are no relays at all
+            self._open = self._failed_early = True
+            return
+        if not self._timer.active():
+            return
+        saved = self._timer.getTime() - self._reactor.seconds()
+        self._timer.cancel()
+        self._timing.add("relay failover", saved=saved)
+        self._release()
+
+    def _release(self):
+        self._open = True
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
 class Common:
     RELAY_DELAY = 2.0
+    # Start the direct connectors this far apart, most promising first
+    # (Happy Eyeballs, RFC 8305). A failure starts the next one right away.
+    HINT_STAGGER = 0.25
+    # Relays are started nearest first, this far apart. Both sides must end
+    # up on the same relay, so the others aren't held back for long.
+    RELAY_STAGGER = 0.5
     TRANSIT_KEY_LENGTH = SecretBox.KEY_SIZE
+    # Peers that don't advertise "record-size-v1" get records of this size,
+    # which is what everybody used before record sizes were negotiated.
+    DEFAULT_RECORD_SIZE = 2**14
+    # Bigger records mean fewer trips through Python, but past this size the
+    # extra copies fall out of the CPU cache and each byte costs more again
+    # (see 'misc/bench-transit.py record-size').
+    MAX_RECORD_SIZE = 2**16
 
     def __init__(self, transit_relay, no_listen=False, tor_manager=None,
-                 reactor=reactor, timing=None):
+                 reactor=reactor, timing=None, crypto_threads=False,
+                 route_cache=None, compress_level=None,
+                 inbound_queue_size=None, udp=False, unix_socket_dir=None,
+                 history=None):
         if transit_relay:
             if not isinstance(transit_relay, type(u"")):
                 raise UsageError
-            relay = RelayV1Hint(hints=[parse_hint_argv(transit_relay)])
+            relay = RelayV1Hint(hints=(parse_hint_argv(transit_relay),))
             self._transit_relays = [relay]
         else:
             self._transit_relays = []
         self._their_direct_hints = [] # hintobjs
-        self._their_relay_hints = []
+        self._their_relays = [] # RelayV1Hints
+        self._their_max_record_size = None
+        self._their_compression = False
         self._tor_manager = tor_manager
         self._transit_key = None
         self._no_listen = no_listen
         self._waiting_for_transit_key = []
         self._listener = None
         self._winner = None
+        self._my_addresses = []
         self._reactor = reactor
+        self._crypto_threads = crypto_threads
+        self._compress_level = compress_level
+        self._inbound_queue_size = inbound_queue_size
+        self._udp_enabled = udp
+        self._udp = None # our rudp.UDPEndpoint, once we're listening
+        self._unix_socket_dir = unix_socket_dir
+        self._route_cache = route_cache
+        self._cached_route = None
+        self._routes = {} # connector description -> (hostname, is_relay)
+        self._history = history or ConnectionHistory()
         self._timing = timing or DebugTiming()
         self._timing.add("transit")
 
@@ -597,22 +1412,66 @@ class Common:
         if self._no_listen or self._tor_manager:
             return ([], None)
         portnum = allocate_tcp_port()
+        self._my_addresses = ipaddrs.find_addresses(ipv6=socket.has_ipv6)
         direct_hints = [DirectTCPV1Hint(six.u(addr), portnum)
-                        for addr in ipaddrs.find_addresses()]
-        ep = endpoints.serverFromString(reactor, "tcp:%d" % portnum)
+                        for addr in self._my_addresses]
+        if self._udp_enabled:
+            # reliable-UDP sessions only use IPv4 for now
+            self._udp = rudp.UDPEndpoint(self._reactor)
+            udp_port = self._udp.listen()
+            direct_hints.extend(DirectUDPV1Hint(six.u(addr), udp_port)
+                                for addr in self._my_addresses
+                                if u":" not in addr)
+        ep = DualStackServerEndpoint(reactor, portnum)
         return direct_hints, ep
 
     def get_connection_abilities(self):
-        return [{u"type": u"direct-tcp-v1"},
-                {u"type": u"relay-v1"},
-                ]
+        abilities = [{u"type": u"direct-tcp-v1"},
+                     {u"type": u"relay-v1"},
+                     {u"type": u"record-size-v1",
+                      u"max": self.MAX_RECORD_SIZE},
+                     # we can always decompress, even if we won't compress
+                     {u"type": u"compress-v1", u"methods": [u"zlib"]},
+                     ]
+        if self._udp_enabled:
+            abilities.append({u"type": u"direct-udp-v1"})
+        return abilities
+
+    def add_connection_abilities(self, abilities):
+        for a in abilities: # ability structs
+            if a.get(u"type", u"") == u"record-size-v1":
+                max_size = a.get(u"max")
+                if not (isinstance(max_size, int) and max_size > 0):
+                    log.msg("invalid record-size-v1 ability: %r" % (a,))
+                    continue
+                self._their_max_record_size = max_size
+            if a.get(u"type", u"") == u"compress-v1":
+                if u"zlib" in a.get(u"methods", []):
+                    self._their_compression = True
+
+    def get_record_size(self):
+        """Return the size of the records that we should send, which is the
+        largest size both sides have agreed to. Call this after
+        add_connection_abilities()."""
+        if self._their_max_record_size is None:
+            return self.DEFAULT_RECORD_SIZE
+        return min(self.MAX_RECORD_SIZE, self._their_max_record_size)
 
     @inlineCallbacks
     def get_connection_hints(self):
         hints = []
         direct_hints = yield self._get_direct_hints()
         for dh in direct_hints:
-            hints.append({u"type": u"direct-tcp-v1",
+            if isinstance(dh, UnixV1Hint):
+                hints.append({u"type": u"unix-v1",
+                              u"hostname": dh.hostname,
+                              u"path": dh.path,
+                              })
+                continue
+            hint_type = u"direct-tcp-v1"
+            if isinstance(dh, DirectUDPV1Hint):
+                hint_type = u"direct-udp-v1"
+            hints.append({u"type": hint_type,
                           u"hostname": dh.hostname,
                           u"port": dh.port, # integer
                           })
@@ -647,6 +1506,17 @@ class Common:
         f = InboundConnectionFactory(self)
         self._listener_f = f # for tests # XX move to __init__ ?
         self._listener_d = f.whenDone()
+        if self._udp:
+            self._udp.factory = f
+            def _stop_udp(res):
+                # turn away new sessions, but keep the one that won
+                self._udp.factory = None
+                self._udp.close_when_idle()
+                return res
+            self._listener_d.addBoth(_stop_udp)
+        if (self._unix_socket_dir is not None
+            and interfaces.IReactorUNIX.providedBy(self._reactor)):
+            self._listen_unix(f)
         d = self._listener.listen(f)
         def _listening(lp):
             # lp is an IListeningPort
@@ -655,51 +1525,99 @@ class Common:
                 lp.stopListening()
                 return res
             self._listener_d.addBoth(_stop_listening)
+            if not isinstance(lp, _DualStackPort):
+                # we fell back to IPv4 only, so nobody could reach us at
+                # our IPv6 addresses
+                self._my_direct_hints = [h for h in self._my_direct_hints
+                                         if not _is_ipv6_tcp_hint(h)]
             return self._my_direct_hints
         d.addCallback(_listening)
         return d
 
+    def _listen_unix(self, f):
+        # the other side can only use an absolute path
+        path = os.path.join(os.path.abspath(self._unix_socket_dir),
+                            u"wormhole-transit-%s.sock"
+                            % hexlify(os.urandom(8)).decode("ascii"))
+        try:
+            lp = self._reactor.listenUNIX(path, f)
+        except error.CannotListenError as e:
+            # e.g. an unwritable directory, or a path too long for AF_UNIX
+            log.msg("not offering a unix-v1 hint: %s" % (e,))
+            return
+        def _stop_listening(res):
+            lp.stopListening() # this removes the socket file
+            return res
+        self._listener_d.addBoth(_stop_listening)
+        # on the same host, nothing beats it, so offer it first
+        hostname = six.u(socket.gethostname())
+        self._my_direct_hints.insert(0, UnixV1Hint(hostname, path))
+
     def _stop_listening(self):
-        # this is for unit tests. The usual control flow (via connect())
-        # wires the listener's Deferred into a there_can_be_only_one(), which
-        # eats the errback. If we don't ever call connect(), we must catch it
-        # ourselves.
+        # this is for unit tests, and for stripes that the other side didn't
+        # accept. The usual control flow (via connect()) wires the listener's
+        # Deferred into a there_can_be_only_one(), which eats the errback. If
+        # we don't ever call connect(), we must catch it ourselves.
+        if not self._listener_d:
+            return
         self._listener_d.addErrback(lambda f: None)
         self._listener_d.cancel()
 
     def _parse_tcp_v1_hint(self, hint): # hint_struct -> hint_obj
         hint_type = hint.get(u"type", u"")
-        if hint_type not in [u"direct-tcp-v1", u"tor-tcp-v1"]:
+        if hint_type not in [u"direct-tcp-v1", u"tor-tcp-v1",
+                             u"direct-udp-v1"]:
             log.msg("unknown hint type: %r" % (hint,))
             return None
         if not(u"hostname" in hint
                and isinstance(hint[u"hostname"], type(u""))):
             log.msg("invalid hostname in hint: %r" % (hint,))
             return None
+        hostname = normalize_hostname(hint[u"hostname"])
+        if not hostname:
+            log.msg("invalid hostname in hint: %r" % (hint,))
+            return None
         if not(u"port" in hint and isinstance(hint[u"port"], int)):
             log.msg("invalid port in hint: %r" % (hint,))
             return None
         if hint_type == u"direct-tcp-v1":
-            return DirectTCPV1Hint(hint[u"hostname"], hint[u"port"])
+            return DirectTCPV1Hint(hostname, hint[u"port"])
+        elif hint_type == u"direct-udp-v1":
+            return DirectUDPV1Hint(hostname, hint[u"port"])
         else:
-            return TorTCPV1Hint(hint[u"hostname"], hint[u"port"])
+            return TorTCPV1Hint(hostname, hint[u"port"])
+
+    def _parse_unix_v1_hint(self, hint): # hint_struct -> hint_obj
+        if not(u"hostname" in hint
+               and isinstance(hint[u"hostname"], type(u""))):
+            log.msg("invalid hostname in hint: %r" % (hint,))
+            return None
+        path = hint.get(u"path")
+        if not(isinstance(path, type(u"")) and os.path.isabs(path)):
+            log.msg("invalid path in hint: %r" % (hint,))
+            return None
+        return UnixV1Hint(hint[u"hostname"], path)
 
     def add_connection_hints(self, hints):
         for h in hints: # hint structs
             hint_type = h.get(u"type", u"")
-            if hint_type in [u"direct-tcp-v1", u"tor-tcp-v1"]:
+            if hint_type in [u"direct-tcp-v1", u"tor-tcp-v1",
+                             u"direct-udp-v1"]:
                 dh = self._parse_tcp_v1_hint(h)
                 if dh:
                     self._their_direct_hints.append(dh) # hint_obj
+            elif hint_type == u"unix-v1":
+                dh = self._parse_unix_v1_hint(h)
+                if dh:
+                    self._their_direct_hints.append(dh)
             elif hint_type == u"relay-v1":
-                # TODO: each relay-v1 clause describes a different relay,
-                # with a set of equally-valid ways to connect to it. Treat
-                # them as separate relays, instead of merging them all
-                # together like this.
-                for rhs in h.get(u"hints", []):
-                    rh = self._parse_tcp_v1_hint(rhs)
-                    if rh:
-                        self._their_relay_hints.append(rh)
+                # each relay-v1 clause describes a different relay, with a
+                # set of equally-valid ways to connect to it
+                rhs = [self._parse_tcp_v1_hint(rhs)
+                       for rhs in h.get(u"hints", [])]
+                relay = RelayV1Hint(hints=tuple(rh for rh in rhs if rh))
+                if relay.hints and relay not in self._their_relays:
+                    self._their_relays.append(relay)
             else:
                 log.msg("unknown hint type: %r" % (h,))
 
@@ -765,20 +1683,28 @@ class Common:
             # connections, so those connections will know what to say when
             # they connect
             winner = yield self._connect()
+        self._remember_route(winner)
+        # the winner has been holding any records that arrived right behind
+        # its "go": now we know how to read them
+        if self._crypto_threads:
+            winner.use_crypto_threads(self._reactor)
+        if self._inbound_queue_size is not None:
+            winner.set_inbound_queue_size(self._inbound_queue_size)
+        if self._their_compression:
+            winner.use_compression(self._compress_level)
+        winner.release_records()
         returnValue(winner)
 
     def _connect(self):
-        # It might be nice to wire this so that a failure in the direct hints
-        # causes the relay hints to be used right away (fast failover). But
-        # none of our current use cases would take advantage of that: if we
-        # have any viable direct hints, then they're either going to succeed
-        # quickly or hang for a long time.
         contenders = []
         if self._listener_d:
             contenders.append(self._listener_d)
         relay_delay = 0
+        direct_contenders = []
+        self._cached_route = self._lookup_route()
 
-        for hint_obj in self._their_direct_hints:
+        racer = _HintRacer(self._reactor, self.HINT_STAGGER)
+        for hint_obj in self._sorted_direct_hints():
             # Check the hint type to see if we can support it (e.g. skip
             # onion hints on a non-Tor client). Do not increase relay_delay
             # unless we have at least one viable hint.
@@ -786,29 +1712,126 @@ class Common:
             if not ep:
                 continue
             description = "->%s" % describe_hint_obj(hint_obj)
-            d = self._start_connector(ep, description)
+            self._routes[description] = (hint_obj.hostname, False)
+            d = racer.add(self._start_connector, ep, description)
             contenders.append(d)
+            direct_contenders.append(d)
             relay_delay = self.RELAY_DELAY
+        racer.start()
 
         # Start trying the relay a few seconds after we start to try the
         # direct hints. The idea is to prefer direct connections, but not be
         # afraid of using the relay when we have direct hints that don't
         # resolve quickly. Many direct hints will be to unused local-network
         # IP addresses, which won't answer, and would take the full TCP
-        # timeout (30s or more) to fail.
-        for hint_obj in self._their_relay_hints:
-            ep = self._endpoint_from_hint_obj(hint_obj)
-            if not ep:
-                continue
-            description = "->relay:%s" % describe_hint_obj(hint_obj)
-            d = task.deferLater(self._reactor, relay_delay,
-                                self._start_connector, ep, description,
-                                is_relay=True)
-            contenders.append(d)
+        # timeout (30s or more) to fail. But if all the direct hints fail
+        # quickly (e.g. connection refused), there's no point in waiting.
+        if self._cached_route and self._cached_route[u"relay"]:
+            # the relay is what worked last time, so don't hold it back
+            relay_delay = 0
+        gate = _RelayGate(self._reactor, relay_delay, direct_contenders,
+                          self._timing)
+        relay_racer = _HintRacer(self._reactor, self.RELAY_STAGGER)
+        relay_contenders = []
+        for relay in self._sorted_relays():
+            connectors = []
+            for hint_obj in relay.hints:
+                ep = self._endpoint_from_hint_obj(hint_obj)
+                if not ep:
+                    continue
+                description = "->relay:%s" % describe_hint_obj(hint_obj)
+                self._routes[description] = (hint_obj.hostname, True)
+                connectors.append((ep, description))
+            if connectors:
+                relay_contenders.append(relay_racer.add(self._start_relay,
+                                                        connectors))
+        if relay_contenders:
+            gated = gate.wait()
+            gated.addCallback(lambda _: relay_racer.start())
+            gated.addErrback(lambda f: f.trap(defer.CancelledError))
+            # once every relay has lost, we don't need the gate any more
+            defer.DeferredList(relay_contenders).addCallback(
+                lambda _: gated.cancel())
+            contenders.extend(relay_contenders)
 
         winner = there_can_be_only_one(contenders)
         return self._not_forever(2*TIMEOUT, winner)
 
+    def _sorted_direct_hints(self):
+        cached = None
+        if self._cached_route and not self._cached_route[u"relay"]:
+            cached = self._cached_route[u"hostname"]
+        def _key(hint_obj):
+            description = "->%s" % describe_hint_obj(hint_obj)
+            # a Unix socket we can see at all is on this host, so it goes
+            # first and wins before the next hint is even started. We only
+            # get to use UDP hints if we asked for them, so they go ahead of
+            # TCP to the same class of address.
+            return (not isinstance(hint_obj, UnixV1Hint),
+                    hint_obj.hostname != cached,
+                    self._history_rank(description),
+                    classify_hint_obj(hint_obj, self._my_addresses),
+                    not isinstance(hint_obj, DirectUDPV1Hint))
+        return sorted(self._their_direct_hints, key=_key)
+
+    def _sorted_relays(self):
+        # both sides race the same relays, ours and theirs, so that they
+        # find each other even if they were configured differently
+        relays = list(self._their_relays)
+        for relay in self._transit_relays:
+            if relay not in relays:
+                relays.append(relay)
+        cached = None
+        if self._cached_route and self._cached_route[u"relay"]:
+            cached = self._cached_route[u"hostname"]
+        def _key(relay):
+            rtts = [self._relay_rtt(hint_obj) for hint_obj in relay.hints]
+            rtts = [rtt for rtt in rtts if rtt is not None]
+            return (cached not in [h.hostname for h in relay.hints],
+                    not rtts, min(rtts or [0]))
+        return sorted(relays, key=_key)
+
+    def _history_rank(self, description):
+        return {True: 0, None: 1, False: 2}[
+            self._history.hints.get(description)]
+
+    def _relay_rtt(self, hint_obj):
+        description = "->relay:%s" % describe_hint_obj(hint_obj)
+        rtt = self._history.relay_rtts.get(description)
+        if rtt is None and self._route_cache:
+            rtt = self._route_cache.lookup_rtt(description)
+        return rtt
+
+    def _start_relay(self, connectors):
+        # try every way we know to reach this one relay at once: the first
+        # to finish negotiating wins, and cancels the others
+        return there_can_be_only_one([self._start_connector(ep, description,
+                                                            is_relay=True)
+                                      for (ep, description) in connectors])
+
+    def _route_key(self):
+        relay_hints = [h for relay in self._their_relays for h in relay.hints]
+        return hints_key(self._their_direct_hints + relay_hints)
+
+    def _lookup_route(self):
+        if not self._route_cache:
+            return None
+        route = self._route_cache.lookup(self._route_key())
+        self._timing.add("route cache", hit=route is not None,
+                         route=route and route[u"hostname"])
+        return route
+
+    def _remember_route(self, winner):
+        # only outbound connections say which of their hints worked
+        if not self._route_cache or winner.describe() not in self._routes:
+            return
+        hostname, relay = self._routes[winner.describe()]
+        latency = None
+        if winner.start is not None:
+            latency = time.time() - winner.start
+        self._route_cache.remember(self._route_key(), hostname, relay,
+                                   latency)
+
     def _not_forever(self, timeout, d):
         """If the timer fires first, cancel the deferred. If the deferred fires
         first, cancel the timer."""
@@ -826,9 +1849,38 @@ class Common:
             assert self._transit_key
             relay_handshake = build_relay_handshake(self._transit_key)
         f = OutboundConnectionFactory(self, relay_handshake, description)
+        # one timing event per attempt, so --dump-timing shows how every
+        # hint did, not just the winner
+        ev = self._timing.add("transit attempt", hint=description)
+        start = time.time()
+        connected = []
         d = ep.connect(f)
         # fires with protocol, or ConnectError
-        d.addCallback(lambda p: p.startNegotiation())
+        def _connected(p):
+            connected.append(time.time())
+            ev.detail(connect=connected[0] - start)
+            if is_relay:
+                self._history.relay_rtts[description] = connected[0] - start
+                if self._route_cache:
+                    self._route_cache.remember_rtt(description,
+                                                   connected[0] - start)
+            return p.startNegotiation()
+        def _connect_failed(f):
+            if not f.check(defer.CancelledError):
+                self._history.hints[description] = False
+            return f
+        d.addCallbacks(_connected, _connect_failed)
+        def _negotiated(res):
+            self._history.hints[description] = True
+            ev.finish(handshake=since(connected[0]), result="ok")
+            return res
+        def _failed(f):
+            if f.check(defer.CancelledError):
+                ev.finish(result="cancelled")
+            else:
+                ev.finish(result=f.getErrorMessage() or f.type.__name__)
+            return f
+        d.addCallbacks(_negotiated, _failed)
         return d
 
     def _endpoint_from_hint_obj(self, hint):
@@ -842,8 +1894,30 @@ class Common:
         if isinstance(hint, DirectTCPV1Hint):
             return endpoints.HostnameEndpoint(self._reactor,
                                               hint.hostname, hint.port)
+        if isinstance(hint, DirectUDPV1Hint) and self._udp:
+            return rudp.UDPClientEndpoint(self._udp, hint.hostname, hint.port)
+        if isinstance(hint, UnixV1Hint):
+            # hints from another host name paths that aren't here (or, if
+            # they are, the handshake will fail)
+            if (interfaces.IReactorUNIX.providedBy(self._reactor)
+                and self._is_our_kind_of_socket(hint.path)):
+                return endpoints.UNIXClientEndpoint(self._reactor, hint.path)
         return None
 
+    def _is_our_kind_of_socket(self, path):
+        # The peer picks the path, so it could point us at any socket on
+        # this host (a docker daemon, someone's ssh-agent), and we'd write
+        # our handshake to it. Only connect to a socket that _listen_unix()
+        # could have made, in the directory we'd use ourselves.
+        if self._unix_socket_dir is None:
+            return False
+        if not UNIX_SOCKET_NAME.match(os.path.basename(path)):
+            return False
+        ours = os.path.realpath(self._unix_socket_dir)
+        if os.path.realpath(os.path.dirname(path)) != ours:
+            return False
+        return _is_unix_socket(path)
+
     def connection_ready(self, p):
         # inbound/outbound Connection protocols call this when they finish
         # negotiation. The first one wins and gets a "go". Any subsequent
@@ -859,6 +1933,13 @@ class Common:
         self._winner = p
         return "go"
 
+    def connection_negotiated(self, p):
+        # Only the winner gets this far. We may not have seen the other
+        # side's abilities yet (a sender sets its key, and so accepts
+        # connections, before the receiver's transit message arrives), so
+        # the winner holds on to its records until connect() sets it up.
+        p.hold_records()
+
 class TransitSender(Common):
     is_sender = True
 
@@ -894,6 +1975,573 @@ class FileConsumer:
         assert self._producer
         self._producer = None
 
+# ThreadedFileConsumer hands the data to a dedicated writer thread instead,
+# so a slow disk can't stall the reactor. The queue between the two is
+# bounded: once WRITER_HIGH_WATER bytes are waiting we pause the producer
+# (for a Connection, that stops reading from the socket, and TCP flow control
+# pushes back on the sender), and resume it when the writer has caught up to
+# WRITER_LOW_WATER. Each chunk is given its offset when it is queued, and
+# regular files are written with pwrite() at that offset, so nothing depends
+# on the file position in the thread (or on the batches finishing in order,
+# although for now only one is in the thread at a time).
+
+WRITER_HIGH_WATER = 2**23
+WRITER_LOW_WATER = 2**21
+
+def _write_chunks(f, fd, chunks):
+    # runs in the writer thread
+    for (offset, chunk) in chunks:
+        if fd is None:
+            f.write(chunk)
+            continue
+        view = memoryview(chunk)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+
+@implementer(interfaces.IConsumer)
+class ThreadedFileConsumer:
+    def __init__(self, f, reactor, progress=None, hasher=None,
+                 threadpool=None, high_water=WRITER_HIGH_WATER,
+                 low_water=WRITER_LOW_WATER):
+        assert low_water <= high_water
+        self._f = f
+        self._fd = None
+        if hasattr(os, "pwrite"): # py3 on unix
+            self._fd = _regular_file_fd(f)
+        if self._fd is not None:
+            f.flush() # anything it has buffered goes before our pwrite()s
+        self._offset = f.tell() # where the next queued chunk will go
+        self._written = self._offset # everything before this is done
+        self._reactor = reactor
+        self._progress = progress
+        self._hasher = hasher
+        self._own_pool = threadpool is None
+        if self._own_pool:
+            threadpool = ThreadPool(1, 1, "transit-writer")
+            threadpool.start()
+        self._pool = threadpool
+        self._high_water = high_water
+        self._low_water = low_water
+        self._producer = None
+        self._paused = False
+        self._queue = [] # (offset, chunk) not yet handed to the writer thread
+        self._queued = 0 # bytes in _queue, plus the batch being written
+        self._writing = False
+        self._error = None
+        self._drain_waiters = []
+        self._max_queued = 0
+        self._pauses = 0
+        self._batches = 0
+
+    def get_stats(self):
+        """Return a dict of counters for the write queue: 'writer_queued' is
+        the number of bytes waiting right now, 'writer_max_queued' the most
+        that ever were, 'writer_pauses' how many times we paused the
+        producer, and 'writer_batches' how many batches the thread wrote."""
+        return {"writer_queued": self._queued,
+                "writer_max_queued": self._max_queued,
+                "writer_pauses": self._pauses,
+                "writer_batches": self._batches,
+                }
+
+    def registerProducer(self, producer, streaming):
+        assert not self._producer
+        self._producer = producer
+        assert streaming
+
+    def write(self, bytes):
+        if self._error:
+            return # the writer has failed, we're just waiting for the hangup
+        if self._hasher:
+            self._hasher(bytes)
+        self._queue.append((self._offset, bytes))
+        self._offset += len(bytes)
+        self._queued += len(bytes)
+        self._max_queued = max(self._max_queued, self._queued)
+        if (self._queued >= self._high_water and self._producer
+            and not self._paused):
+            self._paused = True
+            self._pauses += 1
+            self._producer.pauseProducing()
+        self._write_next()
+
+    def unregisterProducer(self):
+        assert self._producer
+        producer, self._producer = self._producer, None
+        if self._paused:
+            # anything else that arrives is for someone else
+            self._paused = False
+            producer.resumeProducing()
+
+    def _write_next(self):
+        if self._writing or not self._queue:
+            return
+        batch, self._queue = self._queue, []
+        self._writing = True
+        self._batches += 1
+        d = threads.deferToThreadPool(self._reactor, self._pool,
+                                      _write_chunks, self._f, self._fd, batch)
+        d.addCallbacks(self._batch_written, self._write_failed,
+                       callbackArgs=(sum(len(c) for (_, c) in batch),))
+
+    def _batch_written(self, _, size):
+        self._writing = False
+        self._queued -= size
+        self._written += size
+        if self._progress:
+            self._progress(size)
+        if self._paused and self._queued <= self._low_water:
+            self._paused = False
+            self._producer.resumeProducing()
+        self._write_next()
+        self._check_drained()
+
+    def _write_failed(self, f):
+        self._writing = False
+        self._error = f
+        self._queue = []
+        self._queued = 0
+        if self._producer:
+            # there's nowhere to put the rest of the data
+            self._producer.stopProducing()
+        self._check_drained()
+
+    def _check_drained(self):
+        if self._writing or self._queue:
+            return
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for d in waiters:
+            if self._error:
+                d.errback(self._error)
+            else:
+                d.callback(None)
+
+    def drain(self):
+        """Return a Deferred that fires when everything written so far has
+        been handed to the file, or errbacks if the writer failed."""
+        d = defer.Deferred()
+        self._drain_waiters.append(d)
+        self._check_drained()
+        return d
+
+    def close(self):
+        """drain(), then stop the writer thread if we started it."""
+        d = self.drain()
+        def _stop(res):
+            if self._fd is not None:
+                # leave the file where a sequence of write()s would have
+                self._f.seek(self._written)
+            if self._own_pool and self._pool.started:
+                self._pool.stop()
+            return res
+        d.addBoth(_stop)
+        return d
+
+def _when_written(fc, d):
+    # make writeToFile() wait until the queued data is in the file, so the
+    # caller can close or rename it. A failed write trumps everything else.
+    def _close(res):
+        d2 = fc.close()
+        d2.addCallback(lambda _: res)
+        return d2
+    d.addBoth(_close)
+    return d
+
+# Striping: a file can be spread over several Connections at once, to fill a
+# high-latency pipe that one TCP stream cannot. Each stripe is a complete,
+# independent Transit (with its own key, hints, and relay token), so the
+# usual nonce rules are untouched. The StripedConnection prefixes each data
+# record with a sequence number (inside the encryption, so it cannot be
+# tampered with), writes it to whichever stripe asks for data first, and the
+# receiving side puts the records back in order. Control records (like the
+# final ack) use send_record()/receive_record() on the first stripe. Records
+# that arrive ahead of a gap wait in memory, but once INBOUND_QUEUE_SIZE bytes
+# of them are waiting, we stop reading from the stripes that are ahead until
+# the stripe that owes us the missing record catches up.
+
+MAX_STRIPES = 8
+
+@implementer(interfaces.IProducer, interfaces.IConsumer)
+class StripedConnection:
+    def __init__(self, connections):
+        assert connections
+        self._connections = list(connections)
+        # outbound
+        self._producer = None
+        self._current = None # the stripe that asked for the next record
+        self._next_send_seqnum = 0
+        # inbound
+        self._consumer = None
+        self._consumer_bytes_written = 0
+        self._consumer_bytes_expected = None
+        self._consumer_deferred = None
+        self._next_receive_seqnum = 0
+        self._out_of_order = {} # seqnum -> data
+        self._out_of_order_size = 0
+        self._ahead = [] # stripes we paused until the gap is filled
+        self._paused = False # by our consumer
+        self._file_consumer = None
+
+    def describe(self):
+        return "striped: " + ", ".join(c.describe()
+                                       for c in self._connections)
+
+    def get_stats(self):
+        stats = {}
+        for c in self._connections:
+            for name, value in c.get_stats().items():
+                if name in ("handshake_time", "first_byte_time"):
+                    # the stripes run side by side: report the slowest
+                    stats[name] = max(stats.get(name, 0), value)
+                else:
+                    stats[name] = stats.get(name, 0) + value
+        stats["stripes"] = len(self._connections)
+        if self._file_consumer:
+            stats.update(self._file_consumer.get_stats())
+        return stats
+
+    def send_record(self, record):
+        self._connections[0].send_record(record)
+
+    def receive_record(self):
+        return self._connections[0].receive_record()
+
+    def read(self, size=None):
+        return self._connections[0].read(size)
+
+    def read_chunks(self):
+        return self._connections[0].read_chunks()
+
+    def chunks(self, size=None, loop=None):
+        return self._connections[0].chunks(size, loop)
+
+    def close(self):
+        for c in self._connections:
+            c.close()
+
+    # IConsumer methods, for outbound data. Each stripe gets its own pull
+    # producer, so the transport that drains fastest gets the most records.
+    def registerProducer(self, producer, streaming):
+        assert not streaming # we need to decide which stripe gets each chunk
+        self._producer = producer
+        for c in self._connections:
+            c.registerProducer(_StripeFeeder(self, c), False)
+
+    def unregisterProducer(self):
+        self._producer = None
+        for c in self._connections:
+            c.unregisterProducer()
+
+    def _feed(self, connection):
+        if self._producer is None:
+            return
+        self._current = connection
+        try:
+            self._producer.resumeProducing()
+        finally:
+            self._current = None
+
+    def _stripe_stopped(self):
+        # one of our stripes has gone away, along with any records that it
+        # was carrying, so the whole transfer is doomed
+        if self._producer is not None:
+            producer, self._producer = self._producer, None
+            producer.stopProducing()
+
+    def write(self, data):
+        c = self._current or self._connections[0]
+        c.send_record(encode_seqnum(self._next_send_seqnum) + data)
+        self._next_send_seqnum += 1
+
+    # IProducer methods, for inbound flow-control
+    def stopProducing(self):
+        for c in self._connections:
+            c.stopProducing()
+    def pauseProducing(self):
+        self._paused = True
+        for c in self._connections:
+            c.pauseProducing()
+    def resumeProducing(self):
+        self._paused = False
+        for c in self._connections:
+            if c not in self._ahead:
+                c.resumeProducing()
+
+    def connectConsumer(self, consumer, expected):
+        """Like Connection.connectConsumer, but 'expected' is required, since
+        that's how we know the stripes are finished. Returns a Deferred that
+        fires with the number of bytes received, or errbacks if any stripe is
+        lost before then."""
+        if self._consumer:
+            raise RuntimeError("A consumer is already attached: %r" %
+                               self._consumer)
+        consumer.registerProducer(self, True)
+        self._consumer = consumer
+        self._consumer_bytes_written = 0
+        self._consumer_bytes_expected = expected
+        self._consumer_deferred = d = defer.Deferred()
+        for c in self._connections:
+            if self._consumer is None:
+                break # queued records were enough to finish
+            c.connectConsumer(_StripeConsumer(self))
+            if c._consumer is not None:
+                # we don't know how many bytes each stripe will carry, but
+                # we still want to hear about it if one is lost
+                c._consumer_deferred = defer.Deferred()
+                c._consumer_deferred.addErrback(self._stripe_lost)
+        return d
+
+    def _stripe_record(self, record, stripe):
+        seqnum = decode_seqnum(record)
+        if seqnum < self._next_receive_seqnum or seqnum in self._out_of_order:
+            raise BadNonce("duplicate striped record %d" % seqnum)
+        self._out_of_order[seqnum] = record[SEQNUM_SIZE:]
+        self._out_of_order_size += len(record) - SEQNUM_SIZE
+        while self._consumer and self._next_receive_seqnum in self._out_of_order:
+            data = self._out_of_order.pop(self._next_receive_seqnum)
+            self._out_of_order_size -= len(data)
+            self._next_receive_seqnum += 1
+            self._consumer.write(data)
+            self._consumer_bytes_written += len(data)
+            if self._consumer_bytes_written >= self._consumer_bytes_expected:
+                d = self._consumer_deferred
+                self._disconnectConsumer()
+                d.callback(self._consumer_bytes_written)
+        if self._out_of_order_size >= INBOUND_QUEUE_SIZE:
+            # each stripe delivers its own records in order, so this one
+            # can't be the one that owes us the missing record
+            if stripe is not None and stripe not in self._ahead:
+                self._ahead.append(stripe)
+                stripe.pauseProducing()
+        elif self._ahead:
+            ahead, self._ahead = self._ahead, []
+            if not self._paused:
+                for c in ahead:
+                    c.resumeProducing()
+
+    def _stripe_lost(self, f):
+        d = self._consumer_deferred
+        if d:
+            self._disconnectConsumer()
+            d.errback(f)
+
+    def _disconnectConsumer(self):
+        for c in self._connections:
+            if isinstance(c._consumer, _StripeConsumer):
+                c.disconnectConsumer()
+        self._consumer.unregisterProducer()
+        self._consumer = None
+        self._consumer_bytes_expected = None
+        self._consumer_deferred = None
+
+    def writeToFile(self, f, expected, progress=None, hasher=None,
+                    reactor=None):
+        if reactor is None:
+            fc = FileConsumer(f, progress, hasher)
+            return self.connectConsumer(fc, expected)
+        self._file_consumer = fc = ThreadedFileConsumer(f, reactor, progress,
+                                                        hasher)
+        return _when_written(fc, self.connectConsumer(fc, expected))
+
+@inlineCallbacks
+def connect_striped(transits):
+    """Connect all of 'transits' (TransitSenders or TransitReceivers) in
+    parallel, and fire with a StripedConnection. The first one must succeed,
+    the rest are optional: the transfer can still work (more slowly) with
+    fewer stripes. Both sides must use this (rather than connect()) if they
+    agreed to stripe, even if only one stripe connects, because the records
+    are framed differently."""
+    results = yield defer.DeferredList([t.connect() for t in transits],
+                                       consumeErrors=True)
+    (ok, first) = results[0]
+    if not ok:
+        first.raiseException()
+    connections = [first] + [c for (ok, c) in results[1:] if ok]
+    returnValue(StripedConnection(connections))
+
+@implementer(interfaces.IPullProducer)
+class _StripeFeeder:
+    # registered with one stripe: when its transport wants more data, we ask
+    # the StripedConnection's real producer to write a record to it
+    def __init__(self, striped, connection):
+        self._striped = striped
+        self._connection = connection
+    def resumeProducing(self):
+        self._striped._feed(self._connection)
+    def stopProducing(self):
+        self._striped._stripe_stopped()
+
+@implementer(interfaces.IConsumer)
+class _StripeConsumer:
+    # connected to one stripe, hands its records to the StripedConnection
+    def __init__(self, striped):
+        self._striped = striped
+        self._stripe = None
+    def registerProducer(self, producer, streaming):
+        self._stripe = producer
+    def unregisterProducer(self):
+        pass
+    def write(self, record):
+        self._striped._stripe_record(record, self._stripe)
+
+# FileProducer reads regular files through a sliding mmap() window instead of
+# read(): each record is then a single copy out of the page cache, with no
+# system call. We also tell the kernel we'll read sequentially, so it reads
+# further ahead. Anything else (a pipe, a BytesIO, or a SpooledTemporaryFile
+# still held in memory) is read() the usual way. The file size is checked
+# each time the window moves, but a file that is truncated underneath us
+# while a window is mapped can still get us killed with SIGBUS.
+
+MAP_WINDOW = 2**23
+
+def _regular_file_fd(f):
+    # asking a SpooledTemporaryFile for its fileno() would make it roll
+    # itself over to disk, so leave those alone
+    if isinstance(f, tempfile.SpooledTemporaryFile):
+        return None
+    try:
+        fd = f.fileno()
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            return None
+    except (AttributeError, ValueError, EnvironmentError):
+        return None
+    return fd
+
+class _MappedReader:
+    def __init__(self, f, fd, window=None):
+        self._f = f
+        self._fd = fd
+        self._window = window or MAP_WINDOW
+        self._pos = f.tell()
+        self._map = None
+        self._map_start = 0
+        self._mapping_failed = False
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, self._pos, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def read(self, size):
+        if self._mapping_failed:
+            return self._f.read(size)
+        end = self._pos + size
+        if self._map is None or end > self._map_start + len(self._map):
+            if not self._remap(size):
+                return self.read(size) if self._mapping_failed else b""
+        offset = self._pos - self._map_start
+        chunk = self._map[offset:offset+size]
+        self._pos += len(chunk)
+        return chunk
+
+    def _remap(self, size):
+        self._unmap()
+        filesize = os.fstat(self._fd).st_size
+        if self._pos >= filesize:
+            return False
+        start = self._pos - self._pos % mmap.ALLOCATIONGRANULARITY
+        length = min(max(self._window, self._pos - start + size),
+                     filesize - start)
+        try:
+            self._map = mmap.mmap(self._fd, length, access=mmap.ACCESS_READ,
+                                  offset=start)
+        except (EnvironmentError, ValueError):
+            # some filesystems can't be mapped: read() the rest instead
+            self._mapping_failed = True
+            self._f.seek(self._pos)
+            return False
+        self._map_start = start
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+        return True
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def detach(self):
+        # leave the file where a read() loop would have left it
+        if not self._mapping_failed:
+            self._unmap()
+            self._f.seek(self._pos)
+
+# based on twisted.protocols.basic.FileSender, but each chunk becomes a
+# single transit record, so let the caller choose the chunk size (usually
+# from Common.get_record_size()).
+
+@implementer(interfaces.IPullProducer)
+class FileProducer:
+    def __init__(self, record_size=Common.DEFAULT_RECORD_SIZE):
+        self._record_size = record_size
+        self._f = None
+        self._consumer = None
+        self._transform = None
+        self._deferred = None
+        self._reading = False
+
+    def beginFileTransfer(self, f, consumer, transform=None):
+        """Read 'f' until EOF, writing each chunk to 'consumer' (after passing
+        it through 'transform', if provided). Returns a Deferred that fires
+        when the file has been completely written to the consumer. If
+        f.read() returns a Deferred, the chunk is written when it fires."""
+        fd = _regular_file_fd(f)
+        self._f = f if fd is None else _MappedReader(f, fd)
+        self._consumer = consumer
+        self._transform = transform
+        self._deferred = d = defer.Deferred()
+        self._consumer.registerProducer(self, False)
+        return d
+
+    def resumeProducing(self):
+        if self._reading:
+            return # the next chunk will be written when it arrives
+        chunk = b""
+        if self._f:
+            chunk = self._f.read(self._record_size)
+        if isinstance(chunk, defer.Deferred):
+            self._reading = True
+            chunk.addCallbacks(self._read_done, self._read_failed)
+            return
+        self._write(chunk)
+
+    def _read_done(self, chunk):
+        self._reading = False
+        if self._f is not None: # not stopped in the meantime
+            self._write(chunk)
+
+    def _read_failed(self, f):
+        self._reading = False
+        if self._f is None:
+            return # stopped in the meantime, and nobody is waiting
+        self._close_file()
+        self._consumer.unregisterProducer()
+        if self._deferred:
+            d, self._deferred = self._deferred, None
+            d.errback(f)
+
+    def _write(self, chunk):
+        if not chunk:
+            self._close_file()
+            self._consumer.unregisterProducer()
+            if self._deferred:
+                d, self._deferred = self._deferred, None
+                d.callback(None)
+            return
+        if self._transform:
+            chunk = self._transform(chunk)
+        self._consumer.write(chunk)
+
+    def stopProducing(self):
+        self._close_file()
+        if self._deferred:
+            d, self._deferred = self._deferred, None
+            d.errback(TransitClosed("Consumer asked us to stop producing"))
+
+    def _close_file(self):
+        if isinstance(self._f, _MappedReader):
+            self._f.detach()
+        self._f = None
+
 # the TransitSender/Receiver.connect() yields a Connection, on which you can
 # do send_record(), but what should the receive API be? set a callback for
 # inbound records? get a Deferred for the next record? The producer/consumer
@@ -912,7 +2560,3 @@ class FileConsumer:
 
 # check start/finish time-gathering instrumentation
 
-# relay URLs are probably mishandled: both sides probably send their URL,
-# then connect to the *other* side's URL, when they really should connect to
-# both their own and the other side's. The current implementation probably
-# only works if the two URLs are the same.